@@ -0,0 +1,498 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Discovergy anomaly detection
+
+Detect unusual consumption, e. g. a stuck heater or a failing fridge, as the
+power data arrives. The power is averaged per minute and each minute is
+compared to the profile of its hour of the UTC day: an exponentially weighted
+mean and variance of the minute means of that hour on the days before. A
+minute deviates if it is more than threshold standard deviations off. An
+Anomaly is emitted once a deviation lasted duration minutes.
+
+The detector runs on every batch of power data fetched or imported. Updating
+the profile costs O(1) per new sample, the history is never read again. Samples
+not newer than the last one seen are skipped. The live readings are scored
+against the profile as they arrive, too, but don't update it. They have a
+cursor of their own, so the fetched batch covering them is still counted. A
+deviation reported from the live readings isn't reported again by the batch.
+
+The state of each meter is kept in <data_dir>/anomaly/<meter_id>.json. The
+anomalies are logged, published to live.publisher and appended to
+<data_dir>/anomaly/<meter_id>.events.jsonl. Configure the detector in the
+[anomaly] section, the duration in minutes and half_life and warmup in days::
+
+    [anomaly]
+    threshold: 4
+    duration: 15
+    half_life: 14
+    warmup: 7
+
+A threshold of 0 disables the detector.
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import json
+import os
+
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+import numpy as np  # type: ignore
+import pandas as pd  # type: ignore
+
+from box import Box  # type: ignore
+from loguru import logger as log
+
+from . import live
+from .defaults import (
+    ANOMALY_DURATION,
+    ANOMALY_HALF_LIFE,
+    ANOMALY_MIN_STD,
+    ANOMALY_THRESHOLD,
+    ANOMALY_WARMUP,
+)
+from .utils import file_lock
+
+
+SLOTS = 24  # hours of the UTC day
+FIELD = "power"
+
+
+class Anomaly(NamedTuple):
+    meter_id: str
+    start: pd.Timestamp  # naive UTC start of the first deviating minute
+    time: pd.Timestamp  # naive UTC start of the minute the deviation lasted duration
+    power: float  # mean power of that minute as stored, i. e. mW
+    expected: float  # mean power of its hour of the day
+    score: float  # deviation in standard deviations
+
+
+class Run:
+    """Represents an open deviation, minutes in seconds since the epoch."""
+
+    def __init__(
+        self,
+        start: Optional[int] = None,
+        last: Optional[int] = None,
+        reported: bool = False,
+    ):
+        self.start = start
+        self.last = last
+        self.reported = reported
+
+    def __repr__(self):
+        return f"Run:{self.start}-{self.last}"
+
+
+def close_minutes(
+    times: np.ndarray,
+    values: np.ndarray,
+    minute: Optional[int],
+    minute_sum: float,
+    minute_count: int,
+) -> Tuple[np.ndarray, np.ndarray, Tuple[int, float, int]]:
+    """Return the minutes closed by the samples and their means plus the minute
+    still receiving samples with its sum and count.
+
+    :param minute: the minute receiving samples before with its sum and count"""
+    minutes, inverse = np.unique(times // 60 * 60, return_inverse=True)
+    sums = np.bincount(inverse, weights=values)
+    counts = np.bincount(inverse).astype("float64")
+    if minute is not None:
+        if minute == minutes[0]:
+            sums[0] += minute_sum
+            counts[0] += minute_count
+        else:
+            minutes = np.r_[minute, minutes]
+            sums = np.r_[minute_sum, sums]
+            counts = np.r_[minute_count, counts]
+    # The last minute may still receive samples.
+    return (
+        minutes[:-1],
+        sums[:-1] / counts[:-1],
+        (int(minutes[-1]), float(sums[-1]), int(counts[-1])),
+    )
+
+
+class Detector:
+    """Represents the time of day profile and the open deviation of a meter."""
+
+    def __init__(
+        self,
+        *,
+        meter_id: str,
+        threshold: float = ANOMALY_THRESHOLD,
+        duration: int = ANOMALY_DURATION,
+        half_life: float = ANOMALY_HALF_LIFE,
+        warmup: float = ANOMALY_WARMUP,
+        min_std: float = ANOMALY_MIN_STD,
+    ):
+        """:param duration: minutes a deviation lasts before it is an anomaly
+        :param half_life: days after which a minute weighs half in the profile
+        :param warmup: days of minutes an hour of the day needs to be scored"""
+        self.meter_id = meter_id
+        self.threshold = threshold
+        self.duration = duration
+        self.min_std = min_std
+        # Every hour of the day gets 60 minutes a day.
+        self.decay = 0.5 ** (1 / (half_life * 60))
+        self.min_count = warmup * 60
+        # Exponentially weighted sums of the weights, values and squares per hour
+        self.weight = np.zeros(SLOTS)
+        self.sum = np.zeros(SLOTS)
+        self.square = np.zeros(SLOTS)
+        self.count = np.zeros(SLOTS, dtype="int64")
+        # The minute still receiving samples, in seconds since the epoch
+        self.minute: Optional[int] = None
+        self.minute_sum = 0.0
+        self.minute_count = 0
+        self.last_time: Optional[int] = None
+        self.run = Run()
+        # The same for the live readings, which don't update the profile
+        self.live_minute: Optional[int] = None
+        self.live_minute_sum = 0.0
+        self.live_minute_count = 0
+        self.live_time: Optional[int] = None
+        self.live_run = Run()
+        # The first and last minute of the last deviation reported live
+        self.live_reported: Optional[Tuple[int, int]] = None
+
+    def __repr__(self):
+        return f"Detector:{self.meter_id}"
+
+    def state(self) -> Dict[str, Any]:
+        """Return the state to persist."""
+        return {
+            "weight": self.weight.tolist(),
+            "sum": self.sum.tolist(),
+            "square": self.square.tolist(),
+            "count": self.count.tolist(),
+            "minute": self.minute,
+            "minute_sum": self.minute_sum,
+            "minute_count": self.minute_count,
+            "last_time": self.last_time,
+            "run_start": self.run.start,
+            "run_last": self.run.last,
+            "reported": self.run.reported,
+            "live_minute": self.live_minute,
+            "live_minute_sum": self.live_minute_sum,
+            "live_minute_count": self.live_minute_count,
+            "live_time": self.live_time,
+            "live_run_start": self.live_run.start,
+            "live_run_last": self.live_run.last,
+            "live_run_reported": self.live_run.reported,
+            "live_reported": self.live_reported,
+        }
+
+    def load(self, state: Dict[str, Any]) -> None:
+        """Restore the persisted state."""
+        for key in ("weight", "sum", "square"):
+            setattr(self, key, np.array(state[key], dtype="float64"))
+        self.count = np.array(state["count"], dtype="int64")
+        for key in (
+            "minute",
+            "minute_sum",
+            "minute_count",
+            "last_time",
+            "live_minute",
+            "live_minute_sum",
+            "live_minute_count",
+            "live_time",
+        ):
+            setattr(self, key, state[key])
+        self.run = Run(state["run_start"], state["run_last"], state["reported"])
+        self.live_run = Run(
+            state["live_run_start"], state["live_run_last"], state["live_run_reported"]
+        )
+        live_reported = state["live_reported"]
+        self.live_reported = tuple(live_reported) if live_reported else None
+
+    def profile(self) -> pd.DataFrame:
+        """Return the mean and standard deviation of each hour of the UTC day."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = self.sum / self.weight
+            var = self.square / self.weight - mean**2
+        return pd.DataFrame(
+            {"mean": mean, "std": np.sqrt(np.maximum(var, 0)), "count": self.count},
+            index=pd.RangeIndex(SLOTS, name="hour"),
+        )
+
+    def add(self, times: np.ndarray, values: np.ndarray) -> List[Anomaly]:
+        """Add the samples, times in seconds since the epoch in ascending order.
+        Return the anomalies found."""
+        times = np.asarray(times, dtype="int64")
+        values = np.asarray(values, dtype="float64")
+        new = np.isfinite(values)
+        if self.last_time is not None:
+            new &= times > self.last_time
+        times, values = times[new], values[new]
+        if not len(times):
+            return []
+        self.last_time = int(times[-1])
+        minutes, means, minute = close_minutes(
+            times, values, self.minute, self.minute_sum, self.minute_count
+        )
+        self.minute, self.minute_sum, self.minute_count = minute
+        if not len(minutes):
+            return []
+        slots = (minutes // 3600) % SLOTS
+        # Score against the profile before the batch, then update it.
+        expected, scores, deviating = self._score(slots, means)
+        self._update_profile(slots, means)
+        return self._track(minutes, means, expected, scores, deviating, self.run)
+
+    def add_live(self, times: np.ndarray, values: np.ndarray) -> List[Anomaly]:
+        """Score the live samples, times in seconds since the epoch in ascending
+        order, without updating the profile. Return the anomalies found."""
+        times = np.asarray(times, dtype="int64")
+        values = np.asarray(values, dtype="float64")
+        new = np.isfinite(values)
+        cursors = [t for t in (self.last_time, self.live_time) if t is not None]
+        if cursors:
+            new &= times > max(cursors)
+        times, values = times[new], values[new]
+        if not len(times):
+            return []
+        self.live_time = int(times[-1])
+        # The batch caught up with the live minute.
+        if (
+            self.live_minute is not None
+            and self.minute is not None
+            and self.live_minute <= self.minute
+        ):
+            self.live_minute = None
+        minutes, means, live_minute = close_minutes(
+            times,
+            values,
+            self.live_minute,
+            self.live_minute_sum,
+            self.live_minute_count,
+        )
+        self.live_minute, self.live_minute_sum, self.live_minute_count = live_minute
+        if not len(minutes):
+            return []
+        slots = (minutes // 3600) % SLOTS
+        expected, scores, deviating = self._score(slots, means)
+        return self._track(minutes, means, expected, scores, deviating, self.live_run)
+
+    def _score(
+        self, slots: np.ndarray, means: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Return the expected means, the scores and whether the minute means of
+        the hours slots deviate."""
+        profile = self.profile()
+        expected = profile["mean"].to_numpy()[slots]
+        std = np.maximum(profile["std"].to_numpy()[slots], self.min_std)
+        scores = (means - expected) / std
+        deviating = (self.count[slots] >= self.min_count) & (
+            np.abs(scores) > self.threshold
+        )
+        return expected, scores, deviating
+
+    def _update_profile(self, slots: np.ndarray, means: np.ndarray) -> None:
+        """Decay the sums of each hour once per minute added to it, in time order."""
+        order = np.argsort(slots, kind="stable")
+        n = np.bincount(slots, minlength=SLOTS)
+        starts = np.r_[0, np.cumsum(n)[:-1]]
+        # The number of later minutes of the same hour in the batch
+        rank = np.empty(len(slots), dtype="int64")
+        rank[order] = np.arange(len(slots)) - np.repeat(starts, n)
+        later = n[slots] - 1 - rank
+        weights = self.decay**later
+        decay = self.decay**n
+        self.weight = self.weight * decay + np.bincount(
+            slots, weights=weights, minlength=SLOTS
+        )
+        self.sum = self.sum * decay + np.bincount(
+            slots, weights=weights * means, minlength=SLOTS
+        )
+        self.square = self.square * decay + np.bincount(
+            slots, weights=weights * means**2, minlength=SLOTS
+        )
+        self.count += n
+
+    def _track(
+        self,
+        minutes: np.ndarray,
+        means: np.ndarray,
+        expected: np.ndarray,
+        scores: np.ndarray,
+        deviating: np.ndarray,
+        run: Run,
+    ) -> List[Anomaly]:
+        """Follow the deviations minute by minute and return the ones that lasted
+        duration minutes."""
+        live = run is self.live_run
+        anomalies = []
+        for i in range(len(minutes)):
+            minute = int(minutes[i])
+            if not deviating[i]:
+                run.start = run.last = None
+                continue
+            if run.start is None or run.last is None or minute - run.last > 60:
+                run.start, run.reported = minute, False
+            run.last = minute
+            if live and run.reported:
+                self.live_reported = (run.start, minute)
+            if run.reported or minute - run.start < (self.duration - 1) * 60:
+                continue
+            run.reported = True
+            if live:
+                self.live_reported = (run.start, minute)
+            elif (
+                self.live_reported is not None
+                and self.live_reported[0] <= minute
+                and self.live_reported[1] >= run.start
+            ):
+                # Reported from the live readings already
+                continue
+            anomalies.append(
+                Anomaly(
+                    meter_id=self.meter_id,
+                    start=pd.Timestamp(run.start, unit="s"),
+                    time=pd.Timestamp(minute, unit="s"),
+                    power=float(means[i]),
+                    expected=float(expected[i]),
+                    score=float(scores[i]),
+                )
+            )
+        return anomalies
+
+
+def anomaly_dir(config: Box) -> Path:
+    return Path(config.file_location.data_dir).expanduser() / "anomaly"
+
+
+def detector_path(config: Box, meter_id: str) -> Path:
+    """Return the path of the detector state of the meter."""
+    return anomaly_dir(config) / f"{meter_id}.json"
+
+
+def events_path(config: Box, meter_id: str) -> Path:
+    """Return the path of the anomalies found for the meter."""
+    return anomaly_dir(config) / f"{meter_id}.events.jsonl"
+
+
+def get_detector(config: Box, meter_id: str) -> Optional[Detector]:
+    """Return the detector of the meter with its persisted state. None if it is
+    disabled."""
+    anomaly_config = config.get("anomaly", {})
+    threshold = float(anomaly_config.get("threshold", ANOMALY_THRESHOLD) or 0)
+    if threshold <= 0:
+        return None
+    detector = Detector(
+        meter_id=meter_id,
+        threshold=threshold,
+        duration=int(anomaly_config.get("duration", ANOMALY_DURATION)),
+        half_life=float(anomaly_config.get("half_life", ANOMALY_HALF_LIFE)),
+        warmup=float(anomaly_config.get("warmup", ANOMALY_WARMUP)),
+    )
+    try:
+        with detector_path(config, meter_id).open() as fh:
+            detector.load(json.load(fh))
+    except FileNotFoundError:
+        pass
+    except (json.JSONDecodeError, KeyError) as e:
+        log.warning(f"Resetting the corrupt anomaly detector of {meter_id}: {e}")
+    return detector
+
+
+def _write_detector(config: Box, detector: Detector) -> None:
+    file_path = detector_path(config, detector.meter_id)
+    tmp_path = file_path.with_suffix(".tmp")
+    with tmp_path.open("w") as fh:
+        json.dump(detector.state(), fh)
+    os.replace(tmp_path, file_path)
+
+
+def emit(config: Box, anomalies: Iterable[Anomaly]) -> None:
+    """Log, publish and record the anomalies."""
+    for anomaly in anomalies:
+        log.warning(
+            f"Unusual consumption of {anomaly.meter_id} since {anomaly.start}: "
+            f"{anomaly.power:.0f} instead of {anomaly.expected:.0f} "
+            f"({anomaly.score:+.1f} std)."
+        )
+        live.publisher.publish(anomaly)
+        with events_path(config, anomaly.meter_id).open("a") as fh:
+            fh.write(
+                json.dumps(
+                    {
+                        **anomaly._asdict(),
+                        "start": anomaly.start.isoformat(),
+                        "time": anomaly.time.isoformat(),
+                    }
+                )
+                + "\n"
+            )
+
+
+def add_samples(
+    *,
+    config: Box,
+    meter_id: str,
+    times: np.ndarray,
+    values: np.ndarray,
+    live: bool = False,
+) -> List[Anomaly]:
+    """Run the detector of the meter on the samples, times in seconds since the
+    epoch in ascending order. Return the anomalies found.
+
+    :param live: the samples are live readings, see Detector.add_live"""
+    file_path = detector_path(config, meter_id)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    # The fetched batches and the live readings of a meter arrive concurrently.
+    with file_lock(file_path.with_suffix(".lock")):
+        detector = get_detector(config, meter_id)
+        if detector is None:
+            return []
+        if live:
+            anomalies = detector.add_live(times, values)
+        else:
+            anomalies = detector.add(times, values)
+        _write_detector(config, detector)
+        emit(config, anomalies)
+    return anomalies
+
+
+def update(*, config: Box, meter_id: str, df: pd.DataFrame) -> List[Anomaly]:
+    """Run the detector of the meter on the stored power data."""
+    if FIELD not in df.columns or not len(df):
+        return []
+    if df.index.tz is not None:
+        df = df.tz_convert(None)
+    power = df[FIELD].sort_index()
+    return add_samples(
+        config=config,
+        meter_id=meter_id,
+        times=power.index.values.astype("datetime64[s]").astype("int64"),
+        values=power.to_numpy(dtype="float64"),
+    )
+
+
+def add_live_readings(
+    *, config: Box, readings: Iterable["live.LiveReading"]
+) -> List[Anomaly]:
+    """Run the detectors on the live readings, e. g. of a poll. The state of
+    each meter is written once."""
+    samples: Dict[str, List[Tuple[int, float]]] = {}
+    for reading in readings:
+        if FIELD in reading.values:
+            samples.setdefault(reading.meter_id, []).append(
+                (reading.timestamp // 1000, reading.values[FIELD])
+            )
+    anomalies: List[Anomaly] = []
+    for meter_id, meter_samples in samples.items():
+        times, values = zip(*sorted(meter_samples))
+        anomalies += add_samples(
+            config=config,
+            meter_id=meter_id,
+            times=np.array(times),
+            values=np.array(values),
+            live=True,
+        )
+    return anomalies
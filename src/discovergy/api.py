@@ -11,20 +11,27 @@ __copyright__ = "Frank Becker"
 __license__ = "mit"
 
 import json
+import os
 import time
 
 from pathlib import Path
 from urllib.parse import urlencode, urljoin
-from typing import Dict, List, Optional, Set, Union
+from typing import Any, Dict, List, Optional, Set, Union
+
+import pandas as pd  # type: ignore
 
 from box import Box  # type: ignore
 from loguru import logger as log
 from tenacity import retry, stop_after_attempt, stop_after_delay, wait_exponential  # type: ignore
-from authlib.integrations.requests_client import OAuth1Session  # type: ignore
 
-from .auth import get_oauth1_token
-from .defaults import API_URL, API_HOST
-from .utils import before_log, measure_duration
+from . import hot_cache, transport
+from .auth import OAuth1Auth, get_oauth1_token
+from .cluster import get_rate_limiter
+from .coverage import read_coverage
+from .defaults import API_URL, API_HOST, JOURNAL_FLUSH_INTERVAL
+from .response_cache import align_window, get_response_cache, window_closed
+from .statistics import LocalStatistics
+from .utils import before_log, file_lock, measure_duration
 
 
 utc_now = time
@@ -45,7 +52,7 @@ class DiscovergyAPIQueryError(DiscovergyAPIError):
 class DiscovergyAPIClient:
     """Represents a Discovergy API Client."""
 
-    session = None
+    auth: Optional[OAuth1Auth] = None
     last_query_duration: Optional[float] = None
 
     def __init__(self, *, config: Box):
@@ -61,21 +68,27 @@ class DiscovergyAPIClient:
         wait=wait_exponential(multiplier=1, min=4, max=10),
         reraise=True,
     )
-    def _query(self, resource: str) -> dict:
+    def _query(self, resource: str, raw: bool = False) -> Any:
         """Query the Discovergy API for the given url.
 
+        Return the JSON decoded response or the response body if raw is set.
+
         The last query duration can be accessed as
         self.last_query_duration
+
+        The connection is kept alive and shared by all meters, see transport.
         """
-        if not self.session:
-            log.debug("Initiating a new Disovergy API session.")
-            self.session = get_new_api_session(self.config)
+        if not self.auth:
+            self.auth = get_api_auth(self.config)
         url = urljoin(API_HOST, f"{API_URL}/{resource}")
+        rate_limiter = get_rate_limiter(self.config)
         for cycle in range(2):
+            if rate_limiter is not None:
+                rate_limiter.acquire()
             log.debug(f"GETing {url} ...")
             try:
                 with measure_duration() as measure:
-                    request = self.session.get(url)
+                    request = transport.get(url, auth=self.auth)
             except Exception as e:
                 log.warning(f"Caught an exception while querying {url}: {e}")
                 raise
@@ -85,20 +98,18 @@ class DiscovergyAPIClient:
                 break
             elif request.status_code == 401:
                 log.debug("Need to update the OAuth token.")
-                self.config.pop("oauth_token")
-                log.debug("Renewing Discovergy API endpoint HTTPS session.")
-                self.session = get_new_api_session(self.config)
+                stale = self.config.pop("oauth_token", None)
+                self.auth = get_api_auth(self.config, stale=stale)
             else:
                 log.warning(
                     f"Got HTTP status code {request.status_code} while querying {url}. "
-                    "Will re-try with a new OAuth token."
+                    "Will re-try."
                 )
-                self.config.pop("oauth_token")
-                log.debug("Renewing Discovergy API endpoint HTTPS session.")
-                self.session = get_new_api_session(self.config)
         else:
             log.error(f"Could not query {url}. HTTP status code: {request.status_code}")
             raise DiscovergyAPIQueryError(f"Could not query {url}.")
+        if raw:
+            return request.text
         try:
             data = request.json()
         except json.JSONDecodeError:
@@ -117,12 +128,16 @@ class DiscovergyAPIClient:
         discovergy_ts = (discovergy_ts + "000")[:13]
         return int(discovergy_ts)
 
+    @staticmethod
+    def gen_date(timestamp: Union[float, int]) -> str:
+        """Return the UTC day of the given timestamp in s as YYYY-MM-DD.
+        The load profile endpoints use this format.
+        """
+        return time.strftime("%Y-%m-%d", time.gmtime(timestamp))
 
-class DiscovergyMeter(DiscovergyAPIClient):
-    """Represents an energy meter.
 
-    TODO: Implement load_profile, raw_load_profile
-    """
+class DiscovergyMeter(DiscovergyAPIClient):
+    """Represents an energy meter."""
 
     _field_names: Set[str] = set()
     reading_resolutions = {
@@ -135,6 +150,21 @@ class DiscovergyMeter(DiscovergyAPIClient):
         "one_month": 1577880000,  # 50 years
         "one_year": 3155760000,  # 100 years
     }
+    # Approx. seconds between two readings of each resolution. Raw readings
+    # arrive every few seconds.
+    reading_intervals = {
+        "raw": 1,
+        "three_minutes": 180,
+        "fifteen_minutes": 900,
+        "one_hour": 3600,
+        "one_day": 86400,
+        "one_week": 604800,
+        "one_month": 2629800,
+        "one_year": 31557600,
+    }
+    load_profile_resolutions = ("raw", "one_day", "one_month", "one_year")
+    # The fields to fetch and store. None for all, see power.meter_fields.
+    fields: Optional[List[str]] = None
 
     def __init__(self, *, meter: dict, config: Box):
         """Init meter given by the described meter.
@@ -177,16 +207,27 @@ class DiscovergyMeter(DiscovergyAPIClient):
         return True
 
     def _validate_timestamps(self, *, ts_from: int, ts_to: int) -> bool:
-        """Return True if all the given field names are supported. Otherwise,
-        raise a ValueError."""
+        """Return True if ts_from is before ts_to. Otherwise, raise a ValueError."""
         if ts_from >= ts_to:
             msg = (
                 f"The from time {ts_from} must not be larger than the to time {ts_to}."
             )
             log.error(msg)
-            ValueError(msg)
+            raise ValueError(msg)
         return True
 
+    def _query_closed(self, resource: str, ts_to: int, resolution: str = "raw") -> Any:
+        """Query the resource. Its response is cached if the window ending at
+        ts_to (ms) is closed, see response_cache."""
+        cache = get_response_cache(self.config)
+        if cache is None or not window_closed(ts_to, resolution, cache.delay):
+            return self._query(resource)
+        data = cache.get(resource)
+        if data is None:
+            data = self._query(resource)
+            cache.put(resource, data)
+        return data
+
     @property
     def field_names(self) -> Set[str]:
         """Return the list of field names.
@@ -203,9 +244,9 @@ class DiscovergyMeter(DiscovergyAPIClient):
         params = {"meterId": self.meter_id, "from": ts_from}
 
         if ts_to:
-            ts_to = self.gen_ms_timestamp(time.time())
+            ts_to = self.gen_ms_timestamp(ts_to)
             self._validate_timestamps(ts_from=ts_from, ts_to=ts_to)
-            params["to"] = self.gen_ms_timestamp(ts_to)
+            params["to"] = ts_to
 
         return self._query(endpoint(urlencode(params)))
 
@@ -218,9 +259,9 @@ class DiscovergyMeter(DiscovergyAPIClient):
         params = {"meterId": self.meter_id, "from": ts_from}
 
         if ts_to:
-            ts_to = self.gen_ms_timestamp(time.time())
+            ts_to = self.gen_ms_timestamp(ts_to)
             self._validate_timestamps(ts_from=ts_from, ts_to=ts_to)
-            params["to"] = self.gen_ms_timestamp(ts_to)
+            params["to"] = ts_to
         else:
             now = time.time()
             log.debug(
@@ -237,6 +278,42 @@ class DiscovergyMeter(DiscovergyAPIClient):
         params = urlencode({"meterId": self.meter_id})
         return self._query(f"last_reading?{params}")
 
+    def load_profile(
+        self, *, ts_from: int, ts_to: int, resolution: Optional[str] = None,
+    ) -> List[Dict]:
+        """Return the load profile, i. e. the readings recorded by the meter itself.
+
+        The API takes days. ts_from and ts_to are rounded down to their day (UTC).
+        """
+        self._validate_timestamps(ts_from=ts_from, ts_to=ts_to)
+        params = {
+            "meterId": self.meter_id,
+            "from": self.gen_date(ts_from),
+            "to": self.gen_date(ts_to),
+        }
+        if resolution and resolution not in self.load_profile_resolutions:
+            msg = "The resolution argument {} is not known as one of {}.".format(
+                resolution, ", ".join(self.load_profile_resolutions)
+            )
+            log.error(msg)
+            raise ValueError(msg)
+        elif resolution:
+            params["resolution"] = resolution
+        return self._query("load_profile?{}".format(urlencode(params)))
+
+    def raw_load_profile(self, *, ts_from: int, ts_to: int) -> str:
+        """Return the raw load profile file as sent by the meter.
+
+        The API takes days. ts_from and ts_to are rounded down to their day (UTC).
+        """
+        self._validate_timestamps(ts_from=ts_from, ts_to=ts_to)
+        params = {
+            "meterId": self.meter_id,
+            "from": self.gen_date(ts_from),
+            "to": self.gen_date(ts_to),
+        }
+        return self._query("raw_load_profile?{}".format(urlencode(params)), raw=True)
+
     def readings(
         self,
         *,
@@ -251,9 +328,9 @@ class DiscovergyMeter(DiscovergyAPIClient):
         ts_from = self.gen_ms_timestamp(ts_from)
         params = {"meterId": self.meter_id, "from": ts_from}
         if ts_to:
-            ts_to = self.gen_ms_timestamp(time.time())
+            ts_to = self.gen_ms_timestamp(ts_to)
             self._validate_timestamps(ts_from=ts_from, ts_to=ts_to)
-            params["to"] = self.gen_ms_timestamp(ts_to)
+            params["to"] = ts_to
         if field_names and self._validate_field_names(field_names=field_names):
             params["fields"] = ",".join(field_names)
         if resolution and resolution not in self.reading_resolutions:
@@ -274,7 +351,78 @@ class DiscovergyMeter(DiscovergyAPIClient):
         elif disaggregation:
             params["disaggregation"] = "true"
 
-        return self._query(endpoint(urlencode(params)))
+        if not ts_to:
+            return self._query(endpoint(urlencode(params)))
+        resolution = resolution or "raw"
+        aligned_from, aligned_to = align_window(ts_from, ts_to, resolution)
+        cache = get_response_cache(self.config)
+        if cache is None or not window_closed(aligned_to, resolution, cache.delay):
+            return self._query(endpoint(urlencode(params)))
+        # Windows in the same periods of the resolution share the response.
+        params.update({"from": aligned_from, "to": aligned_to})
+        data = self._query_closed(endpoint(urlencode(params)), aligned_to, resolution)
+        first = ts_from if resolution == "raw" else aligned_from
+        return [r for r in data if first <= r["time"] < ts_to]
+
+    @classmethod
+    def choose_resolution(cls, *, ts_from: int, ts_to: int, max_points: int) -> str:
+        """Return the finest resolution of at most max_points readings between
+        ts_from and ts_to (s) the API allows for the time range."""
+        span = ts_to - ts_from
+        allowed = [r for r, s in cls.reading_resolutions.items() if s >= span]
+        for resolution in allowed:
+            if span / cls.reading_intervals[resolution] <= max_points:
+                return resolution
+        return allowed[-1]
+
+    def _stored(self, *, ts_from: int, ts_to: int) -> bool:
+        """Return True if the power data between ts_from and ts_to (s) is stored."""
+        coverage = read_coverage(self.config, f"power_{self.meter_id}")
+        if coverage.missing(ts_from, ts_to):
+            return False
+        # Recent data may still be in the journal of a poller.
+        flush_interval = int(
+            self.config.get("journal", {}).get("flush_interval", JOURNAL_FLUSH_INTERVAL)
+        )
+        if ts_to <= time.time() - flush_interval:
+            return True
+        cache = hot_cache.get_hot_cache(self.config, self.meter_id)
+        return cache is not None and cache.covers(
+            pd.Timestamp(ts_from, unit="s"), pd.Timestamp(ts_to, unit="s")
+        )
+
+    def readings_auto(
+        self,
+        *,
+        field_names: Optional[List[str]] = None,
+        ts_from: int,
+        ts_to: int,
+        max_points: int,
+    ) -> List[Dict]:
+        """Return the readings between ts_from and ts_to (s) at the finest
+        resolution of at most max_points readings, see choose_resolution.
+
+        The readings are rolled up from the stored power data if it covers the
+        time range. Otherwise they are fetched."""
+        ms_from, ms_to = self.gen_ms_timestamp(ts_from), self.gen_ms_timestamp(ts_to)
+        s_from, s_to = ms_from // 1000, ms_to // 1000
+        resolution = self.choose_resolution(
+            ts_from=s_from, ts_to=s_to, max_points=max_points
+        )
+        if self._stored(ts_from=s_from, ts_to=s_to):
+            log.debug(f"Rolling up the stored readings of {self} to {resolution}.")
+            return LocalStatistics(config=self.config, meter_id=self.meter_id).readings(
+                field_names=field_names,
+                ts_from=s_from,
+                ts_to=s_to,
+                resolution=resolution,
+            )
+        return self.readings(
+            field_names=field_names,
+            ts_from=ms_from,
+            ts_to=ms_to,
+            resolution=resolution,
+        )
 
     def statistics(
         self,
@@ -291,9 +439,9 @@ class DiscovergyMeter(DiscovergyAPIClient):
         if field_names and self._validate_field_names(field_names=field_names):
             params["fields"] = ",".join(field_names)
         if ts_to:
-            ts_to = self.gen_ms_timestamp(time.time())
+            ts_to = self.gen_ms_timestamp(ts_to)
             self._validate_timestamps(ts_from=ts_from, ts_to=ts_to)
-            params["to"] = self.gen_ms_timestamp(ts_to)
+            params["to"] = ts_to
         else:
             now = time.time()
             log.debug(
@@ -303,34 +451,26 @@ class DiscovergyMeter(DiscovergyAPIClient):
             ts_to = self.gen_ms_timestamp(now)
         params["to"] = ts_to
 
-        return self._query(endpoint(urlencode(params)))
+        return self._query_closed(endpoint(urlencode(params)), ts_to)
 
 
-def get_new_api_session(config: Box):
-    """Return an authenticated session to the Discovergy API."""
-    if "oauth_token" in config:
-        token = config["oauth_token"]
-    else:
-        get_oauth1_token(config)
-        token = config["oauth_token"]
-
-    # Construct OAuth session with access token
-    discovergy_oauth_session = OAuth1Session(
-        token["key"],
-        client_secret=token["client_secret"],
-        token=token["token"],
-        token_secret=token["token_secret"],
-    )
+def get_api_auth(config: Box, stale: Optional[Dict] = None) -> OAuth1Auth:
+    """Return the auth signing the requests to the Discovergy API.
 
-    return discovergy_oauth_session
+    :param stale: the token rejected by the API, see auth.get_oauth1_token"""
+    return OAuth1Auth(get_oauth1_token(config, stale=stale))
 
 
 def describe_meters(config: Box) -> dict:
     """Describe and return all the meters for the given account."""
+    stale = None
+    rate_limiter = get_rate_limiter(config)
     for cycle in range(2):
-        session = get_new_api_session(config)
+        auth = get_api_auth(config, stale=stale)
+        if rate_limiter is not None:
+            rate_limiter.acquire()
         try:
-            request = session.get(urljoin(API_HOST, f"{API_URL}/meters"))
+            request = transport.get(urljoin(API_HOST, f"{API_URL}/meters"), auth=auth)
         except Exception as e:
             log.warning(f"Caught an exception while describing all meters: {e}")
             raise
@@ -338,13 +478,12 @@ def describe_meters(config: Box) -> dict:
             break
         elif request.status_code == 401:
             log.debug("Need to update the OAuth token.")
-            config.pop("oauth_token")
+            stale = config.pop("oauth_token", None)
         else:
             log.warning(
                 f"Got HTTP status code {request.status_code} while describing the meters. "
-                "Will re-try with a new OAuth token."
+                "Will re-try."
             )
-            config.pop("oauth_token")
     else:
         log.error(
             f"Could not describe the meters. HTTP status code: {request.status_code}"
@@ -362,41 +501,47 @@ def describe_meters(config: Box) -> dict:
 
 
 def save_meters(*, config: Box, meters: Dict) -> None:
-    """Store the meters metadata in the config directory"""
+    """Store the meters metadata in the config directory
+
+    Poller workers save the meters concurrently. The metadata is merged with
+    the saved one under a lock and replaced atomically."""
     # meter_ids = glom(meters, ["meterId"])
     file_path = config.config_file_path.parent / Path("meters-metadata.json")
-    to_save = meters
+    to_save = dict(meters)
     missing = []
-    try:
-        with file_path.open() as fh:
-            old_metadata = json.load(fh)
-    except FileNotFoundError:
-        log.debug(f"Did not find existing {file_path}.")
-        old_metadata = None
-    except json.decoder.JSONDecodeError:
-        log.debug(
-            f"Could not JSON decode the content of {file_path}. Will overwrite that file."
-        )
-        old_metadata = None
-    else:
-        # Let's check what has changed.
-        for old_meter_id, old_meter in old_metadata.items():
-            if old_meter_id in meters:
-                if old_meter != meters[old_meter_id]:
-                    log.debug(f"Updating the metadata on disk for {old_meter_id}.")
-            else:
-                # keep old meters
-                missing.append(old_meter_id)
-                to_save[old_meter_id] = old_meter
-        if missing:
-            log.warning(
-                "Previously described the meters{}: {}".format(
-                    ["s", ""][len(missing) < 1], ", ".join(missing)
-                )
+    with file_lock(file_path.with_suffix(".lock")):
+        try:
+            with file_path.open() as fh:
+                old_metadata = json.load(fh)
+        except FileNotFoundError:
+            log.debug(f"Did not find existing {file_path}.")
+            old_metadata = None
+        except json.decoder.JSONDecodeError:
+            log.debug(
+                f"Could not JSON decode the content of {file_path}. Will overwrite that file."
             )
-    try:
-        with file_path.open("w") as fh:
-            json.dump(to_save, fh)
-    except FileNotFoundError:
-        log.error(f"Could not save meters metadata to {file_path}.")
-        raise
+            old_metadata = None
+        else:
+            # Let's check what has changed.
+            for old_meter_id, old_meter in old_metadata.items():
+                if old_meter_id in meters:
+                    if old_meter != meters[old_meter_id]:
+                        log.debug(f"Updating the metadata on disk for {old_meter_id}.")
+                else:
+                    # keep old meters
+                    missing.append(old_meter_id)
+                    to_save[old_meter_id] = old_meter
+            if missing:
+                log.warning(
+                    "Previously described the meters{}: {}".format(
+                        ["s", ""][len(missing) < 1], ", ".join(missing)
+                    )
+                )
+        tmp_path = file_path.with_suffix(".tmp")
+        try:
+            with tmp_path.open("w") as fh:
+                json.dump(to_save, fh)
+        except FileNotFoundError:
+            log.error(f"Could not save meters metadata to {file_path}.")
+            raise
+        os.replace(tmp_path, file_path)
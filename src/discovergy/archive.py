@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Discovergy raw data archive
+
+Raw records, e. g. the readings as returned by the Discovergy API, are archived
+as newline delimited JSON, one record per line. The files are compressed with
+zstd if zstandard is installed, gzip otherwise. Both formats allow to append
+by adding another frame or member, so records are written as they arrive and
+read back one at a time without holding the file in memory.
+
+ArchiveWriter rotates the files daily by the time of the records:
+<directory>/<name>_YYYY-MM-DD.ndjson.zst
+
+The poller archives the raw readings to <data_dir>/raw/ if raw is set in the
+[archive] section. The import reads them back, see importer.
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import gzip
+import io
+import json
+
+from collections import defaultdict
+from pathlib import Path
+from typing import IO, Any, Dict, Iterable, Iterator, List, Optional, Tuple, Type
+
+import pandas as pd  # type: ignore
+
+from box import Box  # type: ignore
+from loguru import logger as log
+
+try:
+    import zstandard  # type: ignore
+except ImportError:
+    zstandard = None
+
+
+SUFFIXES = {"zstd": ".ndjson.zst", "gzip": ".ndjson.gz", "none": ".ndjson"}
+# Raised by the decompressors if a file ends within a frame or member
+TRUNCATED_ERRORS: Tuple[Type[Exception], ...] = (EOFError,)
+if zstandard is not None:
+    TRUNCATED_ERRORS += (zstandard.ZstdError,)
+
+
+def default_codec() -> str:
+    """Return zstd if zstandard is installed, gzip otherwise."""
+    return "zstd" if zstandard is not None else "gzip"
+
+
+def open_archive(file_path: Path, mode: str = "rb") -> IO[bytes]:
+    """Open the archive file in binary mode. The codec is chosen by the suffix.
+
+    :param mode: rb, wb or ab
+    """
+    if file_path.suffix == ".zst":
+        if zstandard is None:
+            raise RuntimeError(f"Reading or writing {file_path} requires zstandard.")
+        fh = file_path.open(mode)
+        if mode == "rb":
+            # Appended files hold one frame per append.
+            reader = zstandard.ZstdDecompressor().stream_reader(
+                fh, read_across_frames=True, closefd=True
+            )
+            return io.BufferedReader(reader)  # type: ignore
+        return zstandard.ZstdCompressor().stream_writer(fh, closefd=True)
+    if file_path.suffix == ".gz":
+        return gzip.open(file_path.as_posix(), mode)  # type: ignore
+    return file_path.open(mode)
+
+
+def append_records(file_path: Path, records: Iterable[Any]) -> int:
+    """Append the records to the archive file. Return the number written.
+
+    Each call adds a complete frame, records written before are never rewritten."""
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    n = 0
+    with open_archive(file_path, "ab") as fh:
+        for record in records:
+            fh.write(json.dumps(record, separators=(",", ":")).encode("utf-8"))
+            fh.write(b"\n")
+            n += 1
+    return n
+
+
+def read_records(file_path: Path) -> Iterator[Any]:
+    """Yield the records of the archive file one at a time.
+
+    A torn last line, e. g. after a crash, is skipped. So is a truncated last
+    frame or member, the records read before it are kept. Files holding a
+    single JSON array, as written by former versions, are read at once."""
+    with open_archive(file_path, "rb") as fh:
+        for line in _lines(file_path, fh):
+            if line == b"\n":
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                log.warning(f"Skipping a corrupt record in {file_path}.")
+                continue
+            # A legacy file is one line holding the array of all records.
+            if isinstance(record, list):
+                yield from record
+            else:
+                yield record
+
+
+def _lines(file_path: Path, fh: IO[bytes]) -> Iterator[bytes]:
+    try:
+        yield from fh
+    except TRUNCATED_ERRORS as e:
+        log.warning(f"Skipping the truncated end of {file_path}: {e}")
+
+
+class ArchiveWriter:
+    """Append records to daily rotated archive files."""
+
+    def __init__(
+        self,
+        *,
+        directory: Path,
+        name: str,
+        codec: Optional[str] = None,
+        time_field: str = "time",
+        time_unit: str = "ms",
+    ):
+        """:param codec: zstd, gzip or none. Defaults to default_codec.
+        :param time_field: the field of the records holding their time
+        :param time_unit: the unit of the time, e. g. ms or s"""
+        self.directory = directory
+        self.name = name
+        self.codec = codec or default_codec()
+        if self.codec not in SUFFIXES:
+            raise ValueError(
+                f"The codec {self.codec} is not one of {', '.join(SUFFIXES)}."
+            )
+        if self.codec == "zstd" and zstandard is None:
+            log.warning("zstandard is not installed. Archiving gzip-ed.")
+            self.codec = "gzip"
+        self.time_field = time_field
+        self.time_unit = time_unit
+
+    def __repr__(self):
+        return f"ArchiveWriter:{self.name}"
+
+    def file_path(self, day: pd.Timestamp) -> Path:
+        """Return the archive file of the day."""
+        return self.directory / f"{self.name}_{day:%Y-%m-%d}{SUFFIXES[self.codec]}"
+
+    def write(self, records: List[Dict]) -> int:
+        """Append the records to the files of their days. Return the number written."""
+        if not records:
+            return 0
+        times = pd.to_datetime(
+            [r.get(self.time_field) for r in records], unit=self.time_unit
+        )
+        now = pd.Timestamp.utcnow().tz_convert(None)
+        days: Dict[pd.Timestamp, List[Dict]] = defaultdict(list)
+        for record, ts in zip(records, times):
+            # Records without a time go to the archive of today.
+            days[(now if pd.isna(ts) else ts).normalize()].append(record)
+        return sum(
+            append_records(self.file_path(day), day_records)
+            for day, day_records in sorted(days.items())
+        )
+
+
+def raw_archive_writer(config: Box, name: str) -> Optional[ArchiveWriter]:
+    """Return the writer of the raw archive name. None if archiving is disabled."""
+    archive_config = config.get("archive", {})
+    if str(archive_config.get("raw", "false")).lower() != "true":
+        return None
+    return ArchiveWriter(
+        directory=Path(config.file_location.data_dir).expanduser() / "raw",
+        name=name,
+        codec=str(archive_config.get("codec", "")).lower() or None,
+    )
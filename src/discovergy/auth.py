@@ -4,7 +4,8 @@
 
 Discovergy API authentication module
 
-Discovergy uses OAuth1. We use authlib.org to get auth tokens.
+Discovergy uses OAuth1. We use authlib.org to get auth tokens and to sign the
+API requests sent via transport.
 
 See https://docs.authlib.org/en/latest/client/oauth1.html#oauth-1-session and
 https://api.discovergy.com/docs/
@@ -13,19 +14,26 @@ __author__ = "Frank Becker <fb@alien8.de>"
 __copyright__ = "Frank Becker"
 __license__ = "mit"
 
+import json
+import os
+
+from pathlib import Path
 from urllib.parse import urljoin, parse_qs
-from typing import Any, Dict, List, NamedTuple, Union
+from typing import Any, Dict, Generator, List, NamedTuple, Optional, Union
 
 import httpx
 
+from authlib.oauth1 import ClientAuth  # type: ignore
 from box import Box  # type: ignore
 from loguru import logger as log
 from tenacity import retry, stop_after_attempt, stop_after_delay, wait_exponential  # type: ignore
 from authlib.integrations.requests_client import OAuth1Session  # type: ignore
 
+from . import transport
+from .cluster import account_key, cluster_path
 from .config import config_updater_factory, write_config_updater
 from .defaults import API_URL, APP_NAME, API_HOST
-from .utils import before_log
+from .utils import before_log, file_lock
 
 
 class OAuth1Token(NamedTuple):
@@ -35,6 +43,32 @@ class OAuth1Token(NamedTuple):
     token_secret: str
 
 
+class OAuth1Auth(httpx.Auth):
+    """Sign httpx requests with the OAuth1 token."""
+
+    def __init__(self, token: OAuth1Token):
+        self.token = token
+        self.client_auth = ClientAuth(
+            token.key,
+            client_secret=token.client_secret,
+            token=token.token,
+            token_secret=token.token_secret,
+        )
+
+    def __repr__(self):
+        return f"OAuth1Auth:{self.token.key}"
+
+    def auth_flow(
+        self, request: httpx.Request
+    ) -> Generator[httpx.Request, httpx.Response, None]:
+        # The API is only queried with GET, there is no body to sign.
+        _, headers, _ = self.client_auth.prepare(
+            request.method, str(request.url), dict(request.headers), b""
+        )
+        request.headers["Authorization"] = headers["Authorization"]
+        yield request
+
+
 @retry(
     before=before_log(log, "debug"),
     stop=(stop_after_delay(10) | stop_after_attempt(5)),
@@ -48,7 +82,7 @@ def get_consumer_token(config: Box) -> Union[Dict[Any, Any], List[Any]]:
     timeout = 10
 
     try:
-        consumer_response = httpx.post(
+        consumer_response = transport.post(
             consumer_token_url, data={"client": APP_NAME}, timeout=timeout
         )
     except Exception as e:
@@ -85,7 +119,7 @@ def get_oath_verifier(config: Box, client: OAuth1Session) -> str:
         authorize_url, email=discovergy_email, password=discovergy_password
     )
     try:
-        verifier_response = httpx.get(authorize_url)
+        verifier_response = transport.get(authorize_url)
     except Exception as e:
         log.warning(f"Caught exception while GETing the authorize URL: {e}")
         raise
@@ -144,11 +178,51 @@ def fetch_new_oauth1_token(config: Box, save: bool = True) -> OAuth1Token:
     return token
 
 
-def get_oauth1_token(config: Box, save: bool = True) -> OAuth1Token:
+def shared_token_path(config: Box) -> Path:
+    """Return the path of the token shared by the poller workers of the account."""
+    return cluster_path(config) / f"oauth_token_{account_key(config)}.json"
+
+
+def read_shared_token(config: Box) -> Optional[OAuth1Token]:
+    """Return the token shared by the poller workers. None if there is none."""
+    try:
+        with shared_token_path(config).open() as fh:
+            return OAuth1Token(**json.load(fh))
+    except (FileNotFoundError, json.JSONDecodeError, TypeError):
+        return None
+
+
+def write_shared_token(config: Box, token: OAuth1Token) -> None:
+    """Share the token with the other poller workers of the account."""
+    file_path = shared_token_path(config)
+    tmp_path = file_path.with_suffix(".tmp")
+    with os.fdopen(
+        os.open(tmp_path.as_posix(), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600),
+        "w",
+    ) as fh:
+        json.dump(token._asdict(), fh)
+    os.replace(tmp_path, file_path)
+
+
+def get_oauth1_token(
+    config: Box, save: bool = True, stale: Optional[Dict] = None
+) -> OAuth1Token:
     """Return a OAuth1Token from the config or fetch a new one if it is
     not in the config dict.
+
+    Poller workers share their token. Only one of them fetches a new one while
+    the others wait for it.
+
+    :param stale: the token that was rejected by the API. Never returned.
     """
-    if "oauth_token" in config:
+    if "oauth_token" in config and config["oauth_token"] != stale:
         return OAuth1Token(**config["oauth_token"])
-    else:
-        return fetch_new_oauth1_token(config, save=save)
+    with file_lock(shared_token_path(config).with_suffix(".lock")):
+        token = read_shared_token(config)
+        if token is not None and token._asdict() != stale:
+            log.debug("Using the OAuth token shared by the poller workers.")
+            config["oauth_token"] = token._asdict()
+            return token
+        token = fetch_new_oauth1_token(config, save=save)
+        write_shared_token(config, token)
+    return token
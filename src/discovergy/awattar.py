@@ -10,6 +10,7 @@ __author__ = "Frank Becker <fb@alien8.de>"
 __copyright__ = "Frank Becker"
 __license__ = "mit"
 
+from pathlib import Path
 from typing import Any, Dict, List, Optional, Union
 from urllib.parse import urlencode
 
@@ -22,6 +23,7 @@ from box import Box  # type: ignore
 from loguru import logger as log
 from tenacity import retry, stop_after_attempt, stop_after_delay, wait_exponential  # type: ignore
 
+from . import ledger, live
 from .utils import before_log, split_df_by_month, write_data_frames
 
 
@@ -32,11 +34,14 @@ async def get(*, config: Box) -> None:
         data = await get_data(config=config)
     except Exception as e:
         log.warning("Could not fetch Awattar data: {}.".format(str(e)))
+        return
     else:
         elapsed_time = arrow.utcnow() - start_ts
         log.debug(f"Fetching Awattar data took {elapsed_time.total_seconds():.3f} s.")
 
-    data_frames = split_df_by_month(df=raw_to_df(data=data))
+    df = raw_to_df(data=data)
+    live.publisher.publish(live.SourceUpdate(source="awattar", data=df))
+    data_frames = split_df_by_month(df=df)
     # for df in data_frames:
     #     # Check if there are changed values. This should not happen.
     #     joined = df.join(df_prev, how="outer", lsuffix="l", rsuffix="r")
@@ -45,6 +50,7 @@ async def get(*, config: Box) -> None:
     #         log.debug(f"{df}")
     #         log.debug(f"{df_prev}")
     write_data_frames(config=config, data_frames=data_frames, name="awattar")
+    ledger.add_prices(config=config, prices=df)
 
 
 @retry(
@@ -103,19 +109,11 @@ def compare(s1: pd.Series, s2: pd.Series) -> bool:
     return ((s1 == s2) | (np.isnan(s1) | np.isnan(s2))).all()
 
 
-def data_from_files():
-    """Read dumped raw data from files."""
+def data_from_files(data_dir: str = ".", config: Optional[Box] = None) -> None:
+    """Import dumped raw data from the files in data_dir. See importer."""
+    from . import importer
     from .config import read_config
-    import os
-    import json
-
-    config = read_config()
-    for f in os.listdir():
-        if f.startswith("awattar_20"):
-            print(f)
-            with open(f) as fh:
-                data = json.load(fh)
-            df = raw_to_df(data=data)
-            write_data_frames(
-                config=config, data_frames=split_df_by_month(df=df), name="awattar"
-            )
+
+    importer.import_files(
+        config=config or read_config(), source="awattar", data_dir=Path(data_dir)
+    )
@@ -5,7 +5,15 @@ Usage:
    {cmd} -h | --help | --version
 
 Commands:
-   poll       Poll data from the Discovergy endpoint
+   poll          Poll data from the Discovergy endpoint
+   plan          Find the cheapest start time for a consumption profile
+   load_profile  Fetch the load profiles of the meters
+   compact       Merge the small parquet files of the stored data
+   export        Export stored data as CSV, Parquet or Arrow IPC
+   import        Import raw data files in parallel
+   repair        Fetch the power data missing in the coverage index
+   devices       Detect the devices in the stored power data
+   supervise     Poll data in several worker processes
 
 Options:
    -h, --help
@@ -17,7 +25,18 @@ __license__ = "mit"
 
 import sys
 
-from discovergy import __version__, poller
+from discovergy import (
+    __version__,
+    compact,
+    devices,
+    export,
+    importer,
+    load_profile,
+    optimizer,
+    poller,
+    repair,
+    supervisor,
+)
 
 from docopt import docopt  # type: ignore
 
@@ -40,6 +59,14 @@ def main():
 
     dispatch = {
         "poll": poller.main,
+        "plan": optimizer.main,
+        "load_profile": load_profile.main,
+        "compact": compact.main,
+        "export": export.main,
+        "import": importer.main,
+        "repair": repair.main,
+        "devices": devices.main,
+        "supervise": supervisor.main,
     }
 
     arguments = docopt(
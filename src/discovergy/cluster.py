@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Discovergy poller cluster
+
+Poller workers share the data directory, possibly across hosts. Each worker
+writes a heartbeat file to <data_dir>/cluster/members/. The live workers form a
+consistent hash ring. A meter, or a singleton source like awattar, is polled by
+the worker owning its key on the ring. If a worker stops beating, only its keys
+move to the other workers.
+
+The workers of an account share one request rate limit, a token bucket kept in
+<data_dir>/cluster/.
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import bisect
+import hashlib
+import json
+import os
+import time
+
+from pathlib import Path
+from typing import Dict, FrozenSet, Iterable, List, Optional, Tuple
+
+from box import Box  # type: ignore
+from loguru import logger as log
+
+from .defaults import (
+    CLUSTER_HEARTBEAT_TIMEOUT,
+    CLUSTER_RING_REPLICAS,
+    DISCOVERGY_RATE_LIMIT,
+)
+from .utils import file_lock
+
+
+_rate_limiters: Dict[str, "RateLimiter"] = {}
+
+
+def cluster_path(config: Box) -> Path:
+    """Return the directory of the shared cluster state."""
+    return Path(config.file_location.data_dir).expanduser() / "cluster"
+
+
+def account_key(config: Box) -> str:
+    """Return a file name safe key of the Discovergy account of the config."""
+    email = config.discovergy_account.email.lower().encode()
+    return hashlib.sha1(email).hexdigest()[:16]
+
+
+def _hash(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Represents a consistent hash ring of worker ids.
+
+    Each worker is placed replicas times on the ring to spread the keys evenly.
+    """
+
+    def __init__(self, members: Iterable[str], replicas: int = CLUSTER_RING_REPLICAS):
+        self.members: FrozenSet[str] = frozenset(members)
+        points: List[Tuple[int, str]] = sorted(
+            (_hash(f"{member}#{i}"), member)
+            for member in self.members
+            for i in range(replicas)
+        )
+        self._hashes = [h for h, _ in points]
+        self._owners = [m for _, m in points]
+
+    def __repr__(self):
+        return f"HashRing:{','.join(sorted(self.members))}"
+
+    def owner(self, key: str) -> Optional[str]:
+        """Return the worker id owning the key. None if the ring is empty."""
+        if not self._hashes:
+            return None
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._owners[i]
+
+
+class Membership:
+    """Heartbeat of a worker and view of all live workers."""
+
+    def __init__(
+        self,
+        *,
+        config: Box,
+        worker_id: str,
+        timeout: float = CLUSTER_HEARTBEAT_TIMEOUT,
+    ):
+        self.worker_id = worker_id
+        self.timeout = timeout
+        self.path = cluster_path(config) / "members"
+        self.path.mkdir(parents=True, exist_ok=True)
+
+    def __repr__(self):
+        return f"Membership:{self.worker_id}"
+
+    def beat(self) -> None:
+        """Announce that the worker is alive."""
+        file_path = self.path / self.worker_id
+        tmp_path = self.path / f".{self.worker_id}.tmp"
+        with tmp_path.open("w") as fh:
+            json.dump({"pid": os.getpid(), "timestamp": time.time()}, fh)
+        os.replace(tmp_path, file_path)
+
+    def leave(self) -> None:
+        """Remove the worker from the cluster, e. g. on a clean shutdown."""
+        try:
+            (self.path / self.worker_id).unlink()
+        except FileNotFoundError:
+            pass
+
+    def live(self) -> FrozenSet[str]:
+        """Return the ids of the workers that did beat within the timeout."""
+        return _live(self.path, self.timeout)
+
+    def ring(self) -> HashRing:
+        """Return the hash ring of the live workers including this one."""
+        return HashRing(self.live() | {self.worker_id})
+
+
+def _live(path: Path, timeout: float) -> FrozenSet[str]:
+    now = time.time()
+    members = set()
+    for file_path in path.iterdir():
+        if file_path.name.startswith("."):
+            continue
+        try:
+            if now - file_path.stat().st_mtime < timeout:
+                members.add(file_path.name)
+        except FileNotFoundError:
+            continue
+    return frozenset(members)
+
+
+def live_workers(
+    config: Box, timeout: float = CLUSTER_HEARTBEAT_TIMEOUT
+) -> FrozenSet[str]:
+    """Return the ids of the workers of the data directory that did beat
+    within the timeout. Unlike Membership, it doesn't join the cluster."""
+    path = cluster_path(config) / "members"
+    if not path.is_dir():
+        return frozenset()
+    return _live(path, timeout)
+
+
+def owns(config: Box, key: str, account: bool = True) -> bool:
+    """Return True if this poller worker polls key. Always True if not sharded.
+
+    :param account: key belongs to the account of the config, e. g. a meter id.
+        Otherwise, it is global, e. g. awattar, and owned by the first config of
+        the worker only.
+    """
+    if "shard" not in config:
+        return True
+    if account:
+        key = f"{account_key(config)}/{key}"
+    elif not config.shard.primary:
+        return False
+    return HashRing(config.shard.members).owner(key) == config.shard.worker_id
+
+
+class RateLimiter:
+    """Token bucket shared by all processes using the same state file."""
+
+    def __init__(self, *, path: Path, rate: float, burst: Optional[float] = None):
+        """:param rate: requests per second
+        :param burst: max. requests at once, defaults to rate"""
+        self.path = path
+        self.rate = rate
+        self.burst = burst or max(1.0, rate)
+
+    def __repr__(self):
+        return f"RateLimiter:{self.path.stem}:{self.rate}/s"
+
+    def _take(self) -> float:
+        """Take a token if one is available. Return the seconds to wait otherwise."""
+        with file_lock(self.path.with_suffix(".lock")):
+            now = time.time()
+            try:
+                with self.path.open() as fh:
+                    state = json.load(fh)
+            except (FileNotFoundError, json.JSONDecodeError):
+                state = {"tokens": self.burst, "timestamp": now}
+            elapsed = max(0.0, now - state["timestamp"])
+            tokens = min(self.burst, state["tokens"] + elapsed * self.rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            tmp_path = self.path.with_suffix(".tmp")
+            with tmp_path.open("w") as fh:
+                json.dump({"tokens": tokens, "timestamp": now}, fh)
+            os.replace(tmp_path, self.path)
+        return wait
+
+    def acquire(self) -> None:
+        """Block until a request may be sent."""
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            log.debug(f"{self} is exhausted. Waiting {wait:.2f} s.")
+            time.sleep(wait)
+
+
+def get_rate_limiter(config: Box) -> Optional[RateLimiter]:
+    """Return the rate limiter of the account. None if rate_limit is 0."""
+    rate = float(
+        config.discovergy_account.get("rate_limit", DISCOVERGY_RATE_LIMIT) or 0
+    )
+    if rate <= 0:
+        return None
+    path = cluster_path(config) / f"rate_limit_{account_key(config)}.json"
+    key = path.as_posix()
+    if key not in _rate_limiters:
+        _rate_limiters[key] = RateLimiter(path=path, rate=rate)
+    return _rate_limiters[key]
@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""Compact the Pystore collections
+
+Usage:
+   {cmd} compact [--collection=<name>...] [--min-files=<n>]
+   {cmd} compact -h | --help
+
+Options:
+   --collection=<name>    Only compact the given collections, e. g. power_<meter_id>.
+                          Defaults to all.
+   --min-files=<n>        Only compact months stored in at least that many parquet files.
+   -h, --help
+
+Every append leaves another small parquet file in the monthly item. The
+compaction rewrites an item as one parquet file. Its row groups hold whole days
+of at least COMPACT_ROW_GROUP_ROWS rows so their min/max statistics allow to
+skip days. The new item is swapped in under the collection lock, readers see
+either the old or the new item.
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import os
+import re
+import shutil
+import sys
+
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import pyarrow.parquet as pq  # type: ignore
+
+from box import Box  # type: ignore
+from docopt import docopt  # type: ignore
+from loguru import logger as log
+
+from .defaults import COMPACT_MIN_FILES, COMPACT_ROW_GROUP_ROWS
+from .utils import (
+    collection_lock,
+    parquet_part_files,
+    read_parquet_files,
+    write_parquet_file,
+)
+
+
+ITEM_NAME = re.compile(r"^\d{4}-\d{2}$")
+
+# (file name, mtime, size) of each file of an item
+ItemSnapshot = Tuple[Tuple[str, int, int], ...]
+
+
+def store_path(config: Box) -> Path:
+    """Return the path of the Pystore store."""
+    return Path(config.file_location.data_dir).expanduser() / "discovergy"
+
+
+def work_path(config: Box, name: str) -> Path:
+    """Return the directory of the items being compacted. Same file system as the store."""
+    return store_path(config) / ".compact" / name
+
+
+def item_snapshot(item_path: Path) -> ItemSnapshot:
+    """Return a key that changes whenever the item is written."""
+    snapshot = []
+    for file_path in sorted(item_path.iterdir()):
+        stat = file_path.stat()
+        snapshot.append((file_path.name, stat.st_mtime_ns, stat.st_size))
+    return tuple(snapshot)
+
+
+def recover(config: Box, name: str) -> None:
+    """Finish or roll back a swap interrupted by a crash."""
+    path = work_path(config, name)
+    if not path.is_dir():
+        return
+    with collection_lock(config, name):
+        for old_path in path.glob("*.old"):
+            item_path = store_path(config) / name / old_path.stem
+            new_path = path / old_path.stem
+            if not item_path.exists():
+                source = new_path if new_path.is_dir() else old_path
+                log.warning(f"Recovering {item_path} from {source}.")
+                os.rename(source, item_path)
+            if old_path.exists():
+                shutil.rmtree(old_path)
+
+
+def compact_item(
+    *,
+    config: Box,
+    name: str,
+    item_name: str,
+    min_files: int = COMPACT_MIN_FILES,
+    row_group_rows: int = COMPACT_ROW_GROUP_ROWS,
+) -> bool:
+    """Rewrite the item of the collection name as one file. Return True if it was.
+
+    Appends while the compacted file is written make the swap abort. The item
+    is compacted the next time."""
+    item_path = store_path(config) / name / item_name
+    new_path = work_path(config, name) / item_name
+    old_path = work_path(config, name) / f"{item_name}.old"
+    # Writers wait while the item is read. Readers don't.
+    with collection_lock(config, name, shared=True):
+        files = parquet_part_files(item_path)
+        if len(files) < max(1, min_files):
+            return False
+        before = item_snapshot(item_path)
+        index_name = pq.read_schema(files[-1].as_posix()).pandas_metadata[
+            "index_columns"
+        ][0]
+        df = read_parquet_files(files)
+    # Like Pystore, drop rows that are duplicates in all columns. The last wins.
+    df = df[~df.reset_index().duplicated(keep="last").to_numpy()]
+    df = df.sort_index(kind="mergesort").rename_axis(index_name)
+    if new_path.exists():
+        shutil.rmtree(new_path)
+    new_path.mkdir(parents=True)
+    write_parquet_file(df, new_path / "part.0.parquet", row_group_rows=row_group_rows)
+    metadata_path = item_path / "pystore_metadata.json"
+    if metadata_path.exists():
+        shutil.copy2(metadata_path, new_path)
+    with collection_lock(config, name):
+        if item_snapshot(item_path) != before:
+            log.info(f"{name}/{item_name} changed while compacting it. Skipping it.")
+            shutil.rmtree(new_path)
+            return False
+        os.rename(item_path, old_path)
+        os.rename(new_path, item_path)
+    shutil.rmtree(old_path)
+    log.info(f"Compacted {len(files)} files of {name}/{item_name} ({len(df)} rows).")
+    return True
+
+
+def compact(
+    *,
+    config: Box,
+    names: Optional[List[str]] = None,
+    min_files: int = COMPACT_MIN_FILES,
+) -> int:
+    """Compact the items of the collections. Defaults to all. Return the number compacted."""
+    path = store_path(config)
+    if not path.is_dir():
+        return 0
+    if not names:
+        names = sorted(
+            p.name for p in path.iterdir() if p.is_dir() and not p.name.startswith(".")
+        )
+    compacted = 0
+    for name in names:
+        collection_path = path / name
+        if not collection_path.is_dir():
+            log.warning(f"There is no collection {name}.")
+            continue
+        recover(config, name)
+        for item_path in sorted(collection_path.iterdir()):
+            if not ITEM_NAME.match(item_path.name):
+                continue
+            try:
+                compacted += compact_item(
+                    config=config,
+                    name=name,
+                    item_name=item_path.name,
+                    min_files=min_files,
+                )
+            except Exception as e:
+                log.warning(f"Could not compact {name}/{item_path.name}: {e}")
+    return compacted
+
+
+def main(config: Box) -> None:
+    """Entry point for the compact sub command."""
+    arguments = docopt(__doc__.format(cmd=sys.argv[0]), argv=sys.argv[1:])
+    try:
+        min_files = int(arguments["--min-files"] or COMPACT_MIN_FILES)
+    except ValueError:
+        log.error(f"The number of files {arguments['--min-files']} is not a number.")
+        sys.exit(1)
+    compacted = compact(
+        config=config, names=arguments["--collection"], min_files=min_files
+    )
+    print(f"Compacted {compacted} months.")
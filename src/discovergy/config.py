@@ -145,19 +145,74 @@ def verify_config(config: Box) -> bool:
                 "save_password": schema.And(
                     schema.Use(str.lower), lambda x: x in ("true", "false")
                 ),
+                schema.Optional("rate_limit"): schema.Use(float),
             },
             "file_location": {"data_dir": str, "log_dir": str,},
-            "poll": {"default": schema.Use(int), "try_sleep": schema.Use(int),},
-            schema.Optional("open_weather_map"): {"id": str},
-            schema.Optional("oauth1_token"): {
+            # The poll intervals in seconds, see DEFAULT_CONFIG
+            "poll": {
+                schema.Optional("default"): schema.Use(int),
+                schema.Optional("try_sleep"): schema.Use(int),
+                schema.Optional("discovergy"): schema.Use(int),
+                schema.Optional("disaggregation"): schema.Use(int),
+                schema.Optional("load_profile"): schema.Use(int),
+                schema.Optional("weather"): schema.Use(int),
+                schema.Optional("awattar"): schema.Use(int),
+                schema.Optional("live"): schema.Use(float),
+                schema.Optional("compact"): schema.Use(float),
+            },
+            schema.Optional("open_weather_map"): {
+                "id": str,
+                schema.Optional("latitude"): str,
+                schema.Optional("longitude"): str,
+                schema.Optional("locations"): str,
+                schema.Optional("flush_size"): schema.Use(int),
+                schema.Optional("flush_interval"): schema.Use(int),
+            },
+            schema.Optional("oauth_token"): {
                 "key": str,
                 "client_secret": str,
                 "token": str,
                 "token_secret": str,
             },
+            schema.Optional("hot_cache"): {
+                schema.Optional("window"): schema.Use(int),
+            },
+            schema.Optional("response_cache"): {
+                schema.Optional("size"): schema.Use(int),
+                schema.Optional("memory_size"): schema.Use(int),
+                schema.Optional("delay"): schema.Use(int),
+            },
+            schema.Optional("anomaly"): {
+                schema.Optional("threshold"): schema.Use(float),
+                schema.Optional("duration"): schema.Use(int),
+                schema.Optional("half_life"): schema.Use(float),
+                schema.Optional("warmup"): schema.Use(float),
+            },
+            schema.Optional("archive"): {
+                schema.Optional("raw"): schema.And(
+                    schema.Use(str.lower), lambda x: x in ("true", "false")
+                ),
+                schema.Optional("codec"): schema.And(
+                    schema.Use(str.lower), lambda x: x in ("zstd", "gzip", "none")
+                ),
+            },
+            schema.Optional("journal"): {
+                schema.Optional("flush_rows"): schema.Use(int),
+                schema.Optional("flush_interval"): schema.Use(int),
+            },
             # meters stores the meters to read if configured. Otherwise, read all. The key is a nice name,
             # value is the meter id.
             schema.Optional("meters"): {str: str},
+            # fields lists the fields to fetch and store per meter id, e. g. power, energy
+            schema.Optional("fields"): {str: str},
+            # Set per poller worker by the supervisor and saved with a new token
+            schema.Optional("shard"): dict,
+            # One section per rule, see rules
+            schema.Optional(schema.Regex(r"^rule_.+")): {
+                "condition": str,
+                "action": str,
+                schema.Optional("debounce"): schema.Use(float),
+            },
         }
     )
     try:
@@ -206,6 +261,9 @@ def read_config(path: Optional[Path] = None) -> Box:
             sys.exit(1)
 
     config = Box(config_updater.to_dict(), box_dots=True)
+    if not verify_config(config):
+        log.error(f"The config {path} is not valid. Fix it and try again.")
+        sys.exit(1)
     config["config_file_path"] = path
 
     # Strip off quotes that made it into the config.ini file
@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Discovergy coverage index
+
+Record which time ranges of each Pystore collection, i. e. per meter and source,
+were fetched successfully. The index of a collection is a sorted list of
+disjoint intervals [start, end) in seconds since the epoch, kept in
+<data_dir>/coverage/<name>.json. Adjacent and overlapping ranges are merged, so
+a meter polled without holes is a single interval.
+
+The fetch functions add the requested range once the data is journaled. The
+repair command fetches the missing ranges, see repair.
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import bisect
+import json
+import os
+
+from pathlib import Path
+from typing import Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np  # type: ignore
+import pandas as pd  # type: ignore
+
+from box import Box  # type: ignore
+from loguru import logger as log
+
+from .utils import (
+    collection_lock,
+    file_lock,
+    naive_utc,
+    parquet_part_files,
+    read_pystore_index,
+)
+
+
+Interval = Tuple[int, int]
+
+
+def to_seconds(timestamp: pd.Timestamp) -> int:
+    """Return the timestamp as seconds since the epoch. Naive timestamps are UTC."""
+    return int(naive_utc(timestamp).value // 10**9)
+
+
+class Coverage:
+    """Represents the disjoint, sorted intervals [start, end) covered."""
+
+    def __init__(self, intervals: Iterable[Interval] = ()):
+        self.intervals: List[Interval] = []
+        for start, end in sorted(intervals):
+            self.add(start, end)
+
+    def __repr__(self):
+        return f"Coverage:{len(self.intervals)} intervals"
+
+    def add(self, start: int, end: int) -> None:
+        """Add the interval [start, end). Merge it with the ones it touches."""
+        if start >= end:
+            return
+        starts = [s for s, _ in self.intervals]
+        # The first interval ending at or after start and the ones starting up to end
+        i = bisect.bisect_left([e for _, e in self.intervals], start)
+        j = bisect.bisect_right(starts, end)
+        if i < j:
+            start = min(start, self.intervals[i][0])
+            end = max(end, self.intervals[j - 1][1])
+        self.intervals[i:j] = [(start, end)]
+
+    def missing(self, start: int, end: int) -> List[Interval]:
+        """Return the intervals in [start, end) that are not covered."""
+        gaps = []
+        for covered_start, covered_end in self.intervals:
+            if covered_end <= start:
+                continue
+            if covered_start >= end:
+                break
+            if covered_start > start:
+                gaps.append((start, covered_start))
+            start = max(start, covered_end)
+        if start < end:
+            gaps.append((start, end))
+        return gaps
+
+    @property
+    def start(self) -> Optional[int]:
+        return self.intervals[0][0] if self.intervals else None
+
+    @property
+    def end(self) -> Optional[int]:
+        return self.intervals[-1][1] if self.intervals else None
+
+
+def coverage_path(config: Box, name: str) -> Path:
+    """Return the path of the coverage index of the collection name."""
+    return (
+        Path(config.file_location.data_dir).expanduser() / "coverage" / f"{name}.json"
+    )
+
+
+def read_coverage(config: Box, name: str) -> Coverage:
+    """Return the coverage index of the collection name."""
+    try:
+        with coverage_path(config, name).open() as fh:
+            return Coverage(tuple(e) for e in json.load(fh))
+    except FileNotFoundError:
+        return Coverage()
+
+
+def add_coverage(
+    *,
+    config: Box,
+    name: str,
+    date_from: pd.Timestamp,
+    date_to: pd.Timestamp,
+) -> None:
+    """Record that the data of name in [date_from, date_to) was fetched."""
+    add_intervals(
+        config=config,
+        name=name,
+        intervals=[(to_seconds(date_from), to_seconds(date_to))],
+    )
+
+
+def add_intervals(*, config: Box, name: str, intervals: Iterable[Interval]) -> None:
+    """Add the intervals to the coverage index of the collection name."""
+    file_path = coverage_path(config, name)
+    # Poller workers and the repair command update the file concurrently.
+    with file_lock(file_path.with_suffix(".lock")):
+        coverage = read_coverage(config, name)
+        for start, end in intervals:
+            coverage.add(start, end)
+        tmp_path = file_path.with_suffix(".tmp")
+        with tmp_path.open("w") as fh:
+            json.dump(coverage.intervals, fh)
+        os.replace(tmp_path, file_path)
+
+
+def stored_intervals(config: Box, name: str, max_gap: int) -> Iterator[Interval]:
+    """Yield the intervals of the data stored in the Pystore collection name.
+
+    Rows further apart than max_gap seconds start a new interval."""
+    collection_path = (
+        Path(config.file_location.data_dir).expanduser() / "discovergy" / name
+    )
+    if not collection_path.is_dir():
+        return
+    for item_path in sorted(collection_path.iterdir()):
+        if not item_path.is_dir() or item_path.name.startswith("."):
+            continue
+        with collection_lock(config, name, shared=True):
+            index = read_pystore_index(parquet_part_files(item_path))
+        seconds = np.unique(index.astype("datetime64[s]").astype("int64"))
+        if not len(seconds):
+            continue
+        breaks = np.flatnonzero(np.diff(seconds) > max_gap)
+        starts = np.r_[seconds[0], seconds[breaks + 1]]
+        ends = np.r_[seconds[breaks], seconds[-1]] + 1
+        yield from zip(starts.tolist(), ends.tolist())
+
+
+def rebuild(*, config: Box, name: str, max_gap: int) -> Coverage:
+    """Add the ranges of the stored data of name to its coverage index, e. g.
+    for data stored before the index existed."""
+    intervals = list(stored_intervals(config, name, max_gap))
+    log.info(f"Found {len(intervals)} ranges of stored data of {name}.")
+    add_intervals(config=config, name=name, intervals=intervals)
+    return read_coverage(config, name)
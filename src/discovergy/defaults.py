@@ -28,11 +28,145 @@ log_dir: "~/discovergy/log/"
 [poll]
 # all values in seconds
 discovergy: 43200
+disaggregation: 43200
+load_profile: 86400
 weather: 7200
 awattar: 43200
+# seconds between two last readings per meter, 0 disables the live mode
+live: 0
+# seconds between two compactions of the stored data, 0 disables them
+compact: 0
 
 [open_weather_map]
 id: none
 latitude: none
 longitude: none
+# Additional locations, e. g. home=52.52,13.40; cabin=53.87,10.68
+locations:
 """
+
+# Max. Discovergy API requests per second and account shared by all poller
+# workers. Set rate_limit in [discovergy_account] to override, 0 disables it.
+DISCOVERGY_RATE_LIMIT = 10
+
+# Seconds between two heartbeats of a poller worker and after which a worker
+# without heartbeat is considered dead and its meters are moved.
+CLUSTER_HEARTBEAT = 15
+CLUSTER_HEARTBEAT_TIMEOUT = 60
+# Points per worker on the consistent hash ring
+CLUSTER_RING_REPLICAS = 64
+
+# Seconds to wait for the Discovergy API to connect or send data and the max.
+# number of idle connections kept alive per process
+HTTP_TIMEOUT = 30
+HTTP_KEEPALIVE_CONNECTIONS = 10
+
+# Max. number of live readings queued per subscriber
+LIVE_QUEUE_SIZE = 1000
+# Max. number of threads polling the last readings of the meters at once
+LIVE_MAX_THREADS = 8
+
+# Seconds a rule must not fire again after it fired
+RULE_DEBOUNCE = 900
+# Seconds between rule evaluations if nothing was published, e. g. to follow
+# the hourly Awattar price
+RULE_TICK = 60
+# Seconds between reads of the stored Awattar prices by the rules. The prices
+# of the next day are published once a day.
+RULE_PRICES_INTERVAL = 3600
+
+# Days of load profile fetched per request
+LOAD_PROFILE_PAGE_DAYS = 31
+
+# Seconds to look ahead for the cheapest start if no deadline is given
+PLAN_HORIZON = 86400
+
+# Seconds of recent power data kept in the memory-mapped cache per meter. Set
+# window in [hot_cache] to override, 0 disables the cache.
+HOT_CACHE_WINDOW = 259200
+
+# MiB of closed Discovergy readings and statistics responses cached on disk
+# and in memory, and seconds Discovergy may take to deliver late readings. Set
+# size, memory_size and delay in [response_cache] to override.
+RESPONSE_CACHE_SIZE = 256
+RESPONSE_CACHE_MEMORY_SIZE = 32
+RESPONSE_CACHE_DELAY = 86400
+
+# Anomalies are minute means of the power more than ANOMALY_THRESHOLD standard
+# deviations off the profile of their hour of the day for ANOMALY_DURATION
+# minutes. The profile has a half-life of ANOMALY_HALF_LIFE days and is used
+# after ANOMALY_WARMUP days. The standard deviation is at least ANOMALY_MIN_STD
+# mW. Set threshold, duration, half_life and warmup in [anomaly] to override.
+ANOMALY_THRESHOLD = 4.0
+ANOMALY_DURATION = 15
+ANOMALY_HALF_LIFE = 14
+ANOMALY_WARMUP = 7
+ANOMALY_MIN_STD = 10000
+
+# A device step is a change of the phase power of at least DEVICE_MIN_STEP W
+# between steady levels of DEVICE_WINDOW seconds. On and off steps pair up
+# within DEVICE_MAX_DURATION seconds if their sizes differ by at most
+# DEVICE_TOLERANCE. A device needs DEVICE_MIN_ACTIVATIONS activations.
+DEVICE_MIN_STEP = 30
+DEVICE_WINDOW = 5
+DEVICE_TOLERANCE = 0.1
+DEVICE_MAX_DURATION = 86400
+DEVICE_MIN_ACTIVATIONS = 3
+
+# Max. rows read from a parquet file at once by the export
+EXPORT_BATCH_ROWS = 65536
+
+# Compact the months of a Pystore collection stored in at least that many
+# parquet files. Row groups of the compacted files hold whole days and at least
+# that many rows.
+COMPACT_MIN_FILES = 2
+COMPACT_ROW_GROUP_ROWS = 65536
+
+# Max. seconds of power data fetched per request by the repair, the default
+# Discovergy poll interval. Stored rows further apart than REPAIR_MAX_GAP
+# seconds are a gap when the coverage index is rebuilt.
+REPAIR_WINDOW = 43200
+REPAIR_MAX_GAP = 60
+
+# Raw files parsed and merged before their data is written by the import
+IMPORT_BATCH_FILES = 64
+
+# Flush the journal to pystore once it holds that many rows or the oldest
+# row was journaled that many seconds ago.
+JOURNAL_FLUSH_ROWS = 500000
+JOURNAL_FLUSH_INTERVAL = 3600
+
+# Flush the weather buffer once it holds that many observations or the oldest
+# observation is older than that many seconds.
+WEATHER_FLUSH_SIZE = 12
+WEATHER_FLUSH_INTERVAL = 86400
+
+# Columns of the flattened Open Weather Map observations as stored.
+WEATHER_STR_COLUMNS = ("status", "detailed_status", "weather_icon_name", "location")
+WEATHER_COLUMNS = [
+    "clouds",
+    "humidity",
+    "temp",
+    "temp_kf",
+    "temp_max",
+    "temp_min",
+    "pressure",
+    "sea_level",
+    "wind_speed",
+    "wind_direction",
+    "rain_1h",
+    "rain_3h",
+    "snow_1h",
+    "snow_3h",
+    "visibility_distance",
+    "dewpoint",
+    "humidex",
+    "heat_index",
+    "weather_code",
+    "sunrise_time",
+    "sunset_time",
+    "status",
+    "detailed_status",
+    "weather_icon_name",
+    "location",
+]
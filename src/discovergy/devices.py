@@ -0,0 +1,440 @@
+# -*- coding: utf-8 -*-
+"""Detect the devices of a meter in the stored power data
+
+Usage:
+   {cmd} devices [--meter=<meter_id>...] [--to=<date>] [--activity]
+   {cmd} devices -h | --help
+
+Options:
+   --meter=<meter_id>     Only the given meters. Defaults to all stored meters.
+   --to=<date>            Only process the days before as ISO 8601 date. Defaults to today.
+   --activity             Print the activations instead of the device signatures.
+   -h, --help
+
+Devices are found by their on and off steps in the power of each phase,
+power1, power2 and power3. A step is a change of at least DEVICE_MIN_STEP W
+between two steady levels of DEVICE_WINDOW seconds, found with cumulative sums
+over the whole day at once. An on step and the next off step of about the same
+size on the same phase are an activation. Activations of about the same power
+on the same phase are one device, named after its phase and median power.
+
+The steps are detected once per complete day and kept in
+<data_dir>/devices/power_<meter_id>.steps.parquet. Days written again, e. g.
+by an import, are detected again. Each write is counted per day in
+power_<meter_id>.invalidated.json, so steps detected from data written over
+meanwhile are dropped. The activations of all steps are kept as
+device activity table in <data_dir>/devices/power_<meter_id>.activity.parquet
+with the columns start, end, phase, power (W), duration (s), energy (Wh) and
+device.
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import json
+import os
+import sys
+
+from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+import arrow  # type: ignore
+import numpy as np  # type: ignore
+import pandas as pd  # type: ignore
+
+from box import Box  # type: ignore
+from docopt import docopt  # type: ignore
+from loguru import logger as log
+
+from .defaults import (
+    DEVICE_MAX_DURATION,
+    DEVICE_MIN_ACTIVATIONS,
+    DEVICE_MIN_STEP,
+    DEVICE_TOLERANCE,
+    DEVICE_WINDOW,
+)
+from .export import ExportError, first_item_date, pystore_chunks
+from .utils import file_lock, naive_utc
+
+
+PHASES = ["power1", "power2", "power3"]
+ACTIVITY_COLUMNS = ["start", "end", "phase", "power", "duration", "energy", "device"]
+DAY = pd.Timedelta(days=1)
+
+
+def _no_steps() -> pd.DataFrame:
+    return pd.DataFrame(
+        {
+            "phase": pd.Series(dtype="int64"),
+            "delta": pd.Series(dtype="float64"),
+            "before": pd.Series(dtype="float64"),
+            "after": pd.Series(dtype="float64"),
+        },
+        index=pd.DatetimeIndex([], name="time"),
+    )
+
+
+def _std(
+    squares: np.ndarray, start: np.ndarray, end: np.ndarray, mean: np.ndarray
+) -> np.ndarray:
+    """Return the standard deviations of [start, end) from the cumulative squares."""
+    return np.sqrt(
+        np.maximum((squares[end] - squares[start]) / (end - start) - mean**2, 0)
+    )
+
+
+def detect_steps(
+    df: pd.DataFrame, min_step: float = DEVICE_MIN_STEP, window: int = DEVICE_WINDOW
+) -> pd.DataFrame:
+    """Return the steps in the power of the phases of the stored power data df.
+
+    A step at t is the change of the mean power (W) of [t - window, t) to the
+    mean power of [t, t + window). Both levels must be steady, i. e. their
+    standard deviations together are below half the change."""
+    steps = []
+    if not (df.index.is_monotonic_increasing and df.index.is_unique):
+        df = df[~df.index.duplicated(keep="last")].sort_index()
+    if len(df) < 2 * window:
+        return _no_steps()
+    grid = pd.date_range(df.index[0].floor("s"), df.index[-1].floor("s"), freq="s")
+    if not df.index.equals(grid):
+        df = df.reindex(grid)
+    t = np.arange(window, len(grid) - window + 1)
+    for phase, column in enumerate(PHASES, start=1):
+        if column not in df.columns:
+            continue
+        # The stored power is in mW.
+        x = df[column].to_numpy(dtype="float64") / 1000
+        valid = np.isfinite(x)
+        x = np.where(valid, x, 0)
+        sums = np.r_[0, np.cumsum(x)]
+        squares = np.r_[0, np.cumsum(x**2)]
+        counts = np.r_[0, np.cumsum(valid)]
+        before = (sums[t] - sums[t - window]) / window
+        after = (sums[t + window] - sums[t]) / window
+        delta = after - before
+        index = np.flatnonzero(
+            (np.abs(delta) >= min_step)
+            & (counts[t] - counts[t - window] == window)
+            & (counts[t + window] - counts[t] == window)
+        )
+        # Only the few large changes are checked for steady levels.
+        i = t[index]
+        noise = _std(squares, i - window, i, before[index]) + _std(
+            squares, i, i + window, after[index]
+        )
+        index = index[noise < np.abs(delta[index]) / 2]
+        if not len(index):
+            continue
+        # Adjacent candidates of the same sign are one step. Keep the largest.
+        sign = np.sign(delta[index])
+        new_step = np.r_[True, (np.diff(index) > 1) | (np.diff(sign) != 0)]
+        step_id = np.cumsum(new_step)
+        order = np.lexsort((-np.abs(delta[index]), step_id))
+        largest = index[order[np.r_[True, np.diff(step_id[order]) != 0]]]
+        steps.append(
+            pd.DataFrame(
+                {
+                    "phase": phase,
+                    "delta": delta[largest],
+                    "before": before[largest],
+                    "after": after[largest],
+                },
+                index=grid[t[largest]],
+            )
+        )
+    if not steps:
+        return _no_steps()
+    return pd.concat(steps).sort_index(kind="mergesort").rename_axis("time")
+
+
+def pair_steps(
+    steps: pd.DataFrame,
+    tolerance: float = DEVICE_TOLERANCE,
+    max_duration: int = DEVICE_MAX_DURATION,
+) -> pd.DataFrame:
+    """Return the activations, i. e. each on step paired with the next off step of
+    about the same size on the same phase.
+
+    :param tolerance: max. difference of the sizes relative to the larger one
+    :param max_duration: seconds an on step waits for its off step"""
+    rows = []
+    # The on steps still waiting for their off step per phase
+    open_steps: Dict[int, List[Tuple[pd.Timestamp, float]]] = {}
+    limit = pd.Timedelta(seconds=max_duration)
+    for time, phase, delta in zip(steps.index, steps["phase"], steps["delta"]):
+        waiting = open_steps.setdefault(int(phase), [])
+        while waiting and time - waiting[0][0] > limit:
+            waiting.pop(0)
+        if delta > 0:
+            waiting.append((time, delta))
+            continue
+        # The latest on step matching the size, e. g. of a device switched on last
+        for i in range(len(waiting) - 1, -1, -1):
+            start, on = waiting[i]
+            if abs(on + delta) <= tolerance * max(on, -delta):
+                del waiting[i]
+                rows.append((start, time, int(phase), (on - delta) / 2))
+                break
+    activity = pd.DataFrame(rows, columns=["start", "end", "phase", "power"]).astype(
+        {
+            "start": "datetime64[ns]",
+            "end": "datetime64[ns]",
+            "phase": "int64",
+            "power": "float64",
+        }
+    )
+    activity["duration"] = (activity["end"] - activity["start"]).dt.total_seconds()
+    activity["energy"] = activity["power"] * activity["duration"] / 3600
+    return activity
+
+
+def cluster(
+    activity: pd.DataFrame,
+    tolerance: float = DEVICE_TOLERANCE,
+    min_activations: int = DEVICE_MIN_ACTIVATIONS,
+) -> pd.DataFrame:
+    """Return the activations with the device they belong to.
+
+    Activations on the same phase are one device as long as the power of one to
+    the next larger one differs by at most tolerance. Devices activated less
+    than min_activations times are None."""
+    if not len(activity):
+        return activity.assign(device=pd.Series(dtype="object"))
+    activity = activity.sort_values(["phase", "power"], kind="mergesort")
+    log_power = np.log(activity["power"].to_numpy(dtype="float64"))
+    phase = activity["phase"].to_numpy()
+    new_device = np.r_[
+        True, (np.diff(phase) != 0) | (np.diff(log_power) > np.log1p(tolerance))
+    ]
+    device_id = np.cumsum(new_device)
+    groups = activity.groupby(device_id)
+    median = groups["power"].transform("median").to_numpy()
+    count = groups["power"].transform("size").to_numpy()
+    names = pd.Series(
+        [f"L{p}-{m:.0f}W" for p, m in zip(phase, median)], index=activity.index
+    )
+    activity["device"] = names.where(count >= min_activations, None)
+    return activity.sort_values("start", kind="mergesort").reset_index(drop=True)
+
+
+def signatures(activity: pd.DataFrame) -> pd.DataFrame:
+    """Return the phase, median power and duration, activations and energy per
+    device."""
+    groups = activity.dropna(subset=["device"]).groupby("device")
+    return pd.DataFrame(
+        {
+            "phase": groups["phase"].first(),
+            "power": groups["power"].median(),
+            "duration": groups["duration"].median(),
+            "activations": groups.size(),
+            "energy": groups["energy"].sum(),
+        }
+    ).sort_values(["phase", "power"])
+
+
+def devices_dir(config: Box) -> Path:
+    return Path(config.file_location.data_dir).expanduser() / "devices"
+
+
+def _path(config: Box, name: str, suffix: str) -> Path:
+    return devices_dir(config) / f"{name}.{suffix}"
+
+
+def read_days(config: Box, name: str) -> Set[str]:
+    """Return the days YYYY-MM-DD of the collection name the steps are detected of."""
+    try:
+        with _path(config, name, "days.json").open() as fh:
+            return set(json.load(fh))
+    except FileNotFoundError:
+        return set()
+
+
+def read_steps(config: Box, name: str) -> pd.DataFrame:
+    """Return the steps detected in the collection name."""
+    try:
+        return pd.read_parquet(_path(config, name, "steps.parquet").as_posix())
+    except FileNotFoundError:
+        return _no_steps()
+
+
+def read_activity(config: Box, meter_id: str) -> pd.DataFrame:
+    """Return the device activity table of the meter."""
+    try:
+        return pd.read_parquet(
+            _path(config, f"power_{meter_id}", "activity.parquet").as_posix()
+        )
+    except FileNotFoundError:
+        return pd.DataFrame(columns=ACTIVITY_COLUMNS)
+
+
+def _write(file_path: Path, data) -> None:
+    tmp_path = file_path.with_suffix(".tmp")
+    if isinstance(data, pd.DataFrame):
+        data.to_parquet(tmp_path.as_posix())
+    else:
+        with tmp_path.open("w") as fh:
+            json.dump(data, fh)
+    os.replace(tmp_path, file_path)
+
+
+def read_invalidated(config: Box, name: str) -> Dict[str, int]:
+    """Return the number of times each day YYYY-MM-DD of the collection name
+    was written after its steps were detected."""
+    try:
+        with _path(config, name, "invalidated.json").open() as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return {}
+
+
+def invalidate_days(config: Box, name: str, days: Iterable[pd.Timestamp]) -> None:
+    """Detect the steps of the days of the collection name again after data was
+    written. Steps close to midnight depend on the day after too."""
+    lock_path = _path(config, name, "lock")
+    # No steps were ever detected.
+    if not lock_path.exists():
+        return
+    with file_lock(lock_path):
+        done = read_days(config, name)
+        stale = set()
+        for day in days:
+            day = pd.Timestamp(day)
+            stale |= {day.strftime("%Y-%m-%d"), (day - DAY).strftime("%Y-%m-%d")}
+        if stale & done:
+            _write(_path(config, name, "days.json"), sorted(done - stale))
+        invalidated = read_invalidated(config, name)
+        for day in stale:
+            invalidated[day] = invalidated.get(day, 0) + 1
+        _write(_path(config, name, "invalidated.json"), invalidated)
+
+
+def _runs(days: List[pd.Timestamp]) -> Iterator[Tuple[pd.Timestamp, pd.Timestamp]]:
+    """Yield the consecutive days as [start, end)."""
+    start = end = None
+    for day in days:
+        if end is not None and day == end:
+            end = day + DAY
+            continue
+        if start is not None:
+            yield start, end
+        start, end = day, day + DAY
+    if start is not None:
+        yield start, end
+
+
+def day_steps(
+    *,
+    config: Box,
+    name: str,
+    date_from: pd.Timestamp,
+    date_to: pd.Timestamp,
+    min_step: float = DEVICE_MIN_STEP,
+    window: int = DEVICE_WINDOW,
+) -> Iterator[pd.DataFrame]:
+    """Yield the steps of each day in [date_from, date_to) of the collection name.
+
+    The data is read once in time order, the day and window seconds around it
+    are held in memory."""
+    margin = pd.Timedelta(seconds=window)
+
+    def steps_of(df: pd.DataFrame, day: pd.Timestamp) -> pd.DataFrame:
+        df = df[(df.index >= day - margin) & (df.index < day + DAY + margin)]
+        steps = detect_steps(df, min_step, window)
+        return steps[(steps.index >= day) & (steps.index < day + DAY)]
+
+    day = date_from
+    buffer: List[pd.DataFrame] = []
+    try:
+        chunks = pystore_chunks(
+            config=config,
+            name=name,
+            date_from=date_from - margin,
+            date_to=date_to + margin,
+            columns=PHASES,
+        )
+        for chunk in chunks:
+            if not len(chunk):
+                continue
+            buffer.append(chunk)
+            while day < date_to and chunk.index[-1] >= day + DAY + margin:
+                df = pd.concat(buffer)
+                yield steps_of(df, day)
+                day += DAY
+                buffer = [df[df.index >= day - margin]]
+    except ExportError:
+        pass
+    df = pd.concat(buffer) if buffer else pd.DataFrame(index=pd.DatetimeIndex([]))
+    while day < date_to:
+        yield steps_of(df, day)
+        day += DAY
+
+
+def update(
+    *, config: Box, meter_id: str, date_to: Optional[pd.Timestamp] = None
+) -> pd.DataFrame:
+    """Detect the steps of the complete days before date_to not detected yet and
+    rebuild the device activity table of the meter. Return the table."""
+    name = f"power_{meter_id}"
+    first_date = first_item_date(config, name)
+    if first_date is None:
+        return read_activity(config, meter_id)
+    last_day = naive_utc(date_to or pd.Timestamp.utcnow()).floor("D")
+    days = pd.date_range(naive_utc(first_date), last_day - DAY, freq="D")
+    devices_dir(config).mkdir(parents=True, exist_ok=True)
+    lock_path = _path(config, name, "lock")
+    with file_lock(lock_path):
+        done = read_days(config, name)
+        invalidated = read_invalidated(config, name)
+    missing = [d for d in days if d.strftime("%Y-%m-%d") not in done]
+    # The detection runs unlocked, the journal flush invalidates days meanwhile.
+    detected: Dict[str, pd.DataFrame] = {}
+    for start, end in _runs(missing):
+        log.debug(f"Detecting the steps of {name} from {start} to {end}.")
+        run = day_steps(config=config, name=name, date_from=start, date_to=end)
+        for day, day_steps_df in zip(pd.date_range(start, end - DAY), run):
+            detected[day.strftime("%Y-%m-%d")] = day_steps_df
+    with file_lock(lock_path):
+        done = read_days(config, name)
+        changed = {
+            day
+            for day, n in read_invalidated(config, name).items()
+            if n != invalidated.get(day)
+        }
+        steps = read_steps(config, name)
+        steps = steps[steps.index.floor("D").strftime("%Y-%m-%d").isin(done)]
+        # Days written over since are detected again next time. Days another
+        # update stored meanwhile are kept.
+        new = {d: df for d, df in detected.items() if d not in changed | done}
+        steps = pd.concat([steps, *new.values()]).sort_index(kind="mergesort")
+        done |= set(new)
+        activity = cluster(pair_steps(steps))
+        _write(_path(config, name, "steps.parquet"), steps)
+        _write(_path(config, name, "activity.parquet"), activity)
+        _write(_path(config, name, "days.json"), sorted(done))
+    return activity
+
+
+def stored_meters(config: Box) -> List[str]:
+    """Return the ids of the meters with stored power data."""
+    collections = Path(config.file_location.data_dir).expanduser() / "discovergy"
+    if not collections.is_dir():
+        return []
+    return sorted(p.name[len("power_") :] for p in collections.glob("power_*"))
+
+
+def main(config: Box) -> None:
+    """Entry point for the devices sub command."""
+    arguments = docopt(__doc__.format(cmd=sys.argv[0]), argv=sys.argv[1:])
+    date_to = None
+    if arguments["--to"]:
+        date_to = pd.Timestamp(arrow.get(arguments["--to"]).datetime)
+    meter_ids = arguments["--meter"] or stored_meters(config)
+    if not meter_ids:
+        log.error("There is no stored power data.")
+        sys.exit(1)
+    with pd.option_context("display.max_rows", None, "display.width", None):
+        for meter_id in meter_ids:
+            activity = update(config=config, meter_id=meter_id, date_to=date_to)
+            print(f"Meter {meter_id}:")
+            print(activity if arguments["--activity"] else signatures(activity))
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Discovergy disaggregation and activities module
+
+Fetch the per device disaggregation and the device activities of the meters
+incrementally. The last fetched time per meter is kept as watermark. The data
+is stored in the Pystore collections disaggregation_<meter_id> and
+activities_<meter_id> next to power_<meter_id>. Read it with
+utils.read_data_from_pystore.
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+from typing import Dict, List, Union
+
+import pandas as pd  # type: ignore
+
+from box import Box  # type: ignore
+from loguru import logger as log
+
+from .api import DiscovergyMeter
+from .coverage import add_coverage
+from .journal import get_journal
+from .utils import read_watermark, write_watermark
+
+
+def get(
+    *, config: Box, meters: Dict[str, DiscovergyMeter], initial: pd.Timedelta
+) -> None:
+    """Fetch and journal the disaggregation and activities since the watermarks.
+
+    :param initial: how far to look back for a meter without watermark
+    """
+    now = pd.Timestamp.utcnow().floor("s")
+    for meter_id, meter in meters.items():
+        for kind, fetch, to_df, key_columns in (
+            ("disaggregation", meter.disaggregation, disaggregation_to_df, ["device"]),
+            ("activities", meter.activities, activities_to_df, ["deviceId"]),
+        ):
+            name = f"{kind}_{meter_id}"
+            date_from = read_watermark(config=config, name=name) or now - initial
+            if date_from >= now:
+                continue
+            log.info(f"Fetching {kind} for meter {meter_id} since {date_from}...")
+            data = fetch(ts_from=int(date_from.timestamp()), ts_to=int(now.timestamp()))
+            df = to_df(data=data)
+            get_journal(config).append(
+                name=name,
+                df=df,
+                metadata={"meter_id": meter_id, "key_columns": key_columns},
+            )
+            add_coverage(config=config, name=name, date_from=date_from, date_to=now)
+            write_watermark(config=config, name=name, timestamp=now)
+
+
+def disaggregation_to_df(*, data: Dict[str, Dict[str, int]]) -> pd.DataFrame:
+    """Return the disaggregation as a long Pandas DataFrame with the columns device
+    and energy.
+
+    The API returns {<timestamp in ms>: {<device>: <energy>, ...}, ...}. Devices come
+    and go. A long table keeps the stored schema stable.
+    """
+    if not data:
+        return pd.DataFrame(
+            {"device": pd.Series(dtype="object"), "energy": pd.Series(dtype="int64")}
+        )
+    wide = pd.DataFrame.from_dict(data, orient="index")
+    wide.index = pd.to_datetime(wide.index.astype("int64"), unit="ms")
+    df = wide.stack().rename("energy").reset_index(level=1)
+    df = df.rename(columns={df.columns[0]: "device"})
+    df["energy"] = df["energy"].astype("int64")
+    return df.sort_index(kind="mergesort")
+
+
+def activities_to_df(*, data: Union[List[Dict], Dict]) -> pd.DataFrame:
+    """Return the activities as a Pandas DataFrame indexed by their begin time.
+
+    All *Time fields are converted from ms to timestamps."""
+    if isinstance(data, dict):
+        data = data.get("activities", [])
+    df = pd.DataFrame.from_records(data)
+    if not len(df) or "beginTime" not in df:
+        return pd.DataFrame()
+    for column in [c for c in df.columns if c.endswith("Time")]:
+        df[column] = pd.to_datetime(df[column], unit="ms")
+    return df.set_index("beginTime").sort_index(kind="mergesort")
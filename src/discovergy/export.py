@@ -0,0 +1,353 @@
+# -*- coding: utf-8 -*-
+"""Export the stored data
+
+Usage:
+   {cmd} export <source> [--meter=<meter_id>] [--from=<date>] [--to=<date>] [--columns=<columns>] [--resample=<rule>] [--format=<format>] [--output=<file>]
+   {cmd} export -h | --help
+
+Options:
+   <source>               power, disaggregation, activities, load_profile, quarantine,
+                          awattar or weather
+   --meter=<meter_id>     The meter of the power, disaggregation, activities, load_profile
+                          and quarantine data.
+   --from=<date>          Start as ISO 8601 date (inclusive). Defaults to the first data.
+   --to=<date>            End as ISO 8601 date (exclusive). Defaults to now.
+   --columns=<columns>    Comma separated columns to export. Defaults to all.
+   --resample=<rule>      Resample to the mean of fixed intervals, e. g. 15min or 1h.
+   --format=<format>      csv, parquet or arrow (Arrow IPC stream) [default: csv]
+   --output=<file>        Write to the file. Defaults to stdout.
+   -h, --help
+
+The data is streamed partition by partition, i. e. by parquet row group or
+monthly file. Only one partition is held in memory at a time.
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import sys
+
+from pathlib import Path
+from typing import BinaryIO, Iterator, List, Optional, Tuple
+
+import arrow  # type: ignore
+import pandas as pd  # type: ignore
+import pyarrow as pa  # type: ignore
+import pyarrow.parquet as pq  # type: ignore
+
+from box import Box  # type: ignore
+from docopt import docopt  # type: ignore
+from loguru import logger as log
+
+from .defaults import EXPORT_BATCH_ROWS
+from .utils import (
+    collection_lock,
+    data_frame_files,
+    naive_utc,
+    parquet_index_range,
+    parquet_part_files,
+)
+
+
+PYSTORE_SOURCES = (
+    "power",
+    "disaggregation",
+    "activities",
+    "load_profile",
+    "quarantine",
+)
+HDF_SOURCES = ("awattar", "weather")
+FORMATS = ("csv", "parquet", "arrow")
+
+
+class ExportError(Exception):
+    """The export is not possible as requested."""
+
+    pass
+
+
+def pystore_chunks(
+    *,
+    config: Box,
+    name: str,
+    date_from: pd.Timestamp,
+    date_to: pd.Timestamp,
+    columns: Optional[List[str]] = None,
+) -> Iterator[pd.DataFrame]:
+    """Yield the data of the Pystore collection name in [date_from, date_to) in
+    time order, one parquet batch at a time.
+
+    If the files of a month overlap in time, e. g. after a backfill, the month
+    is read at once and sorted."""
+    date_from, date_to = naive_utc(date_from), naive_utc(date_to)
+    collection_path = (
+        Path(config.file_location.data_dir).expanduser() / "discovergy" / name
+    )
+    if not collection_path.is_dir():
+        raise ExportError(f"There is no collection {name}.")
+    months = pd.period_range(date_from, date_to - pd.Timedelta(1), freq="M")
+    for month in months:
+        item_path = collection_path / f"{month.year}-{month.month:02d}"
+        if not item_path.is_dir():
+            continue
+        # Writers and the compaction replace files but never change one. The
+        # files opened under the lock stay a consistent snapshot of the month
+        # after it is released, even if they are deleted meanwhile.
+        with collection_lock(config, name, shared=True):
+            parquet_files = [pq.ParquetFile(f) for f in parquet_part_files(item_path)]
+        try:
+            yield from _item_chunks(
+                item_path=item_path,
+                parquet_files=parquet_files,
+                date_from=date_from,
+                date_to=date_to,
+                columns=columns,
+            )
+        finally:
+            for parquet_file in parquet_files:
+                parquet_file.close()
+
+
+def _item_chunks(
+    *,
+    item_path: Path,
+    parquet_files: List[pq.ParquetFile],
+    date_from: pd.Timestamp,
+    date_to: pd.Timestamp,
+    columns: Optional[List[str]] = None,
+) -> Iterator[pd.DataFrame]:
+    """Yield the data of the files of a Pystore item, see pystore_chunks."""
+    if not parquet_files:
+        return
+    pandas_metadata = parquet_files[0].schema_arrow.pandas_metadata
+    index_name = pandas_metadata["index_columns"][0]
+    ranges = [parquet_index_range(f, index_name) for f in parquet_files]
+    bounds: List[Tuple[pd.Timestamp, pd.Timestamp]] = [
+        r for r in ranges if r is not None
+    ]
+    ordered = len(bounds) == len(ranges)
+    if ordered:
+        order = sorted(range(len(bounds)), key=lambda i: bounds[i])
+        parquet_files = [parquet_files[i] for i in order]
+        bounds = [bounds[i] for i in order]
+        ordered = all(a[1] < b[0] for a, b in zip(bounds[:-1], bounds[1:]))
+    read_columns = columns + [index_name] if columns else None
+    if not ordered:
+        log.debug(f"The files of {item_path} overlap. Reading them at once.")
+        df = pd.concat(
+            [f.read(columns=read_columns).to_pandas() for f in parquet_files]
+        ).sort_index(kind="mergesort")
+        yield df[(df.index >= date_from) & (df.index < date_to)]
+        return
+    for parquet_file, (minimum, maximum) in zip(parquet_files, bounds):
+        if maximum < date_from or minimum >= date_to:
+            continue
+        for batch in parquet_file.iter_batches(
+            batch_size=EXPORT_BATCH_ROWS, columns=read_columns
+        ):
+            df = pa.Table.from_batches([batch]).to_pandas()
+            yield df[(df.index >= date_from) & (df.index < date_to)]
+
+
+def hdf_chunks(
+    *,
+    config: Box,
+    name: str,
+    date_from: pd.Timestamp,
+    date_to: pd.Timestamp,
+    columns: Optional[List[str]] = None,
+) -> Iterator[pd.DataFrame]:
+    """Yield the data of the monthly hdf5 files of name in [date_from, date_to),
+    one file at a time."""
+    for file_path in data_frame_files(
+        config=config, name=name, date_from=date_from, date_to=date_to
+    ):
+        df = pd.read_hdf(file_path, name)
+        if columns:
+            df = df[columns]
+        if df.index.tz is None:
+            lower, upper = naive_utc(date_from), naive_utc(date_to)
+        else:
+            lower, upper = date_from, date_to
+        df = df.sort_index(kind="mergesort")
+        yield df[(df.index >= lower) & (df.index < upper)]
+
+
+def resample_chunks(
+    chunks: Iterator[pd.DataFrame], rule: str
+) -> Iterator[pd.DataFrame]:
+    """Yield the mean of the numeric columns per interval of the time ordered chunks.
+
+    The rows of the last interval of a chunk are carried over to the next chunk
+    so intervals spanning chunks are complete."""
+    carry: Optional[pd.DataFrame] = None
+    dropped: List[str] = []
+    for df in chunks:
+        numeric = df.select_dtypes("number")
+        if len(numeric.columns) < len(df.columns) and not dropped:
+            dropped = [c for c in df.columns if c not in numeric.columns]
+            log.warning(f"Not exporting the non-numeric columns {', '.join(dropped)}.")
+        if carry is not None:
+            numeric = pd.concat([carry, numeric])
+        if not len(numeric):
+            continue
+        last_interval = numeric.index[-1].floor(rule)
+        carry = numeric[numeric.index >= last_interval]
+        done = numeric[numeric.index < last_interval]
+        if len(done):
+            yield done.resample(rule).mean()
+    if carry is not None and len(carry):
+        yield carry.resample(rule).mean()
+
+
+class Sink:
+    """Write data frames to a binary stream in one of FORMATS."""
+
+    def __init__(self, *, stream: BinaryIO, file_format: str):
+        if file_format not in FORMATS:
+            raise ExportError(
+                f"The format {file_format} is not one of {', '.join(FORMATS)}."
+            )
+        self.stream = stream
+        self.file_format = file_format
+        self.schema: Optional[pa.Schema] = None
+        self.columns: Optional[List[str]] = None
+        self.writer = None
+        self.rows = 0
+
+    def __repr__(self):
+        return f"Sink:{self.file_format}"
+
+    def write(self, df: pd.DataFrame) -> None:
+        """Write the data frame. Its index becomes the column time."""
+        if not len(df):
+            return
+        if self.columns is None:
+            self.columns = list(df.columns)
+        # Keep the columns of the first chunk. The schema can't change.
+        df = df.reindex(columns=self.columns).rename_axis("time").reset_index()
+        if self.file_format == "csv":
+            self.stream.write(df.to_csv(header=not self.rows, index=False).encode())
+        else:
+            if self.schema is None:
+                self.schema = pa.Schema.from_pandas(df, preserve_index=False)
+                if self.file_format == "parquet":
+                    self.writer = pq.ParquetWriter(
+                        self.stream, self.schema, compression="snappy"
+                    )
+                else:
+                    self.writer = pa.ipc.new_stream(self.stream, self.schema)
+            table = pa.Table.from_pandas(df, schema=self.schema, preserve_index=False)
+            self.writer.write_table(table)  # type: ignore
+        self.rows += len(df)
+
+    def close(self) -> None:
+        """Finish the file, e. g. write the parquet footer."""
+        if self.writer is not None:
+            self.writer.close()
+        self.stream.flush()
+
+
+def export(
+    *,
+    config: Box,
+    source: str,
+    stream: BinaryIO,
+    meter_id: Optional[str] = None,
+    date_from: Optional[pd.Timestamp] = None,
+    date_to: Optional[pd.Timestamp] = None,
+    columns: Optional[List[str]] = None,
+    resample: Optional[str] = None,
+    file_format: str = "csv",
+) -> int:
+    """Stream the data of the source to the stream. Return the number of rows."""
+    date_from = pd.Timestamp(0, tz="utc") if date_from is None else date_from
+    date_to = pd.Timestamp.utcnow() if date_to is None else date_to
+    if date_from.tzinfo is None:
+        date_from = date_from.tz_localize("utc")
+    if date_to.tzinfo is None:
+        date_to = date_to.tz_localize("utc")
+    if resample is not None:
+        try:
+            offset = pd.tseries.frequencies.to_offset(resample)
+        except ValueError:
+            offset = None
+        if not isinstance(offset, pd.offsets.Tick):
+            raise ExportError(f"The resample rule {resample} is not a fixed interval.")
+    if source in PYSTORE_SOURCES:
+        if not meter_id:
+            raise ExportError(f"Exporting {source} requires a meter.")
+        if date_from == pd.Timestamp(0, tz="utc"):
+            # Don't scan the months since 1970.
+            date_from = first_item_date(config, f"{source}_{meter_id}") or date_from
+        chunks = pystore_chunks(
+            config=config,
+            name=f"{source}_{meter_id}",
+            date_from=date_from,
+            date_to=date_to,
+            columns=columns,
+        )
+    elif source in HDF_SOURCES:
+        chunks = hdf_chunks(
+            config=config,
+            name=source,
+            date_from=date_from,
+            date_to=date_to,
+            columns=columns,
+        )
+    else:
+        raise ExportError(f"The source {source} is unknown.")
+    if resample is not None:
+        chunks = resample_chunks(chunks, resample)
+    sink = Sink(stream=stream, file_format=file_format)
+    try:
+        for df in chunks:
+            sink.write(df)
+    finally:
+        sink.close()
+    return sink.rows
+
+
+def first_item_date(config: Box, name: str) -> Optional[pd.Timestamp]:
+    """Return the first month stored in the Pystore collection name."""
+    collection_path = (
+        Path(config.file_location.data_dir).expanduser() / "discovergy" / name
+    )
+    if not collection_path.is_dir():
+        return None
+    months = sorted(p.name for p in collection_path.iterdir() if p.name[:4].isdigit())
+    return pd.Timestamp(f"{months[0]}-01", tz="utc") if months else None
+
+
+def main(config: Box) -> None:
+    """Entry point for the export sub command."""
+    arguments = docopt(__doc__.format(cmd=sys.argv[0]), argv=sys.argv[1:])
+    date_from = date_to = None
+    if arguments["--from"]:
+        date_from = pd.Timestamp(arrow.get(arguments["--from"]).datetime)
+    if arguments["--to"]:
+        date_to = pd.Timestamp(arrow.get(arguments["--to"]).datetime)
+    columns = None
+    if arguments["--columns"]:
+        columns = [c.strip() for c in arguments["--columns"].split(",")]
+    output = arguments["--output"]
+    stream = open(output, "wb") if output else sys.stdout.buffer
+    try:
+        rows = export(
+            config=config,
+            source=arguments["<source>"],
+            stream=stream,
+            meter_id=arguments["--meter"],
+            date_from=date_from,
+            date_to=date_to,
+            columns=columns,
+            resample=arguments["--resample"],
+            file_format=arguments["--format"],
+        )
+    except (ExportError, KeyError) as e:
+        log.error(f"Could not export {arguments['<source>']}: {e}")
+        sys.exit(1)
+    finally:
+        if output:
+            stream.close()
+    log.info(f"Exported {rows} rows of {arguments['<source>']}.")
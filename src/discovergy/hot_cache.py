@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Discovergy hot data cache
+
+Keep the power data of the last HOT_CACHE_WINDOW seconds of each meter in
+memory-mapped numpy arrays, one file per field in <data_dir>/hot/power_<meter_id>/.
+The arrays are ring buffers with one slot per second. _time.npy holds the
+timestamp of each slot and tells which slots are valid.
+
+The poller writes new readings as they are fetched. Readers in any process map
+the same files, so the pages are shared and reading a time range is a slice
+of the arrays. Ranges not covered by the cache are read from Pystore.
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import shutil
+
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np  # type: ignore
+import pandas as pd  # type: ignore
+
+from box import Box  # type: ignore
+from loguru import logger as log
+
+from .defaults import HOT_CACHE_WINDOW
+from .utils import naive_utc, read_data_from_pystore
+
+
+TIME_FILE = "_time.npy"
+# start: first second since the cache is complete, newest: last second written
+META_FILE = "_meta.npy"
+
+_caches: Dict[Tuple[str, bool], "HotCache"] = {}
+
+
+def cache_window(config: Box) -> int:
+    """Return the configured window in seconds. 0 if the cache is disabled."""
+    return int(config.get("hot_cache", {}).get("window", HOT_CACHE_WINDOW) or 0)
+
+
+class HotCache:
+    """Represents the memory-mapped ring buffers of the recent data of a meter."""
+
+    def __init__(self, *, config: Box, meter_id: str, writable: bool = False):
+        """:param writable: open for writing and create the files if needed"""
+        self.meter_id = meter_id
+        self.writable = writable
+        self.capacity = cache_window(config)
+        self.path = (
+            Path(config.file_location.data_dir).expanduser()
+            / "hot"
+            / f"power_{meter_id}"
+        )
+        self._fields: Dict[str, np.memmap] = {}
+        self.times: Optional[np.memmap] = None
+        self.meta: Optional[np.memmap] = None
+        if writable:
+            self._create()
+        self._open()
+
+    def __repr__(self):
+        return f"HotCache:{self.meter_id}"
+
+    def _create(self) -> None:
+        """Create the time and meta files. Start over if the window changed."""
+        time_path = self.path / TIME_FILE
+        if time_path.exists():
+            shape = np.load(time_path.as_posix(), mmap_mode="r").shape
+            if shape == (self.capacity,):
+                return
+            log.info(f"The window of {self} changed. Starting over.")
+            shutil.rmtree(self.path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        np.lib.format.open_memmap(
+            (self.path / META_FILE).as_posix(), mode="w+", dtype="int64", shape=(2,)
+        ).flush()
+        np.lib.format.open_memmap(
+            time_path.as_posix(), mode="w+", dtype="int64", shape=(self.capacity,)
+        ).flush()
+
+    def _open(self) -> None:
+        time_path = self.path / TIME_FILE
+        if not time_path.exists():
+            return
+        self.times = np.load(
+            time_path.as_posix(), mmap_mode="r+" if self.writable else "r"
+        )
+        self.meta = np.load(
+            (self.path / META_FILE).as_posix(), mmap_mode="r+" if self.writable else "r"
+        )
+        self.capacity = len(self.times)
+
+    def field(self, name: str) -> Optional[np.memmap]:
+        """Return the ring buffer of the field. Create it if writable."""
+        if name not in self._fields:
+            file_path = self.path / f"{name}.npy"
+            if file_path.exists():
+                self._fields[name] = np.load(
+                    file_path.as_posix(), mmap_mode="r+" if self.writable else "r"
+                )
+            elif self.writable:
+                values = np.lib.format.open_memmap(
+                    file_path.as_posix(),
+                    mode="w+",
+                    dtype="float64",
+                    shape=(self.capacity,),
+                )
+                values[:] = np.nan
+                self._fields[name] = values
+            else:
+                return None
+        return self._fields[name]
+
+    def fields(self) -> List[str]:
+        """Return the names of the cached fields."""
+        return sorted(
+            p.stem for p in self.path.glob("*.npy") if not p.name.startswith("_")
+        )
+
+    def write(self, df: pd.DataFrame) -> None:
+        """Write the data with a naive UTC index at 1 s resolution."""
+        if not len(df) or self.times is None or self.meta is None:
+            return
+        seconds = df.index.asi8 // 10**9
+        start, newest = (int(e) for e in self.meta)
+        # Rows older than the window would overwrite the slots of newer ones.
+        recent = seconds > max(newest, int(seconds.max())) - self.capacity
+        if not recent.all():
+            df, seconds = df[recent], seconds[recent]
+            if not len(df):
+                return
+        slots = seconds % self.capacity
+        # Values first. A reader only uses a slot once its time is set.
+        for name in df.columns:
+            values = self.field(name)
+            assert values is not None
+            values[slots] = df[name].to_numpy(dtype="float64")
+        self.times[slots] = seconds
+        first, last = int(seconds.min()), int(seconds.max())
+        # The cache is complete since start as long as the writes are contiguous.
+        if not newest or first > newest + 1:
+            start = first
+        self.meta[:] = (start, max(newest, last))
+
+    def covers(self, date_from: pd.Timestamp, date_to: pd.Timestamp) -> bool:
+        """Return True if the time range [date_from, date_to) is in the cache."""
+        if self.meta is None:
+            return False
+        start, newest = (int(e) for e in self.meta)
+        ts_from = naive_utc(date_from).value // 10**9
+        ts_to = naive_utc(date_to).value // 10**9
+        if not newest or ts_from >= ts_to:
+            return False
+        return max(start, newest - self.capacity + 1) <= ts_from and ts_to <= newest + 1
+
+    def arrays(
+        self,
+        *,
+        date_from: pd.Timestamp,
+        date_to: pd.Timestamp,
+        fields: Optional[List[str]] = None,
+    ) -> Tuple[np.ndarray, Dict[str, np.ndarray]]:
+        """Return the seconds and the values of the fields in [date_from, date_to).
+
+        The arrays are views of the mapped files unless the range wraps around
+        the end of the ring buffer or has gaps."""
+        ts_from = naive_utc(date_from).value // 10**9
+        ts_to = naive_utc(date_to).value // 10**9
+        n = max(0, min(ts_to - ts_from, self.capacity))
+        ts_from = ts_to - n
+        fields = fields or self.fields()
+        if self.times is None or not n:
+            return np.empty(0, dtype="int64"), {f: np.empty(0) for f in fields}
+        first = ts_from % self.capacity
+        if first + n <= self.capacity:
+            select = slice(first, first + n)
+        else:
+            select = np.r_[first : self.capacity, 0 : first + n - self.capacity]
+        seconds = self.times[select]
+        valid = seconds == np.arange(ts_from, ts_to)
+        if not valid.all():
+            select = np.arange(first, first + n)[valid] % self.capacity
+            seconds = self.times[select]
+        values = {}
+        for name in fields:
+            values_field = self.field(name)
+            if values_field is None:
+                values[name] = np.full(len(seconds), np.nan)
+            else:
+                values[name] = values_field[select]
+        return seconds, values
+
+    def read(
+        self,
+        *,
+        date_from: pd.Timestamp,
+        date_to: pd.Timestamp,
+        fields: Optional[List[str]] = None,
+    ) -> pd.DataFrame:
+        """Return the cached data in [date_from, date_to) like read_data_from_pystore."""
+        seconds, values = self.arrays(
+            date_from=date_from, date_to=date_to, fields=fields
+        )
+        return pd.DataFrame(values, index=pd.to_datetime(seconds, unit="s"))
+
+
+def get_hot_cache(
+    config: Box, meter_id: str, writable: bool = False
+) -> Optional[HotCache]:
+    """Return the cache of the meter. None if the cache is disabled or missing."""
+    if not cache_window(config):
+        return None
+    path = Path(config.file_location.data_dir).expanduser().as_posix()
+    key = (f"{path}/{meter_id}", writable)
+    cache = _caches.get(key)
+    if cache is None or cache.times is None:
+        cache = HotCache(config=config, meter_id=meter_id, writable=writable)
+        if cache.times is None:
+            return None
+        _caches[key] = cache
+    return cache
+
+
+def update(*, config: Box, meter_id: str, df: pd.DataFrame) -> None:
+    """Write newly fetched power data of the meter to its cache."""
+    cache = get_hot_cache(config, meter_id, writable=True)
+    if cache is not None:
+        cache.write(df)
+
+
+def warm(*, config: Box, meter_ids: List[str]) -> None:
+    """Fill the caches of the meters from Pystore.
+
+    The journal must be flushed, otherwise the cache misses its data."""
+    window = cache_window(config)
+    if not window:
+        return
+    date_to = naive_utc(pd.Timestamp.utcnow()).floor("s")
+    date_from = date_to - pd.Timedelta(seconds=window)
+    for meter_id in meter_ids:
+        cache = get_hot_cache(config, meter_id, writable=True)
+        if cache is None:
+            continue
+        df = read_data_from_pystore(
+            config=config,
+            name=f"power_{meter_id}",
+            date_from=date_from,
+            date_to=date_to,
+        )
+        if len(df):
+            assert cache.meta is not None
+            cache.meta[:] = 0
+            cache.write(df)
+            # Pystore has all data of the window. No data means no data.
+            cache.meta[0] = min(int(cache.meta[0]), date_from.value // 10**9)
+        log.debug(f"Loaded {len(df)} rows into {cache}.")
+
+
+def read_data(
+    *,
+    config: Box,
+    name: str,
+    date_from: pd.Timestamp,
+    date_to: pd.Timestamp,
+    columns: Optional[List[str]] = None,
+) -> pd.DataFrame:
+    """Like read_data_from_pystore but read the power data from the cache if it
+    covers the time range."""
+    if name.startswith("power_"):
+        cache = get_hot_cache(config, name[len("power_") :])
+        if cache is not None and cache.covers(date_from, date_to):
+            return cache.read(date_from=date_from, date_to=date_to, fields=columns)
+    return read_data_from_pystore(
+        config=config,
+        name=name,
+        date_from=date_from,
+        date_to=date_to,
+        columns=columns,
+    )
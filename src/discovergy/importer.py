@@ -0,0 +1,333 @@
+# -*- coding: utf-8 -*-
+"""Import raw data files
+
+Usage:
+   {cmd} import <source> <dir> [--meter=<meter_id>] [--processes=<n>] [--batch=<n>] [--restart]
+   {cmd} import -h | --help
+
+Options:
+   <source>             power, awattar or weather
+   <dir>                The directory of the raw files, e. g. <data_dir>/raw.
+   --meter=<meter_id>   The meter of the power data.
+   --processes=<n>      Number of processes parsing the files. Defaults to the number of CPUs.
+   --batch=<n>          Number of files parsed before their data is written.
+   --restart            Import all files again, not only the ones not imported yet.
+   -h, --help
+
+The files are parsed in a process pool. The data of a batch of files is merged
+and written once per day (power) or month (awattar, weather) while the next
+batch is parsed. The imported files are recorded in <data_dir>/import/. An
+interrupted import continues with the files not imported yet.
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import json
+import os
+import re
+import sys
+import time
+
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd  # type: ignore
+
+from box import Box  # type: ignore
+from docopt import docopt  # type: ignore
+from loguru import logger as log
+
+from . import anomaly, awattar, compact, devices, ledger, power, statistics, weather
+from .archive import read_records
+from .coverage import add_intervals, to_seconds
+from .defaults import IMPORT_BATCH_FILES
+from .journal import drop_duplicates
+from .utils import (
+    append_data_frames,
+    init_pystore,
+    split_df_by_day,
+    split_df_by_month,
+    write_data_frames,
+    write_data_to_pystore,
+)
+from .validation import FIELDS, Validation, record_metrics, validate_readings
+
+
+# File name prefix of the raw files of each source
+PREFIXES = {
+    "power": "discovergy_data",
+    "awattar": "awattar_20",
+    "weather": "open_weather_map",
+}
+# The raw power archive of a meter, see power.fetch and archive.ArchiveWriter
+POWER_ARCHIVE = re.compile(r"discovergy_data_(.+)_\d{4}-\d{2}-\d{2}\.ndjson")
+
+
+class ArchiveImportError(Exception):
+    """The import is not possible as requested."""
+
+    pass
+
+
+def parse_file(
+    source: str, file_path: Path, fields: Optional[List[str]] = None
+) -> Tuple[pd.DataFrame, Optional[Validation]]:
+    """Return the data of the raw file of the source and the validation of the
+    power readings. Runs in a pool process.
+
+    :param fields: the power fields to keep, see power.configured_fields"""
+    if source == "power":
+        validation = validate_readings(list(read_records(file_path)), fields or FIELDS)
+        return power.readings_to_df(validation.readings), validation
+    with file_path.open() as fh:
+        data = json.load(fh)
+    if source == "awattar":
+        return awattar.raw_to_df(data=data), None
+    # The weather files hold the JSON string of the observation.
+    return weather.raw_owm_to_df(data=json.loads(data)), None
+
+
+class ImportState:
+    """The files imported so far, kept in a JSON file."""
+
+    def __init__(self, *, path: Path):
+        self.path = path
+        # {absolute file path: [size, mtime]}
+        self.files: Dict[str, List[int]] = {}
+        try:
+            with self.path.open() as fh:
+                self.files = json.load(fh)
+        except FileNotFoundError:
+            pass
+        except json.JSONDecodeError:
+            log.warning(f"Could not read {self.path}. Importing all files.")
+
+    def __repr__(self):
+        return f"ImportState:{self.path.stem}"
+
+    @staticmethod
+    def _key(file_path: Path) -> Tuple[str, List[int]]:
+        stat = file_path.stat()
+        return file_path.resolve().as_posix(), [stat.st_size, stat.st_mtime_ns]
+
+    def imported(self, file_path: Path) -> bool:
+        """Return True if the file was imported and did not change since."""
+        key, value = self._key(file_path)
+        return self.files.get(key) == value
+
+    def add(self, file_paths: List[Path]) -> None:
+        """Record the files as imported."""
+        self.files.update(self._key(p) for p in file_paths)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.path.with_suffix(".tmp")
+        with tmp_path.open("w") as fh:
+            json.dump(self.files, fh)
+        os.replace(tmp_path, self.path)
+
+    def clear(self) -> None:
+        """Forget all imported files."""
+        self.files = {}
+        try:
+            self.path.unlink()
+        except FileNotFoundError:
+            pass
+
+
+def state_path(config: Box, source: str, meter_id: Optional[str] = None) -> Path:
+    """Return the path of the import state of the source."""
+    name = f"{source}_{meter_id}" if meter_id else source
+    return Path(config.file_location.data_dir).expanduser() / "import" / f"{name}.json"
+
+
+def source_files(
+    data_dir: Path, source: str, meter_id: Optional[str] = None
+) -> List[Path]:
+    """Return the raw files of the source in data_dir. The raw power archive
+    holds the files of all meters, only the ones of meter_id are returned.
+    Files named as dumped by former versions don't name their meter and are
+    always returned."""
+    files = sorted(p for p in data_dir.iterdir() if p.name.startswith(PREFIXES[source]))
+    if source != "power":
+        return files
+    return [
+        p
+        for p in files
+        if p.name.startswith(f"{PREFIXES[source]}_{meter_id}_")
+        or not POWER_ARCHIVE.match(p.name)
+    ]
+
+
+def write_batch(
+    *,
+    config: Box,
+    source: str,
+    data_frames: List[pd.DataFrame],
+    meter_id: Optional[str] = None,
+    rejected: Optional[List[pd.DataFrame]] = None,
+) -> int:
+    """Merge the data of a batch of files and write it once per partition.
+    Return the number of rows.
+
+    :param rejected: the readings rejected by the validation of power data
+    """
+    if rejected:
+        df = drop_duplicates(df=pd.concat(rejected), key_columns=["reason", "values"])
+        write_data_to_pystore(
+            config=config,
+            data_frames=split_df_by_day(df=df),
+            name=f"quarantine_{meter_id}",
+            metadata={"meter_id": meter_id},
+        )
+    if not data_frames:
+        return 0
+    df = pd.concat(data_frames)
+    if source == "power":
+        if not meter_id:
+            raise ArchiveImportError("Importing power requires a meter.")
+        df = drop_duplicates(df=df)
+        name = f"power_{meter_id}"
+        write_data_to_pystore(
+            config=config,
+            data_frames=split_df_by_day(df=df),
+            name=name,
+            metadata={"meter_id": meter_id},
+        )
+        # Each file holds the readings of one fetch. The repair command skips
+        # the span of its readings.
+        add_intervals(
+            config=config,
+            name=name,
+            intervals=[
+                (to_seconds(d.index.min()), to_seconds(d.index.max()) + 1)
+                for d in data_frames
+            ],
+        )
+        statistics.invalidate_days(config, name, df.index.normalize().unique())
+        devices.invalidate_days(config, name, df.index.normalize().unique())
+        ledger.add_readings(config=config, meter_id=meter_id, df=df)
+        anomaly.update(config=config, meter_id=meter_id, df=df)
+    elif source == "awattar":
+        df = drop_duplicates(df=df)
+        write_data_frames(
+            config=config, data_frames=split_df_by_month(df=df), name="awattar"
+        )
+        ledger.add_prices(config=config, prices=df)
+    else:
+        df = drop_duplicates(df=df, key_columns=["location"])
+        append_data_frames(
+            config=config,
+            data_frames=split_df_by_month(df=df),
+            name="weather",
+            dedup_columns=["location"],
+            fill_values={"location": "default"},
+        )
+    return len(df)
+
+
+def import_files(
+    *,
+    config: Box,
+    source: str,
+    data_dir: Path,
+    meter_id: Optional[str] = None,
+    processes: Optional[int] = None,
+    batch_files: int = IMPORT_BATCH_FILES,
+    restart: bool = False,
+) -> int:
+    """Import the raw files of the source in data_dir. Return the number of files
+    imported. Files imported before are skipped unless restart is set."""
+    if source not in PREFIXES:
+        raise ArchiveImportError(f"The source {source} is unknown.")
+    fields = None
+    if source == "power":
+        if not meter_id:
+            raise ArchiveImportError("Importing power requires a meter.")
+        init_pystore(config)
+        fields = power.configured_fields(config, meter_id)
+    data_dir = data_dir.expanduser()
+    if not data_dir.is_dir():
+        raise ArchiveImportError(f"There is no directory {data_dir}.")
+    state = ImportState(path=state_path(config, source, meter_id))
+    if restart:
+        state.clear()
+    files = source_files(data_dir, source, meter_id)
+    pending = [p for p in files if not state.imported(p)]
+    if len(pending) < len(files):
+        log.info(f"Skipping {len(files) - len(pending)} files imported before.")
+    batch_files = max(1, batch_files)
+    batches = [
+        pending[i : i + batch_files] for i in range(0, len(pending), batch_files)
+    ]
+    imported = rows = 0
+    start_ts = time.time()
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+
+        def submit(batch: List[Path]) -> List[Future]:
+            return [executor.submit(parse_file, source, p, fields) for p in batch]
+
+        futures = submit(batches[0]) if batches else []
+        for i, batch in enumerate(batches):
+            data_frames, rejected, parsed = [], [], []
+            for file_path, future in zip(batch, futures):
+                try:
+                    df, validation = future.result()
+                except Exception as e:
+                    # Not recorded, the next import tries again.
+                    log.warning(f"Could not parse {file_path}: {e}")
+                    continue
+                parsed.append(file_path)
+                if len(df):
+                    data_frames.append(df)
+                if validation is not None:
+                    record_metrics(f"quarantine_{meter_id}", validation.stats)
+                    if len(validation.rejected):
+                        rejected.append(validation.rejected)
+            # Parse the next batch while this one is written.
+            futures = submit(batches[i + 1]) if i + 1 < len(batches) else []
+            rows += write_batch(
+                config=config,
+                source=source,
+                data_frames=data_frames,
+                meter_id=meter_id,
+                rejected=rejected,
+            )
+            state.add(parsed)
+            imported += len(parsed)
+            elapsed = time.time() - start_ts
+            done = sum(len(b) for b in batches[: i + 1])
+            remaining = elapsed / done * (len(pending) - done)
+            log.info(
+                f"Imported {done}/{len(pending)} files of {source} ({rows} rows) "
+                f"in {elapsed:.0f} s, {remaining:.0f} s to go."
+            )
+    if source == "power" and imported:
+        # Every day written left another parquet file.
+        compact.compact(config=config, names=[f"power_{meter_id}"])
+    return imported
+
+
+def main(config: Box) -> None:
+    """Entry point for the import sub command."""
+    arguments = docopt(__doc__.format(cmd=sys.argv[0]), argv=sys.argv[1:])
+    try:
+        processes = int(arguments["--processes"] or os.cpu_count() or 1)
+        batch_files = int(arguments["--batch"] or IMPORT_BATCH_FILES)
+    except ValueError:
+        log.error("The number of processes or files is not a number.")
+        sys.exit(1)
+    try:
+        imported = import_files(
+            config=config,
+            source=arguments["<source>"],
+            data_dir=Path(arguments["<dir>"]),
+            meter_id=arguments["--meter"],
+            processes=processes,
+            batch_files=batch_files,
+            restart=arguments["--restart"],
+        )
+    except ArchiveImportError as e:
+        log.error(f"Could not import {arguments['<source>']}: {e}")
+        sys.exit(1)
+    print(f"Imported {imported} files.")
@@ -0,0 +1,334 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Discovergy time-aligned join
+
+Align stored sources, e. g. the 1 s power data, the hourly Awattar prices and
+the irregular weather observations, onto one grid of fixed intervals::
+
+    frames = join.join(
+        config=config,
+        sources=[
+            join.Source(source="power", meter_id=meter_id, columns=["power"]),
+            join.Source(source="awattar", how="asof", limit="1h"),
+            join.Source(source="weather", how="asof", limit="3h", columns=["temp"]),
+        ],
+        date_from=pd.Timestamp("2020-03-01"),
+        date_to=pd.Timestamp("2020-04-01"),
+        freq="15min",
+    )
+    df = pd.concat(frames)
+
+A source is aligned either as the mean of its values in each interval
+[t, t + freq) or as of t, i. e. the last value at or before t that is at most
+limit old. The data is read and aligned month by month, one parquet batch or
+hdf5 file at a time, see export. Only the aligned months are held in memory.
+
+The aligned months of the grids in CACHED_GRIDS are cached in
+<data_dir>/join_cache/. A cached month is used as long as the files of its
+sources are unchanged. Data still in the journal is not joined.
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import hashlib
+import json
+import os
+
+from pathlib import Path
+from typing import Iterator, List, NamedTuple, Optional
+
+import pandas as pd  # type: ignore
+
+from box import Box  # type: ignore
+from loguru import logger as log
+
+from .export import (
+    HDF_SOURCES,
+    PYSTORE_SOURCES,
+    ExportError,
+    hdf_chunks,
+    pystore_chunks,
+)
+from .utils import (
+    data_frame_files,
+    naive_utc,
+    parquet_part_files,
+    read_parquet_files,
+    write_parquet_file,
+)
+
+
+HOWS = ("mean", "asof")
+CACHED_GRIDS = ("15min", "1h")
+
+
+class JoinError(Exception):
+    """The join is not possible as requested."""
+
+    pass
+
+
+class Source(NamedTuple):
+    source: str  # one of export.PYSTORE_SOURCES or HDF_SOURCES
+    meter_id: Optional[str] = None
+    columns: Optional[List[str]] = None  # defaults to all numeric columns
+    how: str = "mean"  # or asof
+    limit: str = "1h"  # asof: max. age of the value at t
+    location: Optional[str] = None  # weather: only this location
+    prefix: Optional[str] = None  # of the joined columns, e. g. for two meters
+
+    @property
+    def name(self) -> str:
+        return f"{self.source}_{self.meter_id}" if self.meter_id else self.source
+
+
+def grid_freq(freq: str) -> pd.Timedelta:
+    """Return the interval of the grid. Raise JoinError if days are not
+    divided evenly, i. e. a month is not a whole number of intervals."""
+    try:
+        offset = pd.tseries.frequencies.to_offset(freq)
+    except ValueError:
+        offset = None
+    if not isinstance(offset, pd.offsets.Tick):
+        raise JoinError(f"The grid {freq} is not a fixed interval.")
+    interval = pd.Timedelta(offset)
+    if pd.Timedelta(days=1) % interval:
+        raise JoinError(f"The grid {freq} does not divide a day evenly.")
+    return interval
+
+
+def check_source(source: Source) -> None:
+    """Raise JoinError if the source can't be joined."""
+    if source.how not in HOWS:
+        raise JoinError(f"The alignment {source.how} is not one of {', '.join(HOWS)}.")
+    if source.source in PYSTORE_SOURCES:
+        if not source.meter_id:
+            raise JoinError(f"Joining {source.source} requires a meter.")
+    elif source.source not in HDF_SOURCES:
+        raise JoinError(f"The source {source.source} is unknown.")
+    try:
+        pd.Timedelta(source.limit)
+    except ValueError:
+        raise JoinError(f"The limit {source.limit} is not a time span.")
+
+
+def source_files(
+    config: Box, source: Source, date_from: pd.Timestamp, date_to: pd.Timestamp
+) -> List[Path]:
+    """Return the files holding the data of the source in the time range."""
+    if source.source in HDF_SOURCES:
+        return data_frame_files(
+            config=config, name=source.name, date_from=date_from, date_to=date_to
+        )
+    collection_path = (
+        Path(config.file_location.data_dir).expanduser() / "discovergy" / source.name
+    )
+    files: List[Path] = []
+    for month in pd.period_range(date_from, date_to - pd.Timedelta(1), freq="M"):
+        item_path = collection_path / f"{month.year}-{month.month:02d}"
+        if item_path.is_dir():
+            files.extend(parquet_part_files(item_path))
+    return files
+
+
+def source_chunks(
+    config: Box, source: Source, date_from: pd.Timestamp, date_to: pd.Timestamp
+) -> Iterator[pd.DataFrame]:
+    """Yield the numeric data of the source in [date_from, date_to) in time order
+    with a naive UTC index."""
+    columns = source.columns
+    if columns and source.location:
+        columns = columns + ["location"]
+    if source.source in HDF_SOURCES:
+        chunks = hdf_chunks(
+            config=config,
+            name=source.name,
+            date_from=date_from.tz_localize("utc"),
+            date_to=date_to.tz_localize("utc"),
+            columns=columns,
+        )
+    else:
+        chunks = pystore_chunks(
+            config=config,
+            name=source.name,
+            date_from=date_from,
+            date_to=date_to,
+            columns=columns,
+        )
+    try:
+        for df in chunks:
+            if source.location:
+                df = df[df["location"] == source.location]
+            df = df.select_dtypes("number")
+            if df.index.tz is not None:
+                df = df.tz_convert(None)
+            yield df
+    except ExportError:
+        # There is no data of the source yet.
+        return
+
+
+def align_mean(chunks: Iterator[pd.DataFrame], grid: pd.DatetimeIndex) -> pd.DataFrame:
+    """Return the mean of the values in each interval of the grid."""
+    freq = grid.freq
+    sums: Optional[pd.DataFrame] = None
+    counts: Optional[pd.DataFrame] = None
+    for df in chunks:
+        if not len(df):
+            continue
+        groups = df.groupby(df.index.floor(freq))
+        chunk_sums, chunk_counts = groups.sum(), groups.count()
+        if sums is None or counts is None:
+            sums, counts = chunk_sums, chunk_counts
+        else:
+            # Intervals spanning two chunks are summed up.
+            sums = sums.add(chunk_sums, fill_value=0)
+            counts = counts.add(chunk_counts, fill_value=0)
+    if sums is None or counts is None:
+        return pd.DataFrame(index=grid)
+    return (sums / counts.where(counts > 0)).reindex(grid)
+
+
+def align_asof(
+    chunks: Iterator[pd.DataFrame], grid: pd.DatetimeIndex, limit: pd.Timedelta
+) -> pd.DataFrame:
+    """Return the last values at or before each time of the grid that are at most
+    limit old."""
+    freq = grid.freq
+    # Only the last row before each grid time can be the value as of it.
+    lasts = []
+    for df in chunks:
+        if not len(df):
+            continue
+        keys = df.index.ceil(freq)
+        lasts.append(df[~keys.duplicated(keep="last")])
+    if not lasts:
+        return pd.DataFrame(index=grid)
+    df = pd.concat(lasts)
+    df = df[~df.index.ceil(freq).duplicated(keep="last")]
+    aligned = pd.merge_asof(
+        pd.DataFrame(index=grid),
+        df,
+        left_index=True,
+        right_index=True,
+        direction="backward",
+        tolerance=limit,
+    )
+    return aligned.set_axis(grid)
+
+
+def align(
+    config: Box, source: Source, grid: pd.DatetimeIndex, date_to: pd.Timestamp
+) -> pd.DataFrame:
+    """Return the data of the source aligned onto the grid ending at date_to."""
+    if source.how == "mean":
+        df = align_mean(source_chunks(config, source, grid[0], date_to), grid)
+    else:
+        limit = pd.Timedelta(source.limit)
+        chunks = source_chunks(config, source, grid[0] - limit, grid[-1] + grid.freq)
+        df = align_asof(chunks, grid, limit)
+    if source.columns:
+        df = df.reindex(columns=source.columns)
+    if source.prefix:
+        df = df.add_prefix(f"{source.prefix}_")
+    return df
+
+
+class JoinCache:
+    """Represents the cached aligned months of a join."""
+
+    def __init__(self, *, config: Box, sources: List[Source], freq: str):
+        self.config = config
+        self.sources = sources
+        key = hashlib.sha256(
+            json.dumps([list(s) for s in sources] + [freq]).encode("utf-8")
+        ).hexdigest()
+        self.path = (
+            Path(config.file_location.data_dir).expanduser() / "join_cache" / key
+        )
+
+    def __repr__(self):
+        return f"JoinCache:{self.path.name[:8]}"
+
+    def fingerprint(self, date_from: pd.Timestamp, date_to: pd.Timestamp) -> List:
+        """Return the stats of the files the month [date_from, date_to) is read from."""
+        fingerprint = []
+        for source in self.sources:
+            lookback = pd.Timedelta(source.limit) if source.how == "asof" else None
+            start = date_from - lookback if lookback is not None else date_from
+            for file_path in source_files(self.config, source, start, date_to):
+                stat = file_path.stat()
+                fingerprint.append(
+                    [file_path.as_posix(), stat.st_size, stat.st_mtime_ns]
+                )
+        return fingerprint
+
+    def get(self, month: pd.Period, fingerprint: List) -> Optional[pd.DataFrame]:
+        """Return the cached month. None if it is not cached or stale."""
+        try:
+            with (self.path / f"{month}.json").open() as fh:
+                if json.load(fh) != fingerprint:
+                    return None
+            return read_parquet_files([self.path / f"{month}.parquet"])
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def put(self, month: pd.Period, fingerprint: List, df: pd.DataFrame) -> None:
+        """Cache the aligned month."""
+        self.path.mkdir(parents=True, exist_ok=True)
+        write_parquet_file(df, self.path / f".{month}.parquet.tmp")
+        os.replace(self.path / f".{month}.parquet.tmp", self.path / f"{month}.parquet")
+        tmp_path = self.path / f".{month}.json.tmp"
+        with tmp_path.open("w") as fh:
+            json.dump(fingerprint, fh)
+        os.replace(tmp_path, self.path / f"{month}.json")
+
+
+def join(
+    *,
+    config: Box,
+    sources: List[Source],
+    date_from: pd.Timestamp,
+    date_to: pd.Timestamp,
+    freq: str = "1h",
+    cache: bool = True,
+) -> Iterator[pd.DataFrame]:
+    """Yield the sources aligned onto the grid of freq in [date_from, date_to),
+    one month at a time. The index is naive UTC.
+
+    :param cache: use and update the cache if freq is one of CACHED_GRIDS
+    """
+    interval = grid_freq(freq)
+    for source in sources:
+        check_source(source)
+    date_from = naive_utc(date_from).floor(interval)
+    date_to = naive_utc(date_to)
+    join_cache = None
+    if cache and freq in CACHED_GRIDS:
+        join_cache = JoinCache(config=config, sources=sources, freq=freq)
+    for month in pd.period_range(date_from, date_to - pd.Timedelta(1), freq="M"):
+        month_from, month_to = month.start_time, month.end_time.ceil("D")
+        if join_cache is None:
+            # Only align the requested part of the month.
+            month_from, month_to = max(month_from, date_from), min(month_to, date_to)
+        grid = pd.date_range(month_from, month_to, freq=interval, inclusive="left")
+        if not len(grid):
+            continue
+        df = None
+        if join_cache is not None:
+            fingerprint = join_cache.fingerprint(month_from, month_to)
+            df = join_cache.get(month, fingerprint)
+        if df is None:
+            df = pd.concat([align(config, s, grid, month_to) for s in sources], axis=1)
+            if df.columns.duplicated().any():
+                raise JoinError(
+                    "The sources have columns of the same name. Set a prefix."
+                )
+            if join_cache is not None:
+                join_cache.put(month, fingerprint, df)
+        else:
+            log.debug(f"Using the cached {month} of {join_cache}.")
+        yield df[(df.index >= date_from) & (df.index < date_to)]
@@ -0,0 +1,303 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Discovergy write-ahead journal
+
+Parsed data is appended to an append-only journal on disk as soon as it is
+fetched. The journal keeps the data in memory as well and writes it in large
+batches to pystore. Journal segments are deleted only after their data has been
+written. Unflushed segments are replayed on startup.
+
+Each process owns a directory of segments in <data_dir>/journal/ and holds an
+exclusive lock on it: main, the worker id of a poller worker, or <owner>+<pid>
+if the owner's directory is in use, e. g. by a CLI command run while the
+poller runs. The segments left by a process that died are adopted by the next
+journal opened in the data directory. The ones of a poller worker are adopted
+once its heartbeat expired, see cluster. Until then it may be restarting.
+
+The metadata of a collection may list key_columns. Rows with the same index and
+key_columns are duplicates. Otherwise the index must be unique.
+
+A segment is a sequence of records. A record is a header of the payload length
+and the CRC32 of the payload followed by the pickled (name, metadata, DataFrame)
+tuple.
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import fcntl
+import os
+import pickle
+import struct
+import threading
+import time
+import zlib
+
+from collections import defaultdict
+from pathlib import Path
+from typing import IO, BinaryIO, Dict, Iterator, List, Optional, Tuple
+
+import pandas as pd  # type: ignore
+
+from box import Box  # type: ignore
+from loguru import logger as log
+
+from . import cluster, devices, statistics
+from .defaults import JOURNAL_FLUSH_INTERVAL, JOURNAL_FLUSH_ROWS
+from .utils import file_lock, split_df_by_day, write_data_to_pystore
+
+
+RECORD_HEADER = struct.Struct("<II")
+
+_journals: Dict[str, "Journal"] = {}
+
+
+class Journal:
+    """Represents the write-ahead journal in front of the pystore collections."""
+
+    def __init__(self, *, config: Box):
+        """:param config: the internal config object"""
+        self.config: Box = config
+        self.root = (Path(config.file_location.data_dir) / "journal").expanduser()
+        # Each poller worker has its own journal. A restarted worker replays it.
+        owner = config.shard.worker_id if "shard" in config else "main"
+        self._owner_lock = _try_lock(self.root / owner)
+        if self._owner_lock is None:
+            owner = f"{owner}+{os.getpid()}"
+            self._owner_lock = _try_lock(self.root / owner)
+            assert self._owner_lock is not None
+        self.path = self.root / owner
+        journal_config = config.get("journal", {})
+        self.flush_rows = int(journal_config.get("flush_rows", JOURNAL_FLUSH_ROWS))
+        self.flush_interval = int(
+            journal_config.get("flush_interval", JOURNAL_FLUSH_INTERVAL)
+        )
+        self._buffer: Dict[str, List[pd.DataFrame]] = defaultdict(list)
+        self._metadata: Dict[str, Dict] = {}
+        self._rows = 0
+        self._oldest: Optional[float] = None
+        self._segment: Optional[BinaryIO] = None
+        # The poller appends and flushes from executor threads.
+        self._lock = threading.Lock()
+        self.adopt()
+        self.replay()
+
+    def __repr__(self):
+        return f"Journal:{self.path}"
+
+    @property
+    def rows(self) -> int:
+        """Return the number of rows not yet written to pystore."""
+        return self._rows
+
+    def segments(self) -> List[Path]:
+        """Return the journal segment files in the order they were written."""
+        return sorted(self.path.glob("*.journal"))
+
+    def _open_segment(self) -> BinaryIO:
+        """Open a new segment after the last existing one."""
+        segments = self.segments()
+        seq = int(segments[-1].stem) + 1 if segments else 0
+        return (self.path / f"{seq:010d}.journal").open("ab")
+
+    def adopt(self) -> None:
+        """Move the segments left by processes that died into this journal.
+
+        These are the directories nobody holds the lock of, but the ones of
+        poller workers that did beat lately, and the segments of former
+        versions in the root."""
+        live = cluster.live_workers(self.config)
+        with file_lock(self.root / "adopt.lock"):
+            adopted = self._move(sorted(self.root.glob("*.journal")))
+            for directory in sorted(self.root.iterdir()):
+                if (
+                    directory == self.path
+                    or not directory.is_dir()
+                    or directory.name in live
+                ):
+                    continue
+                lock = _try_lock(directory)
+                if lock is None:
+                    continue
+                adopted += self._move(sorted(directory.glob("*.journal")))
+                _remove_directory(directory, lock)
+        if adopted:
+            log.info(f"Adopted {adopted} journal segments into {self}.")
+
+    def _move(self, segments: List[Path]) -> int:
+        """Move the segments after the last one of this journal in their order."""
+        own = self.segments()
+        seq = int(own[-1].stem) + 1 if own else 0
+        for i, segment in enumerate(segments):
+            os.replace(segment, self.path / f"{seq + i:010d}.journal")
+        return len(segments)
+
+    def close(self) -> None:
+        """Close the open segment and give up the journal directory."""
+        with self._lock:
+            if self._segment is not None:
+                self._segment.close()
+                self._segment = None
+            if self._owner_lock is not None:
+                self._owner_lock.close()
+                self._owner_lock = None
+
+    def append(self, *, name: str, df: pd.DataFrame, metadata: Optional[Dict] = None):
+        """Durably append the data frame for the pystore collection name."""
+        if not len(df):
+            log.debug(f"Did not find any data for {name}. Not journaling it.")
+            return
+        metadata = metadata or {}
+        payload = pickle.dumps((name, metadata, df), protocol=pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            if self._segment is None:
+                self._segment = self._open_segment()
+            self._segment.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+            self._segment.write(payload)
+            self._segment.flush()
+            os.fsync(self._segment.fileno())
+            self._add(name=name, df=df, metadata=metadata)
+
+    def _add(self, *, name: str, df: pd.DataFrame, metadata: Dict) -> None:
+        """Add the data frame to the in-memory buffer."""
+        self._buffer[name].append(df)
+        self._metadata[name] = metadata
+        self._rows += len(df)
+        if self._oldest is None:
+            self._oldest = time.time()
+
+    def replay(self) -> None:
+        """Load all unflushed segments into the in-memory buffer."""
+        records = 0
+        for segment in self.segments():
+            for name, metadata, df in read_segment(segment):
+                self._add(name=name, df=df, metadata=metadata)
+                records += 1
+        if records:
+            log.info(f"Replayed {records} records ({self._rows} rows) from {self}.")
+
+    def due(self) -> bool:
+        """Return True if the buffer should be flushed."""
+        if not self._rows:
+            return False
+        if self._rows >= self.flush_rows:
+            return True
+        return time.time() - (self._oldest or 0) >= self.flush_interval
+
+    def flush(self) -> None:
+        """Write the buffered data to pystore, one write per collection and day.
+
+        Appends during the flush go to a new segment and stay buffered.
+        """
+        with self._lock:
+            if not self._buffer:
+                return
+            # Everything in the buffer is in closed segments from now on.
+            if self._segment is not None:
+                self._segment.close()
+                self._segment = None
+            segments = self.segments()
+            buffer, metadata = self._buffer, self._metadata
+            self._buffer, self._metadata = defaultdict(list), {}
+            self._rows, self._oldest = 0, None
+        try:
+            for name in list(buffer):
+                df = drop_duplicates(
+                    df=pd.concat(buffer[name]),
+                    key_columns=metadata[name].get("key_columns"),
+                )
+                log.debug(f"Flushing {len(df)} rows of {name} from {self}.")
+                write_data_to_pystore(
+                    config=self.config,
+                    data_frames=split_df_by_day(df=df),
+                    name=name,
+                    metadata=metadata[name],
+                )
+                statistics.invalidate_days(
+                    self.config, name, df.index.normalize().unique()
+                )
+                devices.invalidate_days(
+                    self.config, name, df.index.normalize().unique()
+                )
+                del buffer[name]
+        except Exception:
+            # Keep what wasn't written. The segments are still on disk.
+            with self._lock:
+                for name, frames in buffer.items():
+                    self._buffer[name][:0] = frames
+                    self._metadata.setdefault(name, metadata[name])
+                    self._rows += sum(len(df) for df in frames)
+                self._oldest = self._oldest or time.time()
+            raise
+        for segment in segments:
+            segment.unlink()
+
+
+def _try_lock(directory: Path) -> Optional[IO]:
+    """Take the exclusive lock of the journal directory. Return the open lock
+    file holding it, None if another process holds it."""
+    directory.mkdir(parents=True, exist_ok=True)
+    fh = (directory / "lock").open("a")
+    try:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        fh.close()
+        return None
+    return fh
+
+
+def _remove_directory(directory: Path, lock: IO) -> None:
+    """Remove the journal directory once its segments are moved away."""
+    try:
+        (directory / "lock").unlink()
+        directory.rmdir()
+    except OSError as e:
+        log.debug(f"Could not remove {directory}: {e}")
+    finally:
+        lock.close()
+
+
+def drop_duplicates(
+    *, df: pd.DataFrame, key_columns: Optional[List[str]] = None
+) -> pd.DataFrame:
+    """Return df sorted by index without duplicates. The last row wins.
+
+    Rows are duplicates if their index and their key_columns are equal. Without
+    key_columns the index must be unique.
+    """
+    key_columns = [k for k in key_columns or [] if k in df]
+    if key_columns:
+        keys = pd.DataFrame({k: df[k].to_numpy() for k in key_columns})
+        keys["index"] = df.index
+        duplicated = keys.duplicated(keep="last").to_numpy()
+    else:
+        duplicated = df.index.duplicated(keep="last")
+    return df[~duplicated].sort_index(kind="mergesort")
+
+
+def read_segment(path: Path) -> Iterator[Tuple[str, Dict, pd.DataFrame]]:
+    """Yield the records of the segment. Stop at a torn or corrupt record."""
+    with path.open("rb") as fh:
+        while True:
+            header = fh.read(RECORD_HEADER.size)
+            if not header:
+                return
+            if len(header) < RECORD_HEADER.size:
+                log.warning(f"Found a torn record header in {path}. Ignoring it.")
+                return
+            length, crc = RECORD_HEADER.unpack(header)
+            payload = fh.read(length)
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                log.warning(f"Found a torn or corrupt record in {path}. Ignoring it.")
+                return
+            yield pickle.loads(payload)
+
+
+def get_journal(config: Box) -> Journal:
+    """Return the journal of the data directory. Create and replay it once."""
+    key = Path(config.file_location.data_dir).expanduser().as_posix()
+    if key not in _journals:
+        _journals[key] = Journal(config=config)
+    return _journals[key]
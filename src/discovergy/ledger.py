@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Discovergy energy cost ledger
+
+Keep the energy consumed and its cost at the Awattar market price per hour and
+meter in <data_dir>/ledger/<meter_id>.parquet. A row holds the first and the
+last energy counter reading of the hour. The kWh of an hour are the difference
+of its last reading to the last reading of the hour before, or to its first
+reading if there is no reading the hour before.
+
+The ledger is updated as data is ingested. New readings only recompute their
+hours and the hour after them, new prices only the hours they are for, so
+late readings or prices are cheap. Build the ledger of data stored before with
+rebuild.
+
+The stored energy is in Wh, see power.readings_to_df. The Awattar prices are
+in EUR/MWh.
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import os
+
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np  # type: ignore
+import pandas as pd  # type: ignore
+
+from box import Box  # type: ignore
+from loguru import logger as log
+
+from .export import ExportError, first_item_date, pystore_chunks
+from .statistics import field_scale
+from .utils import file_lock, naive_utc, read_data_frames
+
+
+LEDGER_COLUMNS = [
+    "first_time",
+    "first_energy",
+    "last_time",
+    "last_energy",
+    "kwh",
+    "marketprice",
+    "cost",
+]
+HOUR = pd.Timedelta(hours=1)
+
+
+def ledger_dir(config: Box) -> Path:
+    return Path(config.file_location.data_dir).expanduser() / "ledger"
+
+
+def ledger_path(config: Box, meter_id: str) -> Path:
+    """Return the path of the ledger of the meter."""
+    return ledger_dir(config) / f"{meter_id}.parquet"
+
+
+def read_ledger(config: Box, meter_id: str) -> pd.DataFrame:
+    """Return the hourly ledger of the meter indexed by the naive UTC hour."""
+    try:
+        return pd.read_parquet(ledger_path(config, meter_id).as_posix())
+    except FileNotFoundError:
+        return pd.DataFrame(
+            {
+                c: pd.Series(
+                    dtype="datetime64[ns]" if c.endswith("time") else "float64"
+                )
+                for c in LEDGER_COLUMNS
+            },
+            index=pd.DatetimeIndex([], name="hour"),
+        )
+
+
+def _write_ledger(file_path: Path, ledger: pd.DataFrame) -> None:
+    tmp_path = file_path.with_suffix(".tmp")
+    ledger.to_parquet(tmp_path.as_posix())
+    os.replace(tmp_path, file_path)
+
+
+def to_kwh(energy: pd.Series) -> pd.Series:
+    """Return the stored energy counter values in kWh."""
+    # The API reports the energy in 10^-10 kWh.
+    return energy * field_scale("energy") / 10**10
+
+
+def read_prices(
+    config: Box, date_from: pd.Timestamp, date_to: pd.Timestamp
+) -> pd.Series:
+    """Return the stored Awattar prices in [date_from, date_to) by naive UTC hour."""
+    df = read_data_frames(
+        config=config,
+        name="awattar",
+        date_from=date_from.tz_localize("utc"),
+        date_to=date_to.tz_localize("utc"),
+    )
+    if not len(df):
+        return pd.Series(dtype="float64")
+    prices = df["marketprice"].tz_convert(None)
+    return prices[~prices.index.duplicated(keep="last")]
+
+
+def hourly_readings(df: pd.DataFrame) -> pd.DataFrame:
+    """Return the first and last energy counter reading of each hour of df."""
+    energy = df["energy"].dropna()
+    hours = energy.index.floor("h")
+    first = ~hours.duplicated(keep="first")
+    last = ~hours.duplicated(keep="last")
+    return pd.DataFrame(
+        {
+            "first_time": energy.index[first],
+            "first_energy": energy.to_numpy()[first],
+            "last_time": energy.index[last],
+            "last_energy": energy.to_numpy()[last],
+        },
+        index=pd.DatetimeIndex(hours[first], name="hour"),
+    )
+
+
+def _recompute(
+    ledger: pd.DataFrame, hours: pd.DatetimeIndex, prices: Optional[pd.Series] = None
+) -> None:
+    """Recompute the kWh and cost of the hours of the ledger in place.
+
+    :param prices: the new prices of the hours, if any"""
+    hours = hours.intersection(ledger.index)
+    if not len(hours):
+        return
+    previous = ledger["last_energy"].reindex(hours - HOUR).to_numpy(dtype="float64")
+    first = ledger.loc[hours, "first_energy"].to_numpy(dtype="float64")
+    baseline = np.where(np.isnan(previous), first, previous)
+    last = ledger.loc[hours, "last_energy"].to_numpy(dtype="float64")
+    ledger.loc[hours, "kwh"] = to_kwh(pd.Series(last - baseline)).to_numpy()
+    if prices is not None:
+        ledger.loc[hours, "marketprice"] = prices.reindex(hours).to_numpy()
+    # EUR/MWh -> EUR/kWh
+    ledger.loc[hours, "cost"] = (
+        ledger.loc[hours, "kwh"].astype("float64")
+        * ledger.loc[hours, "marketprice"].astype("float64")
+        / 1000
+    )
+
+
+def add_readings(*, config: Box, meter_id: str, df: pd.DataFrame) -> None:
+    """Add the stored power data of the meter to its ledger."""
+    if "energy" not in df.columns or not len(df):
+        return
+    if df.index.tz is not None:
+        df = df.tz_convert(None)
+    new = hourly_readings(df.sort_index())
+    if not len(new):
+        return
+    file_path = ledger_path(config, meter_id)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    with file_lock(file_path.with_suffix(".lock")):
+        ledger = read_ledger(config, meter_id)
+        old = ledger.reindex(new.index)
+        # Keep the earlier first and the later last reading of an hour.
+        earlier = (old["first_time"] < new["first_time"]).to_numpy()
+        later = (old["last_time"] > new["last_time"]).to_numpy()
+        new.loc[earlier, ["first_time", "first_energy"]] = old.loc[
+            earlier, ["first_time", "first_energy"]
+        ].to_numpy()
+        new.loc[later, ["last_time", "last_energy"]] = old.loc[
+            later, ["last_time", "last_energy"]
+        ].to_numpy()
+        new = new.reindex(columns=LEDGER_COLUMNS)
+        new["marketprice"] = old["marketprice"]
+        ledger = pd.concat([ledger[~ledger.index.isin(new.index)], new]).sort_index()
+        # The kWh of the hour after a changed hour depend on it.
+        hours = new.index.union(new.index + HOUR)
+        missing_prices = hours[ledger["marketprice"].reindex(hours).isna().to_numpy()]
+        prices = None
+        if len(missing_prices):
+            prices = read_prices(config, missing_prices[0], missing_prices[-1] + HOUR)
+            prices = prices.reindex(hours).fillna(ledger["marketprice"].reindex(hours))
+        _recompute(ledger, hours, prices)
+        _write_ledger(file_path, ledger)
+
+
+def add_prices(*, config: Box, prices: pd.DataFrame) -> None:
+    """Update the cost in the ledgers of all meters for the new Awattar prices."""
+    if not len(prices) or not ledger_dir(config).is_dir():
+        return
+    marketprice = prices["marketprice"]
+    if marketprice.index.tz is not None:
+        marketprice = marketprice.tz_convert(None)
+    marketprice = marketprice[~marketprice.index.duplicated(keep="last")]
+    for file_path in sorted(ledger_dir(config).glob("*.parquet")):
+        with file_lock(file_path.with_suffix(".lock")):
+            ledger = read_ledger(config, file_path.stem)
+            hours = marketprice.index.intersection(ledger.index)
+            if not len(hours):
+                continue
+            _recompute(ledger, pd.DatetimeIndex(hours), marketprice)
+            _write_ledger(file_path, ledger)
+
+
+def daily(ledger: pd.DataFrame) -> pd.DataFrame:
+    """Return the kWh and cost per UTC day of the hourly ledger."""
+    df = ledger[["kwh", "cost"]].astype("float64")
+    return df.groupby(df.index.floor("D")).sum(min_count=1).rename_axis("day")
+
+
+def rebuild(
+    *,
+    config: Box,
+    meter_id: str,
+    date_from: Optional[pd.Timestamp] = None,
+    date_to: Optional[pd.Timestamp] = None,
+) -> int:
+    """Add the stored power data of the meter to its ledger one batch at a time.
+    Return the number of hours in the ledger."""
+    name = f"power_{meter_id}"
+    date_from = naive_utc(date_from or first_item_date(config, name) or 0)
+    date_to = naive_utc(date_to or pd.Timestamp.utcnow())
+    chunks: List[pd.DataFrame] = []
+    try:
+        for df in pystore_chunks(
+            config=config,
+            name=name,
+            date_from=date_from,
+            date_to=date_to,
+            columns=["energy"],
+        ):
+            chunks.append(df)
+            # One write per about a day of 1 s data
+            if sum(len(c) for c in chunks) >= 86400:
+                add_readings(config=config, meter_id=meter_id, df=pd.concat(chunks))
+                chunks = []
+    except ExportError:
+        log.warning(f"There is no stored power data of {meter_id}.")
+    if chunks:
+        add_readings(config=config, meter_id=meter_id, df=pd.concat(chunks))
+    return len(read_ledger(config, meter_id))
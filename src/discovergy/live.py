@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Discovergy live mode
+
+Poll the last reading of all meters every few seconds and fan out new readings
+to in-process subscribers. Each meter costs one last_reading request per cycle
+over its own keep-alive session. Readings with an already seen timestamp are
+suppressed.
+
+Other sources publish their new data as SourceUpdate. Subscribe via::
+
+    queue = live.publisher.subscribe()
+    while True:
+        reading = await queue.get()
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import asyncio
+
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, NamedTuple, Optional, Set
+
+import pandas as pd  # type: ignore
+
+from loguru import logger as log
+
+from .api import DiscovergyMeter
+from .defaults import LIVE_MAX_THREADS, LIVE_QUEUE_SIZE
+
+
+class LiveReading(NamedTuple):
+    meter_id: str
+    timestamp: int  # ms since epoch as returned by Discovergy
+    values: Dict[str, int]
+
+
+class SourceUpdate(NamedTuple):
+    source: str  # awattar or weather
+    data: pd.DataFrame
+
+
+class Publisher:
+    """Fan out published items to all subscribed asyncio queues.
+
+    A slow subscriber never blocks the publisher. If its queue is full the
+    oldest item is dropped. The queues belong to the event loop of the
+    subscribers. Items published from other threads, e. g. the executor
+    threads fetching data, are handed over to that loop.
+    """
+
+    def __init__(self, maxsize: int = LIVE_QUEUE_SIZE):
+        self.maxsize = maxsize
+        self._subscribers: Set[asyncio.Queue] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def subscribe(self, maxsize: Optional[int] = None) -> asyncio.Queue:
+        """Return a new queue receiving all published items. Call it on the
+        event loop reading the queue."""
+        self._loop = asyncio.get_event_loop()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize or self.maxsize)
+        self._subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        """Stop publishing to the queue."""
+        self._subscribers.discard(queue)
+
+    def publish(self, item) -> None:
+        """Put the item into all subscribed queues. Safe to call from any thread."""
+        loop = self._loop
+        if loop is None:
+            return
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._put(item)
+        elif not loop.is_closed():
+            # asyncio queues are not thread-safe.
+            loop.call_soon_threadsafe(self._put, item)
+
+    def _put(self, item) -> None:
+        for queue in self._subscribers:
+            if queue.full():
+                queue.get_nowait()
+                log.debug("Dropped the oldest item of a slow live subscriber.")
+            queue.put_nowait(item)
+
+
+publisher = Publisher()
+
+
+class LivePoller:
+    """Poll last_reading for the given meters and publish new readings."""
+
+    def __init__(self, *, meters: Dict[str, DiscovergyMeter], publisher: Publisher):
+        self.meters = meters
+        self.publisher = publisher
+        self.last_seen: Dict[str, int] = {}
+        # Meters are polled in parallel so one slow meter doesn't delay the
+        # others, but a worker with many meters doesn't get a thread for each.
+        self.executor = ThreadPoolExecutor(
+            max_workers=max(1, min(len(meters), LIVE_MAX_THREADS)),
+            thread_name_prefix="live",
+        )
+
+    async def poll(self) -> List[LiveReading]:
+        """Fetch the last reading of all meters concurrently and publish new ones."""
+        loop = asyncio.get_event_loop()
+        meter_ids = list(self.meters)
+        results = await asyncio.gather(
+            *(
+                loop.run_in_executor(self.executor, self.meters[m].last_reading)
+                for m in meter_ids
+            ),
+            return_exceptions=True,
+        )
+        readings = []
+        for meter_id, result in zip(meter_ids, results):
+            if isinstance(result, BaseException):
+                log.warning(f"Could not fetch the last reading of {meter_id}: {result}")
+                continue
+            reading = self.parse(meter_id=meter_id, data=result)
+            if reading is None:
+                continue
+            readings.append(reading)
+            self.publisher.publish(reading)
+        return readings
+
+    def parse(self, *, meter_id: str, data: Dict) -> Optional[LiveReading]:
+        """Return the reading unless its timestamp was seen already."""
+        try:
+            timestamp = int(data["time"])
+            values = data["values"]
+        except (KeyError, TypeError, ValueError):
+            log.warning(f"Got an invalid last reading for {meter_id}: {data}")
+            return None
+        if self.last_seen.get(meter_id, 0) >= timestamp:
+            return None
+        self.last_seen[meter_id] = timestamp
+        return LiveReading(meter_id=meter_id, timestamp=timestamp, values=values)
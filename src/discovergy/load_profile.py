@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""Fetch the load profiles of the meters
+
+Usage:
+   {cmd} load_profile [--from=<date>] [--to=<date>] [--meter=<meter_id>...] [--raw]
+   {cmd} load_profile -h | --help
+
+Options:
+   --from=<date>          First day to fetch as ISO 8601 date. Defaults to the watermark.
+   --to=<date>            Fetch up to this day (exclusive). Defaults to today.
+   --meter=<meter_id>     Only fetch the given meters. Defaults to all configured meters.
+   --raw                  Also archive the raw load profile files as sent by the meters.
+   -h, --help
+
+The load profiles are stored in the Pystore collections load_profile_<meter_id>.
+Long time ranges are fetched page by page.
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import gzip
+import sys
+
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import arrow  # type: ignore
+import pandas as pd  # type: ignore
+
+from box import Box  # type: ignore
+from docopt import docopt  # type: ignore
+from loguru import logger as log
+
+from .api import DiscovergyMeter
+from .coverage import add_coverage
+from .defaults import LOAD_PROFILE_PAGE_DAYS
+from .journal import get_journal
+from .power import get_meters
+from .utils import init_pystore, naive_utc, read_watermark, write_watermark
+
+
+def pages(
+    date_from: pd.Timestamp, date_to: pd.Timestamp, days: int = LOAD_PROFILE_PAGE_DAYS
+) -> Iterator[Tuple[pd.Timestamp, pd.Timestamp]]:
+    """Yield (from, to) day aligned pages covering [date_from, date_to)."""
+    page_from = date_from.floor("D")
+    while page_from < date_to:
+        page_to = min(page_from + pd.Timedelta(days=days), date_to.ceil("D"))
+        yield page_from, page_to
+        page_from = page_to
+
+
+def load_profile_to_df(*, data: List[Dict]) -> pd.DataFrame:
+    """Return the load profile as a Pandas DataFrame with one typed column per
+    register.
+
+    Registers missing in a reading or null are NaN. All columns are float64 so
+    every page has the same schema.
+    """
+    if not data:
+        return pd.DataFrame()
+    index = pd.to_datetime([r["time"] for r in data], unit="ms")
+    df = pd.DataFrame.from_records([r["values"] for r in data], index=index)
+    df = df[sorted(df.columns)].astype("float64")
+    return df[~df.index.duplicated(keep="last")].sort_index()
+
+
+def get(
+    *,
+    config: Box,
+    meters: Dict[str, DiscovergyMeter],
+    date_from: Optional[pd.Timestamp] = None,
+    date_to: Optional[pd.Timestamp] = None,
+    raw: bool = False,
+) -> None:
+    """Fetch the load profiles of the meters page by page and journal them.
+
+    Without date_from a meter is fetched from its watermark or, if there is none,
+    from LOAD_PROFILE_PAGE_DAYS days ago. date_to defaults to the start of today.
+    """
+    today = naive_utc(pd.Timestamp.utcnow()).floor("D")
+    date_to = naive_utc(date_to) if date_to is not None else today
+    for meter_id, meter in meters.items():
+        name = f"load_profile_{meter_id}"
+        start = date_from or read_watermark(config=config, name=name)
+        if start is None:
+            start = today - pd.Timedelta(days=LOAD_PROFILE_PAGE_DAYS)
+        start = naive_utc(start)
+        for page_from, page_to in pages(start, date_to):
+            log.info(f"Fetching the load profile of {meter_id} {page_from}-{page_to}")
+            ts_from, ts_to = int(page_from.timestamp()), int(page_to.timestamp())
+            data = meter.load_profile(ts_from=ts_from, ts_to=ts_to)
+            get_journal(config).append(
+                name=name,
+                df=load_profile_to_df(data=data),
+                metadata={"meter_id": meter_id},
+            )
+            add_coverage(
+                config=config, name=name, date_from=page_from, date_to=page_to
+            )
+            if raw:
+                archive_raw_load_profile(
+                    config=config,
+                    meter_id=meter_id,
+                    date_from=page_from,
+                    date_to=page_to,
+                    data=meter.raw_load_profile(ts_from=ts_from, ts_to=ts_to),
+                )
+            if date_from is None:
+                write_watermark(
+                    config=config, name=name, timestamp=page_to.tz_localize("utc")
+                )
+
+
+def archive_raw_load_profile(
+    *,
+    config: Box,
+    meter_id: str,
+    date_from: pd.Timestamp,
+    date_to: pd.Timestamp,
+    data: str,
+) -> None:
+    """Write the raw load profile file of the page [date_from, date_to) gz-iped
+    to the data dir. A page fetched again replaces its file only."""
+    file_path = (
+        Path(config.file_location.data_dir).expanduser()
+        / "raw_load_profile"
+        / meter_id
+        / f"{date_from:%Y-%m-%d}_{date_to:%Y-%m-%d}.txt.gz"
+    )
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    with gzip.open(file_path.as_posix(), "wt") as fh:
+        fh.write(data)
+
+
+def main(config: Box) -> None:
+    """Entry point for the load_profile sub command."""
+    arguments = docopt(__doc__.format(cmd=sys.argv[0]), argv=sys.argv[1:])
+    date_from = date_to = None
+    if arguments["--from"]:
+        date_from = pd.Timestamp(arrow.get(arguments["--from"]).datetime)
+    if arguments["--to"]:
+        date_to = pd.Timestamp(arrow.get(arguments["--to"]).datetime)
+    init_pystore(config)
+    meters = get_meters(config)
+    if arguments["--meter"]:
+        meters = {k: v for k, v in meters.items() if k in arguments["--meter"]}
+    get(
+        config=config,
+        meters=meters,
+        date_from=date_from,
+        date_to=date_to,
+        raw=arguments["--raw"],
+    )
+    get_journal(config).flush()
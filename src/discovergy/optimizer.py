@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+"""Find the cheapest start time for a consumption profile
+
+Usage:
+   {cmd} plan --profile=<kWh> [--resolution=<resolution>] [--from=<date>] [--deadline=<date>]
+   {cmd} plan -h | --help
+
+Options:
+   --profile=<kWh>             Comma separated kWh per time slot, e. g. 0.5,1.2,0.3
+   --resolution=<resolution>   Length of a time slot of the profile: 15min or 1h [default: 15min]
+   --from=<date>               Earliest start as ISO 8601 date. Defaults to now.
+   --deadline=<date>           The profile must be finished by then. Defaults to 24 h from the start.
+   -h, --help
+
+The prices are read from the stored Awattar data.
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import sys
+
+from functools import lru_cache
+from pathlib import Path
+from typing import NamedTuple, Optional, Sequence, Tuple
+
+import arrow  # type: ignore
+import numpy as np  # type: ignore
+import pandas as pd  # type: ignore
+
+from box import Box  # type: ignore
+from docopt import docopt  # type: ignore
+from loguru import logger as log
+
+from .defaults import PLAN_HORIZON
+from .utils import data_frame_files
+
+
+RESOLUTIONS = {"15min": pd.Timedelta(minutes=15), "1h": pd.Timedelta(hours=1)}
+
+# (path, mtime, size) of each Awattar file. Changes whenever new prices are stored.
+PriceSnapshot = Tuple[Tuple[str, int, int], ...]
+
+
+class Plan(NamedTuple):
+    start: pd.Timestamp
+    end: pd.Timestamp
+    cost: float  # EUR
+    energy: float  # kWh
+    cost_at_earliest: float  # EUR if started at the earliest possible time
+
+
+def cheapest_start(
+    *,
+    prices: pd.Series,
+    profile: Sequence[float],
+    resolution: str = "15min",
+    earliest: pd.Timestamp,
+    deadline: pd.Timestamp,
+) -> Optional[Plan]:
+    """Return the start time with the minimum cost for the profile.
+
+    :param prices: Awattar market prices in EUR/MWh indexed by the start of their hour
+    :param profile: kWh per time slot of length resolution
+    :param earliest: do not start before
+    :param deadline: the profile must be finished by then
+
+    The cost of all start slots is one sliding window dot product of the slot
+    prices and the profile.
+    """
+    step = RESOLUTIONS[resolution]
+    weights = np.asarray(profile, dtype="float64")
+    if not len(prices) or not len(weights):
+        return None
+    # Prices are valid for one hour. Spread them over the slots.
+    last_slot = min(deadline, prices.index[-1] + pd.Timedelta(hours=1)) - step
+    slots = pd.date_range(earliest.ceil(step), last_slot, freq=step)
+    if len(slots) < len(weights):
+        log.warning("The prices don't cover the profile before the deadline.")
+        return None
+    slot_prices = prices.sort_index().reindex(slots, method="ffill").to_numpy()
+    # EUR/MWh -> EUR/kWh
+    slot_prices = slot_prices / 1000
+    costs = np.convolve(slot_prices, weights[::-1], mode="valid")
+    costs[np.isnan(costs)] = np.inf
+    best = int(np.argmin(costs))
+    if not np.isfinite(costs[best]):
+        return None
+    return Plan(
+        start=slots[best],
+        end=slots[best] + len(weights) * step,
+        cost=float(costs[best]),
+        energy=float(weights.sum()),
+        cost_at_earliest=float(costs[0]),
+    )
+
+
+def price_snapshot(
+    *, config: Box, date_from: pd.Timestamp, date_to: pd.Timestamp
+) -> PriceSnapshot:
+    """Return a key identifying the currently stored prices of the time range."""
+    snapshot = []
+    for path in data_frame_files(
+        config=config, name="awattar", date_from=date_from, date_to=date_to
+    ):
+        stat = path.stat()
+        snapshot.append((path.as_posix(), stat.st_mtime_ns, stat.st_size))
+    return tuple(snapshot)
+
+
+@lru_cache(maxsize=8)
+def load_prices(snapshot: PriceSnapshot) -> pd.Series:
+    """Return the Awattar prices of the files in the snapshot."""
+    data_frames = [pd.read_hdf(Path(path), "awattar") for path, _, _ in snapshot]
+    if not data_frames:
+        return pd.Series(dtype="float64")
+    df = pd.concat(data_frames).sort_index()
+    return df.loc[~df.index.duplicated(keep="last"), "marketprice"]
+
+
+@lru_cache(maxsize=256)
+def _cached_plan(
+    snapshot: PriceSnapshot,
+    profile: Tuple[float, ...],
+    resolution: str,
+    earliest: pd.Timestamp,
+    deadline: pd.Timestamp,
+) -> Optional[Plan]:
+    return cheapest_start(
+        prices=load_prices(snapshot),
+        profile=profile,
+        resolution=resolution,
+        earliest=earliest,
+        deadline=deadline,
+    )
+
+
+def plan(
+    *,
+    config: Box,
+    profile: Sequence[float],
+    resolution: str = "15min",
+    earliest: Optional[pd.Timestamp] = None,
+    deadline: Optional[pd.Timestamp] = None,
+) -> Optional[Plan]:
+    """Return the cheapest plan for the profile based on the stored Awattar prices.
+
+    Plans are cached per price snapshot. Repeated queries don't touch the disk
+    unless new prices were stored."""
+    if resolution not in RESOLUTIONS:
+        raise ValueError(
+            f"The resolution {resolution} is not one of {', '.join(RESOLUTIONS)}."
+        )
+    if earliest is None:
+        earliest = pd.Timestamp.utcnow()
+    # Make queries within one time slot share the cache
+    earliest = earliest.ceil(RESOLUTIONS[resolution])
+    if deadline is None:
+        deadline = earliest + pd.Timedelta(seconds=PLAN_HORIZON)
+    snapshot = price_snapshot(
+        config=config,
+        date_from=earliest - pd.Timedelta(hours=1),
+        date_to=deadline,
+    )
+    return _cached_plan(snapshot, tuple(profile), resolution, earliest, deadline)
+
+
+def main(config: Box) -> None:
+    """Entry point for the plan sub command."""
+    arguments = docopt(__doc__.format(cmd=sys.argv[0]), argv=sys.argv[1:])
+    try:
+        profile = [float(e) for e in arguments["--profile"].split(",")]
+    except ValueError:
+        log.error(f"Could not parse the profile {arguments['--profile']}.")
+        sys.exit(1)
+    earliest = deadline = None
+    if arguments["--from"]:
+        earliest = pd.Timestamp(arrow.get(arguments["--from"]).datetime)
+    if arguments["--deadline"]:
+        deadline = pd.Timestamp(arrow.get(arguments["--deadline"]).datetime)
+    try:
+        result = plan(
+            config=config,
+            profile=profile,
+            resolution=arguments["--resolution"],
+            earliest=earliest,
+            deadline=deadline,
+        )
+    except ValueError as e:
+        log.error(str(e))
+        sys.exit(1)
+    if result is None:
+        print("Could not find a start time. Are there Awattar prices for that range?")
+        sys.exit(1)
+    saving = result.cost_at_earliest - result.cost
+    print(f"Start:  {arrow.get(result.start.to_pydatetime()).to('local')}")
+    print(f"End:    {arrow.get(result.end.to_pydatetime()).to('local')}")
+    print(f"Energy: {result.energy:.3f} kWh")
+    print(f"Cost:   {result.cost:.4f} EUR")
+    print(f"Saving: {saving:.4f} EUR compared to the earliest start")
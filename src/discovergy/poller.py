@@ -11,38 +11,69 @@ __copyright__ = "Frank Becker"
 __license__ = "mit"
 
 import asyncio
+import functools
 import re
 import sys
 
 from datetime import timedelta
-from pathlib import Path
+from typing import List
 
 import arrow  # type: ignore
-import pystore
 
 from box import Box  # type: ignore
 from loguru import logger as log
 
-from . import awattar, power, weather
+from . import (
+    anomaly,
+    awattar,
+    cluster,
+    compact,
+    disaggregation,
+    hot_cache,
+    live,
+    load_profile,
+    power,
+    rules,
+    weather,
+)
 from .config import read_config
-from .utils import start_logging
+from .defaults import CLUSTER_HEARTBEAT, RULE_PRICES_INTERVAL, RULE_TICK
+from .journal import get_journal
+from .utils import init_pystore, start_logging
 
 
 async def discovergy_meter_read_task(
     *, config: Box, loop: asyncio.base_events.BaseEventLoop,
 ) -> None:
-    """Async worker to poll the Discovergy API."""
-    meters = power.get_meters(config)
+    """Async worker to poll the Discovergy API.
+
+    The requests based client runs in the default executor so the other tasks,
+    e. g. the live mode, keep running while the raw history is fetched."""
+    meters = await loop.run_in_executor(None, power.get_meters, config)
     read_interval = timedelta(seconds=int(config.poll.discovergy))
+    # The hot cache is filled from pystore. Flush the replayed journal first.
+    try:
+        await loop.run_in_executor(None, get_journal(config).flush)
+        await loop.run_in_executor(
+            None,
+            functools.partial(hot_cache.warm, config=config, meter_ids=list(meters)),
+        )
+    except Exception as e:
+        log.warning(f"Could not fill the hot cache: {e}")
     date_to = arrow.utcnow()
     date_from = date_to - read_interval
     log.debug(f"The Discovergy read interval is {read_interval}.")
     while loop.is_running():
         try:
-            # FIXME (a8): This isn't an async call yet because we use requests. OTHO, this doesn't
-            # really matter ATM. We only call Discovergy every few hours.
-            power.get(
-                config=config, meters=meters, date_from=date_from, date_to=date_to
+            await loop.run_in_executor(
+                None,
+                functools.partial(
+                    power.get,
+                    config=config,
+                    meters=meters,
+                    date_from=date_from,
+                    date_to=date_to,
+                ),
             )
         except Exception as e:
             log.warning(
@@ -55,10 +86,214 @@ async def discovergy_meter_read_task(
             date_to = arrow.utcnow()
 
 
+async def discovergy_disaggregation_read_task(
+    *, config: Box, loop: asyncio.base_events.BaseEventLoop,
+) -> None:
+    """Async worker to poll the disaggregation and activities of the meters."""
+    read_interval = timedelta(
+        seconds=int(config.poll.get("disaggregation", config.poll.discovergy))
+    )
+    meters = await loop.run_in_executor(None, power.get_meters, config)
+    log.debug(f"The Discovergy disaggregation read interval is {read_interval}.")
+    while loop.is_running():
+        try:
+            await loop.run_in_executor(
+                None,
+                functools.partial(
+                    disaggregation.get,
+                    config=config,
+                    meters=meters,
+                    initial=read_interval,
+                ),
+            )
+        except Exception as e:
+            log.warning(
+                "Error in Discovergy disaggregation poller. Retrying in 15 seconds. "
+                "{}".format(str(e))
+            )
+            await asyncio.sleep(15)
+        else:
+            await asyncio.sleep(read_interval.total_seconds())
+
+
+async def discovergy_load_profile_read_task(
+    *, config: Box, loop: asyncio.base_events.BaseEventLoop,
+) -> None:
+    """Async worker to fetch the load profiles of the meters since their watermark."""
+    read_interval = timedelta(seconds=int(config.poll.get("load_profile", 86400)))
+    meters = await loop.run_in_executor(None, power.get_meters, config)
+    log.debug(f"The Discovergy load profile read interval is {read_interval}.")
+    while loop.is_running():
+        try:
+            await loop.run_in_executor(
+                None, functools.partial(load_profile.get, config=config, meters=meters)
+            )
+        except Exception as e:
+            log.warning(
+                "Error in Discovergy load profile poller. Retrying in 15 seconds. "
+                "{}".format(str(e))
+            )
+            await asyncio.sleep(15)
+        else:
+            await asyncio.sleep(read_interval.total_seconds())
+
+
+async def discovergy_live_read_task(
+    *, config: Box, loop: asyncio.base_events.BaseEventLoop,
+) -> None:
+    """Async worker to poll the last readings and publish them to live.publisher.
+    The new readings are passed on to the anomaly detector.
+
+    Disabled if the poll interval live is not set or 0."""
+    read_interval = float(config.poll.get("live", 0) or 0)
+    if read_interval <= 0:
+        log.debug("The Discovergy live mode is disabled.")
+        return
+    meters = await loop.run_in_executor(None, power.get_meters, config)
+    live_poller = live.LivePoller(meters=meters, publisher=live.publisher)
+    log.debug(f"The Discovergy live read interval is {read_interval} s.")
+    while loop.is_running():
+        try:
+            readings = await live_poller.poll()
+            if readings:
+                await loop.run_in_executor(
+                    None,
+                    functools.partial(
+                        anomaly.add_live_readings, config=config, readings=readings
+                    ),
+                )
+        except Exception as e:
+            log.warning(
+                "Error in Discovergy live poller. Retrying in 15 seconds. {}".format(
+                    str(e)
+                )
+            )
+            await asyncio.sleep(15)
+        else:
+            await asyncio.sleep(read_interval)
+
+
+async def rules_task(
+    *, config: Box, loop: asyncio.base_events.BaseEventLoop,
+) -> None:
+    """Async worker to evaluate the rules on every published update.
+
+    The live readings of all configs of the worker are published, so the rules
+    run in the first config only."""
+    if "shard" in config and not config.shard.primary:
+        return
+    rule_list = rules.load_rules(config)
+    if not rule_list:
+        log.debug("No rules configured.")
+        return
+    engine = rules.RuleEngine(rule_list)
+    inputs = rules.RuleInputs()
+    queue = live.publisher.subscribe()
+    prices_read = None
+    log.debug(f"Evaluating the rules {', '.join(r.name for r in rule_list)}.")
+    while loop.is_running():
+        if prices_read is None or loop.time() - prices_read >= RULE_PRICES_INTERVAL:
+            try:
+                inputs.add_prices(
+                    await loop.run_in_executor(None, rules.stored_prices, config)
+                )
+            except Exception as e:
+                log.warning(f"Could not read the stored Awattar prices: {e}")
+            prices_read = loop.time()
+        try:
+            item = await asyncio.wait_for(queue.get(), timeout=RULE_TICK)
+        except asyncio.TimeoutError:
+            item = None
+        try:
+            values = inputs.from_item(item)
+            values.update(inputs.current())
+            for rule in engine.update(values):
+                asyncio.ensure_future(rules.run_action(rule, dict(engine.values)))
+        except Exception as e:
+            log.warning(f"Error in the rule engine: {e}")
+
+
+async def journal_flush_task(
+    *, config: Box, loop: asyncio.base_events.BaseEventLoop,
+) -> None:
+    """Async worker to flush the journal to pystore in large batches."""
+    journal = get_journal(config)
+    check_interval = min(60, journal.flush_interval)
+    log.debug(f"Flushing {journal} every {journal.flush_interval} s.")
+    while loop.is_running():
+        try:
+            if journal.due():
+                await loop.run_in_executor(None, journal.flush)
+        except Exception as e:
+            log.warning(
+                "Error in journal flusher. Retrying in 15 seconds. {}".format(str(e))
+            )
+            await asyncio.sleep(15)
+        else:
+            await asyncio.sleep(check_interval)
+
+
+async def storage_compact_task(
+    *, config: Box, loop: asyncio.base_events.BaseEventLoop,
+) -> None:
+    """Async worker to compact the stored data.
+
+    Disabled if the poll interval compact is not set or 0."""
+    read_interval = float(config.poll.get("compact", 0) or 0)
+    if read_interval <= 0 or not cluster.owns(config, "compact", account=False):
+        return
+    log.debug(f"Compacting the stored data every {read_interval} s.")
+    while loop.is_running():
+        try:
+            await loop.run_in_executor(
+                None, functools.partial(compact.compact, config=config)
+            )
+        except Exception as e:
+            log.warning(
+                "Error in the storage compaction. Retrying in 15 seconds. {}".format(
+                    str(e)
+                )
+            )
+            await asyncio.sleep(15)
+        else:
+            await asyncio.sleep(read_interval)
+
+
+async def cluster_heartbeat_task(
+    *, config: Box, loop: asyncio.base_events.BaseEventLoop,
+) -> None:
+    """Async worker to keep a poller worker in the cluster. See supervisor.
+
+    Stops the loop if the live workers changed so the supervisor restarts the
+    worker with its new shard."""
+    if "shard" not in config or not config.shard.primary:
+        return
+    worker_id = config.shard.worker_id
+    membership = cluster.Membership(config=config, worker_id=worker_id)
+    members = frozenset(config.shard.members)
+    while loop.is_running():
+        try:
+            membership.beat()
+            live_members = membership.live() | {worker_id}
+        except Exception as e:
+            log.warning(f"Error in the cluster heartbeat: {e}")
+        else:
+            if live_members != members:
+                log.info(
+                    f"The poller workers changed to {', '.join(sorted(live_members))}. "
+                    f"Restarting {worker_id} to rebalance the meters."
+                )
+                loop.stop()
+                return
+        await asyncio.sleep(CLUSTER_HEARTBEAT)
+
+
 async def awattar_read_task(
     *, config: Box, loop: asyncio.base_events.BaseEventLoop,
 ) -> None:
     """Async worker to poll the Open Weather Map API."""
+    if not cluster.owns(config, "awattar", account=False):
+        return
     read_interval = timedelta(seconds=int(config.poll.awattar))
     log.debug(f"The Awattar read interval is {read_interval}.")
     while loop.is_running():
@@ -79,6 +314,8 @@ async def open_weather_map_read_task(
     *, config: Box, loop: asyncio.base_events.BaseEventLoop,
 ) -> None:
     """Async worker to poll the Open Weather Map API."""
+    if not cluster.owns(config, "weather", account=False):
+        return
     read_interval = timedelta(seconds=int(config.poll.weather))
     log.debug(f"The Open Weather Map read interval is {read_interval}.")
     while loop.is_running():
@@ -98,21 +335,31 @@ async def open_weather_map_read_task(
 
 def main(config: Box) -> None:
     """Entry point for the data poller."""
+    run([config])
+
+
+def run(configs: List[Box]) -> None:
+    """Run the tasks of all configs, e. g. accounts, on one event loop."""
     loop = asyncio.get_event_loop()
     # Set pystore directory
-    pystore.set_path(Path(config.file_location.data_dir).expanduser().as_posix())
+    init_pystore(configs[0])
     # Add all tasks to the event loop.
     task_match = re.compile(r"^.*_task$")
-    for attr in globals().keys():
-        if task_match.match(attr):
-            asyncio.ensure_future(globals()[attr](config=config, loop=loop))
+    for config in configs:
+        for attr in list(globals().keys()):
+            if task_match.match(attr):
+                asyncio.ensure_future(globals()[attr](config=config, loop=loop))
     try:
         loop.run_forever()
     except KeyboardInterrupt:
         log.info("Polling Discovergy and friends was ended by <Ctrl>+<C>.")
+        get_journal(configs[0]).flush()
         sys.exit(0)
     except Exception as e:
         log.error(f"While running the poller event loop we caught {e}.")
+    else:
+        # The loop was stopped, e. g. to rebalance the poller workers.
+        get_journal(configs[0]).flush()
     finally:
         log.info("Closing event loop")
         loop.close()
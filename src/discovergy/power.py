@@ -4,6 +4,11 @@
 
 Discovergy Power Meters module
 
+Only the fields listed for a meter in the [fields] section are fetched and
+stored, e. g.::
+
+    [fields]
+    <meter_id>: power, energy, energyOut
 """
 __author__ = "Frank Becker <fb@alien8.de>"
 __copyright__ = "Frank Becker"
@@ -11,38 +16,64 @@ __license__ = "mit"
 
 import sys
 
-from collections import defaultdict
-from typing import Dict, List
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
 
 import arrow  # type: ignore
 import pandas as pd  # type: ignore
-import schema  # type: ignore
 
 from box import Box  # type: ignore
 from loguru import logger as log
 from tenacity import retry, stop_after_attempt, stop_after_delay, wait_exponential  # type: ignore
 
+from . import anomaly, cluster, hot_cache, ledger
 from .api import DiscovergyMeter, describe_meters, save_meters
-from .utils import before_log, split_df_by_day, write_data_frames, write_data_to_pystore
-
-
-ValueSchema = schema.Schema(
-    {
-        "energyOut": int,
-        "energy2": int,
-        "energy1": int,
-        "voltage1": int,
-        "voltage2": int,
-        "voltage3": int,
-        "energyOut1": int,
-        "power": int,
-        "energyOut2": int,
-        "power3": int,
-        "power1": int,
-        "energy": int,
-        "power2": int,
-    }
-)
+from .archive import raw_archive_writer
+from .coverage import add_coverage
+from .journal import get_journal
+from .statistics import field_scale
+from .utils import before_log
+from .validation import FIELDS, quarantine, validate_readings
+
+
+def fetch(
+    *,
+    config: Box,
+    meter: DiscovergyMeter,
+    date_from: arrow.Arrow,
+    date_to: arrow.Arrow,
+) -> pd.DataFrame:
+    """Fetch the readings of the meter, journal them and record the coverage.
+    Return the readings as stored.
+
+    The raw readings are archived if configured, see archive."""
+    meter_id = meter.meter_id
+    log.info(f"Fetching data for meter {meter_id}...")
+    data = meter.readings(
+        field_names=meter.fields,
+        ts_from=int(date_from.timestamp()),
+        ts_to=int(date_to.timestamp()),
+        resolution="raw",
+    )
+    log.info(
+        f"To get data for meter {meter_id} took {meter.last_query_duration:.3f} s."
+    )
+    writer = raw_archive_writer(config, f"discovergy_data_{meter_id}")
+    if writer is not None:
+        writer.write(data)
+    validation = validate_readings(data, meter.fields or FIELDS)
+    quarantine(config=config, meter_id=meter_id, validation=validation)
+    df = readings_to_df(validation.readings)
+    get_journal(config).append(
+        name=f"power_{meter_id}", df=df, metadata={"meter_id": meter_id}
+    )
+    add_coverage(
+        config=config,
+        name=f"power_{meter_id}",
+        date_from=pd.Timestamp(date_from.datetime),
+        date_to=pd.Timestamp(date_to.datetime),
+    )
+    return df
 
 
 def get(
@@ -52,22 +83,15 @@ def get(
     date_from: arrow.Arrow,
     date_to: arrow.Arrow,
 ) -> None:
-    """Poll the Discovergy API."""
+    """Poll the Discovergy API and journal the readings, see fetch.
+
+    The readings are written to pystore by the journal flusher and to the hot
+    cache, the cost ledger and the anomaly detector right away."""
     for meter_id, meter in meters.items():
-        log.info(f"Fetching data for meter {meter_id}...")
-        data = meter.readings(
-            ts_from=date_from.timestamp, ts_to=date_to.timestamp, resolution="raw"
-        )
-        log.info(
-            f"To get data for meter {meter_id} took {meter.last_query_duration:.3f} s."
-        )
-        df = raw_to_df(data=data)
-        write_data_to_pystore(
-            config=config,
-            data_frames=split_df_by_day(df=df),
-            name=f"power_{meter_id}",
-            metadata={"meter_id": meter_id},
-        )
+        df = fetch(config=config, meter=meter, date_from=date_from, date_to=date_to)
+        hot_cache.update(config=config, meter_id=meter_id, df=df)
+        ledger.add_readings(config=config, meter_id=meter_id, df=df)
+        anomaly.update(config=config, meter_id=meter_id, df=df)
 
 
 @retry(
@@ -84,76 +108,93 @@ def get_meters(config: Box) -> Dict[str, DiscovergyMeter]:
     else:
         configured_meters = []
     meters = {}
+    described = {}
     now = arrow.utcnow()
     for meter in describe_meters(config):
         meter_id = meter.get("meterId")
-        meter["timestamp"] = now.timestamp
+        meter["timestamp"] = int(now.timestamp())
         if not meter_id:
             log.error(
                 "Got the following meter metadata from the Discovergy API lacking a meter id (meterId): {meter}."
             )
             sys.exit(1)
-        if not configured_meters or meter_id in configured_meters:
+        if configured_meters and meter_id not in configured_meters:
+            continue
+        described[meter_id] = meter
+        # Other poller workers poll the meters they own.
+        if cluster.owns(config, meter_id):
             meters[meter_id] = DiscovergyMeter(meter=meter, config=config)
-    save_meters(config=config, meters={m.meter_id: m.metadata for m in meters.values()})
+            meters[meter_id].fields = meter_fields(config, meters[meter_id])
+    # All meters, so the ones of the other workers are not taken as gone.
+    save_meters(config=config, meters=described)
 
     return meters
 
 
-def raw_to_df(*, data: List[Dict]) -> pd.DataFrame:
+def configured_fields(config: Box, meter_id: str) -> Optional[List[str]]:
+    """Return the fields configured for the meter. None if all are fetched."""
+    fields = config.get("fields", {}).get(meter_id)
+    if not fields:
+        return None
+    return [f.strip() for f in fields.split(",") if f.strip()]
+
+
+def meter_fields(config: Box, meter: DiscovergyMeter) -> Optional[List[str]]:
+    """Return the configured fields of the meter after checking that the meter
+    provides them and that they can be stored. None if all are fetched."""
+    fields = configured_fields(config, meter.meter_id)
+    if fields is None:
+        return None
+    unknown = set(fields) - set(FIELDS)
+    if unknown:
+        log.error(
+            f"The fields {', '.join(sorted(unknown))} of meter {meter.meter_id} are "
+            f"not one of {', '.join(FIELDS)}."
+        )
+        sys.exit(1)
+    try:
+        meter._validate_field_names(field_names=fields)
+    except ValueError:
+        sys.exit(1)
+    return fields
+
+
+def raw_to_df(*, data: List[Dict], fields: Sequence[str] = FIELDS) -> pd.DataFrame:
     """Return the raw Discovergy power meter data as a Pandas DataFrame.
 
-    The index is re-sampled to full seconds. The Discovergy API returns values
-    at about a rate of 1 second.
+    Invalid readings are dropped, see validation."""
+    return readings_to_df(validate_readings(data, fields).readings)
+
+
+def readings_to_df(readings: pd.DataFrame) -> pd.DataFrame:
+    """Return the validated readings scaled down and re-sampled to full seconds.
+
+    The Discovergy API returns values at about a rate of 1 second.
     """
-    index = []
-    values = defaultdict(list)
-    for reading in data:
-        try:
-            ValueSchema.validate(reading["values"])
-        except schema.SchemaError as e:
-            log.warning(f"Got invalid data from Discovergy: {e}")
-            continue
-        index.append(pd.Timestamp(reading["time"], unit="ms"))
-        # index.append(pd.Timestamp(reading["time"], unit="ms", tz="utc"))
-        for k, v in reading["values"].items():
-            # Saving tons of 0s from using disk space.
-            # Watt resolution is all we need and Discovergy reports anyway.
-            if k.startswith("energy") and v > 0:
-                v = int(v / 10000000)
-            # Do not store a higher precision than we get. This is mV resolution.
-            elif k.startswith("voltage") and v > 0:
-                v = int(v / 100)
-            else:
-                values[k].append(int(v))
-    df = pd.DataFrame(values, index=index)
-    del values
+    # Saving tons of 0s from using disk space. Watt resolution is all we need
+    # and Discovergy reports anyway. Do not store a higher precision than we
+    # get, i. e. mV for the voltage.
+    df = pd.DataFrame(
+        {column: readings[column] // field_scale(column) for column in readings},
+        index=readings.index,
+    )
+    if not len(df):
+        return df
     # The Discovergy API returns data at ~1s intervals. Resample to full seconds.
     df = pd.DataFrame(df.resample("1s").median())
     return df
 
 
-def data_from_files(data_dir, meter_id):
-    """Read data from raw data dumped JSON files."""
+def data_from_files(data_dir, meter_id, config: Optional[Box] = None) -> None:
+    """Import the raw data of the meter dumped to JSON files in data_dir.
+
+    See importer for the parallel import."""
+    from . import importer
     from .config import read_config
-    import gzip
-    import os
-    import json
-    import pystore
-    from pathlib import Path
-
-    config = read_config()
-    name = f"power_{meter_id}"
-    pystore.set_path(Path(config.file_location.data_dir).expanduser().as_posix())
-    for f in sorted(os.listdir(data_dir)):
-        if f.startswith("discovergy_data"):
-            with gzip.open(f"{data_dir}/{f}") as fh:
-                data = json.load(fh)
-            df = raw_to_df(data=data)
-            print(f)
-            write_data_to_pystore(
-                config=config,
-                data_frames=split_df_by_day(df=df),
-                name=name,
-                metadata={"meter_id": meter_id},
-            )
+
+    importer.import_files(
+        config=config or read_config(),
+        source="power",
+        data_dir=Path(data_dir),
+        meter_id=meter_id,
+    )
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+"""Fetch the power data missing in the coverage index
+
+Usage:
+   {cmd} repair [--meter=<meter_id>...] [--from=<date>] [--to=<date>] [--window=<seconds>] [--rebuild] [--dry-run]
+   {cmd} repair -h | --help
+
+Options:
+   --meter=<meter_id>     Only repair the given meters. Defaults to all configured meters.
+   --from=<date>          Start as ISO 8601 date. Defaults to the start of the coverage.
+   --to=<date>            End as ISO 8601 date (exclusive). Defaults to the end of the coverage.
+   --window=<seconds>     Max. seconds fetched per request.
+   --rebuild              Add the ranges of the stored data to the coverage index first,
+                          e. g. for data stored before the index existed.
+   --dry-run              Only print the missing ranges.
+   -h, --help
+
+Missing ranges close to each other are fetched in one request of at most
+window seconds. See coverage.
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import sys
+
+from typing import Iterable, Iterator, List, Optional
+
+import arrow  # type: ignore
+import pandas as pd  # type: ignore
+
+from box import Box  # type: ignore
+from docopt import docopt  # type: ignore
+from loguru import logger as log
+
+from . import ledger, power
+from .api import DiscovergyMeter
+from .coverage import Interval, read_coverage, rebuild, to_seconds
+from .defaults import REPAIR_MAX_GAP, REPAIR_WINDOW
+from .journal import get_journal
+from .utils import init_pystore
+
+
+def windows(intervals: Iterable[Interval], window: int) -> Iterator[Interval]:
+    """Yield the fetch windows of at most window seconds covering the intervals.
+
+    Consecutive intervals share a window if they fit in it."""
+    group: Optional[Interval] = None
+    for start, end in intervals:
+        if group is not None and end - group[0] <= window:
+            group = (group[0], end)
+            continue
+        if group is not None:
+            yield group
+        while end - start > window:
+            yield start, start + window
+            start += window
+        group = (start, end)
+    if group is not None:
+        yield group
+
+
+def missing_windows(
+    *,
+    config: Box,
+    meter_id: str,
+    date_from: Optional[pd.Timestamp] = None,
+    date_to: Optional[pd.Timestamp] = None,
+    window: int = REPAIR_WINDOW,
+) -> List[Interval]:
+    """Return the windows to fetch to fill the gaps in the power data of the meter."""
+    coverage = read_coverage(config, f"power_{meter_id}")
+    start = to_seconds(date_from) if date_from is not None else coverage.start
+    end = to_seconds(date_to) if date_to is not None else coverage.end
+    if start is None or end is None:
+        return []
+    return list(windows(coverage.missing(start, end), window))
+
+
+def repair(
+    *,
+    config: Box,
+    meter: DiscovergyMeter,
+    date_from: Optional[pd.Timestamp] = None,
+    date_to: Optional[pd.Timestamp] = None,
+    window: int = REPAIR_WINDOW,
+) -> int:
+    """Fetch the missing power data of the meter. Return the number of requests."""
+    fetch_windows = missing_windows(
+        config=config,
+        meter_id=meter.meter_id,
+        date_from=date_from,
+        date_to=date_to,
+        window=window,
+    )
+    for start, end in fetch_windows:
+        log.info(
+            f"Fetching the missing data of {meter.meter_id} "
+            f"{pd.Timestamp(start, unit='s')} - {pd.Timestamp(end, unit='s')}."
+        )
+        # Adds the window to the coverage. The hot cache only takes recent data.
+        df = power.fetch(
+            config=config,
+            meter=meter,
+            date_from=arrow.get(start),
+            date_to=arrow.get(end),
+        )
+        ledger.add_readings(config=config, meter_id=meter.meter_id, df=df)
+    return len(fetch_windows)
+
+
+def main(config: Box) -> None:
+    """Entry point for the repair sub command."""
+    arguments = docopt(__doc__.format(cmd=sys.argv[0]), argv=sys.argv[1:])
+    date_from = date_to = None
+    if arguments["--from"]:
+        date_from = pd.Timestamp(arrow.get(arguments["--from"]).datetime)
+    if arguments["--to"]:
+        date_to = pd.Timestamp(arrow.get(arguments["--to"]).datetime)
+    try:
+        window = int(arguments["--window"] or REPAIR_WINDOW)
+    except ValueError:
+        log.error(f"The window {arguments['--window']} is not a number.")
+        sys.exit(1)
+    init_pystore(config)
+    meters = power.get_meters(config)
+    if arguments["--meter"]:
+        meters = {k: v for k, v in meters.items() if k in arguments["--meter"]}
+    requests = 0
+    for meter_id, meter in meters.items():
+        if arguments["--rebuild"]:
+            get_journal(config).flush()
+            rebuild(config=config, name=f"power_{meter_id}", max_gap=REPAIR_MAX_GAP)
+        if arguments["--dry-run"]:
+            for start, end in missing_windows(
+                config=config,
+                meter_id=meter_id,
+                date_from=date_from,
+                date_to=date_to,
+                window=window,
+            ):
+                print(
+                    f"{meter_id} {pd.Timestamp(start, unit='s')} - "
+                    f"{pd.Timestamp(end, unit='s')}"
+                )
+            continue
+        requests += repair(
+            config=config,
+            meter=meter,
+            date_from=date_from,
+            date_to=date_to,
+            window=window,
+        )
+    get_journal(config).flush()
+    if not arguments["--dry-run"]:
+        print(f"Fetched {requests} missing ranges.")
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Discovergy response cache
+
+Readings and statistics of the past never change, so the responses of
+DiscovergyMeter.readings and statistics are cached once their window is closed:
+the window must end before the start of the resolution's period, e. g. the
+hour or the month, that was current delay seconds ago. Discovergy still adds
+the readings of meters that were offline in the meantime. The readings are
+fetched for whole periods of the resolution, see align_window, and sliced to
+the window asked for. Statistics are cached for their exact window.
+
+The responses are kept gzip-ed in <data_dir>/response_cache/, one file per
+request, and the recently used ones uncompressed in memory. Both tiers evict
+the least recently used responses once they exceed their size. The hits and
+misses of this process are counted, see metrics.
+
+Configure the cache in the [response_cache] section, all sizes in MiB::
+
+    [response_cache]
+    size: 256
+    memory_size: 32
+    delay: 86400
+
+A size of 0 disables the cache.
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+import time
+
+from collections import Counter, OrderedDict
+from pathlib import Path
+from typing import Any, Dict, Optional, Tuple, Union
+
+import pandas as pd  # type: ignore
+
+from pandas.tseries.frequencies import to_offset  # type: ignore
+
+from box import Box  # type: ignore
+from loguru import logger as log
+
+from .defaults import (
+    RESPONSE_CACHE_DELAY,
+    RESPONSE_CACHE_MEMORY_SIZE,
+    RESPONSE_CACHE_SIZE,
+)
+
+
+# Period of each reading resolution. Statistics are computed over raw readings.
+PERIODS = {
+    "raw": "s",
+    "three_minutes": "3min",
+    "fifteen_minutes": "15min",
+    "one_hour": "h",
+    "one_day": "D",
+    "one_week": "W-SUN",
+    "one_month": "M",
+    "one_year": "Y",
+}
+
+_caches: Dict[Path, "ResponseCache"] = {}
+_metrics: Counter = Counter()
+_lock = threading.Lock()
+
+
+def period_start(
+    timestamp: Union[pd.Timestamp, pd.DatetimeIndex], resolution: str
+) -> Union[pd.Timestamp, pd.DatetimeIndex]:
+    """Return the start of the period of the resolution the timestamp is in."""
+    period = PERIODS[resolution]
+    if period in ("W-SUN", "M", "Y"):
+        return timestamp.to_period(period).start_time
+    # Periods of multiple minutes are not aligned to the hour.
+    return timestamp.floor(period)
+
+
+def align_window(ts_from: int, ts_to: int, resolution: str) -> Tuple[int, int]:
+    """Return the window from ts_from to ts_to (ms) widened to whole periods of
+    the resolution, so windows in the same periods share a cached response."""
+    date_from = period_start(pd.Timestamp(ts_from, unit="ms"), resolution)
+    date_to = pd.Timestamp(ts_to, unit="ms")
+    end = period_start(date_to, resolution)
+    if end < date_to:
+        period = PERIODS[resolution]
+        if period in ("W-SUN", "M", "Y"):
+            end = (date_to.to_period(period) + 1).start_time
+        else:
+            end = end + to_offset(period)
+    return date_from.value // 10**6, end.value // 10**6
+
+
+def window_closed(
+    ts_to: int, resolution: str = "raw", delay: int = RESPONSE_CACHE_DELAY
+) -> bool:
+    """Return True if the window ending at ts_to (ms) can not change anymore.
+
+    :param delay: seconds Discovergy may take to deliver late readings
+    """
+    now = pd.Timestamp(time.time() - delay, unit="s")
+    return pd.Timestamp(ts_to, unit="ms") <= period_start(now, resolution)
+
+
+def _unlink(file_path: Path) -> None:
+    try:
+        file_path.unlink()
+    except FileNotFoundError:
+        pass
+
+
+class ResponseCache:
+    """Represents the on-disk and in-memory cache of immutable API responses."""
+
+    def __init__(
+        self,
+        *,
+        path: Path,
+        max_bytes: int,
+        memory_bytes: int,
+        delay: int = RESPONSE_CACHE_DELAY,
+    ):
+        """:param max_bytes: max. size of the gzip-ed responses on disk
+        :param memory_bytes: max. size of the responses kept in memory"""
+        self.path = path
+        self.max_bytes = max_bytes
+        self.memory_bytes = memory_bytes
+        self.delay = delay
+        self._memory: "OrderedDict[str, bytes]" = OrderedDict()
+        self._memory_size = 0
+        # The size on disk, None until the directory was scanned.
+        self._disk_size: Optional[int] = None
+
+    def __repr__(self):
+        return f"ResponseCache:{self.path}"
+
+    @staticmethod
+    def key(resource: str) -> str:
+        return hashlib.sha256(resource.encode("utf-8")).hexdigest()
+
+    def file_path(self, key: str) -> Path:
+        return self.path / key[:2] / f"{key}.json.gz"
+
+    def get(self, resource: str) -> Optional[Any]:
+        """Return the cached response of the resource. None if it is not cached."""
+        key = self.key(resource)
+        with _lock:
+            body = self._memory.get(key)
+            if body is not None:
+                self._memory.move_to_end(key)
+                _metrics["memory_hits"] += 1
+                return json.loads(body)
+        file_path = self.file_path(key)
+        try:
+            with gzip.open(file_path.as_posix(), "rb") as fh:
+                body = fh.read()
+            data = json.loads(body)
+        except FileNotFoundError:
+            _metrics["misses"] += 1
+            return None
+        except (OSError, EOFError, json.JSONDecodeError) as e:
+            log.warning(f"Dropping the corrupt cached response {file_path}: {e}")
+            _unlink(file_path)
+            _metrics["misses"] += 1
+            return None
+        # The modification time orders the files for the eviction.
+        os.utime(file_path)
+        _metrics["disk_hits"] += 1
+        self._remember(key, body)
+        return data
+
+    def put(self, resource: str, data: Any) -> None:
+        """Cache the response of the resource."""
+        key = self.key(resource)
+        body = json.dumps(data, separators=(",", ":")).encode("utf-8")
+        file_path = self.file_path(key)
+        file_path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = file_path.with_suffix(f".{os.getpid()}.tmp")
+        with gzip.open(tmp_path.as_posix(), "wb") as fh:
+            fh.write(body)
+        os.replace(tmp_path, file_path)
+        _metrics["stores"] += 1
+        self._remember(key, body)
+        if self._disk_size is None:
+            self._disk_size = self._scan()
+        else:
+            self._disk_size += file_path.stat().st_size
+        if self._disk_size > self.max_bytes:
+            self.evict()
+
+    def _remember(self, key: str, body: bytes) -> None:
+        """Keep the response in memory and evict the least recently used ones."""
+        if len(body) > self.memory_bytes:
+            return
+        with _lock:
+            if key in self._memory:
+                return
+            self._memory[key] = body
+            self._memory_size += len(body)
+            while self._memory_size > self.memory_bytes:
+                _, evicted = self._memory.popitem(last=False)
+                self._memory_size -= len(evicted)
+
+    def _scan(self) -> int:
+        """Return the size of the cached files. Other processes add files too."""
+        return sum(p.stat().st_size for p in self.path.glob("*/*.json.gz"))
+
+    def evict(self) -> None:
+        """Delete the least recently used files until the cache fits max_bytes
+        with some room to spare."""
+        files = []
+        for file_path in self.path.glob("*/*.json.gz"):
+            try:
+                stat = file_path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, file_path))
+        size = sum(f[1] for f in files)
+        target = self.max_bytes * 0.9
+        for _, file_size, file_path in sorted(files):
+            if size <= target:
+                break
+            _unlink(file_path)
+            size -= file_size
+            _metrics["evictions"] += 1
+        log.debug(f"Evicted cached responses of {self}. {size} bytes left.")
+        self._disk_size = size
+
+
+def get_response_cache(config: Box) -> Optional[ResponseCache]:
+    """Return the response cache of the data directory. None if it is disabled."""
+    cache_config = config.get("response_cache", {})
+    max_bytes = int(cache_config.get("size", RESPONSE_CACHE_SIZE) or 0) * 2**20
+    if not max_bytes:
+        return None
+    path = Path(config.file_location.data_dir).expanduser() / "response_cache"
+    if path not in _caches:
+        _caches[path] = ResponseCache(
+            path=path,
+            max_bytes=max_bytes,
+            memory_bytes=int(
+                cache_config.get("memory_size", RESPONSE_CACHE_MEMORY_SIZE)
+            )
+            * 2**20,
+            delay=int(cache_config.get("delay", RESPONSE_CACHE_DELAY)),
+        )
+    return _caches[path]
+
+
+def metrics() -> Dict[str, int]:
+    """Return the hits, misses, stores and evictions of this process."""
+    return dict(_metrics)
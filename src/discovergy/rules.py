@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Discovergy rule engine
+
+Trigger actions on conditions over the latest power, Awattar price and weather
+values, e. g. turn on the washing machine when power is cheap. Rules are
+configured as one section per rule::
+
+    [rule_washing_machine]
+    condition: marketprice < 30 and power < 500
+    action: command: /usr/local/bin/washing-machine on
+    debounce: 3600
+
+action is either "command: <command line>" or "webhook: <URL>". A rule fires if
+its condition becomes true and it didn't fire within the last debounce seconds.
+
+The values are named after their source:
+
+* power fields of the live readings as <field> and <field>_<meter id>
+* marketprice: the Awattar price of the current hour in EUR/MWh
+* weather fields as <field> for the default location and <field>_<location>
+
+Only the rules referencing a changed value are evaluated. The rules run in the
+first config of each poller worker. The Awattar prices are read from the stored
+data, too, since another worker may poll them.
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import ast
+import asyncio
+import shlex
+import time
+
+from collections import defaultdict
+from typing import Any, Dict, FrozenSet, List, Optional, Set
+
+import httpx
+import pandas as pd  # type: ignore
+
+from box import Box  # type: ignore
+from loguru import logger as log
+
+from . import ledger
+from .defaults import RULE_DEBOUNCE
+from .live import LiveReading, SourceUpdate
+
+
+SAFE_FUNCTIONS = {"abs": abs, "min": min, "max": max, "round": round}
+SAFE_NODES = (
+    ast.Expression,
+    ast.BoolOp,
+    ast.And,
+    ast.Or,
+    ast.UnaryOp,
+    ast.Not,
+    ast.USub,
+    ast.UAdd,
+    ast.BinOp,
+    ast.Add,
+    ast.Sub,
+    ast.Mult,
+    ast.Div,
+    ast.Mod,
+    ast.Compare,
+    ast.Eq,
+    ast.NotEq,
+    ast.Lt,
+    ast.LtE,
+    ast.Gt,
+    ast.GtE,
+    ast.Name,
+    ast.Load,
+    ast.Constant,
+    ast.Call,
+)
+
+
+class RuleError(Exception):
+    """The rule is not valid."""
+
+    pass
+
+
+class Rule:
+    """Represents a condition and the action to run once it becomes true."""
+
+    def __init__(
+        self, *, name: str, condition: str, action: str, debounce: float = RULE_DEBOUNCE
+    ):
+        self.name = name
+        self.condition = condition
+        self.action = action
+        self.debounce = debounce
+        self.inputs: FrozenSet[str] = frozenset()
+        self._code = self._compile(condition)
+        self.state = False
+        self.last_fired: Optional[float] = None
+        try:
+            self.action_type, self.action_arg = (
+                e.strip() for e in action.split(":", 1)
+            )
+        except ValueError:
+            raise RuleError(f"The action '{action}' of rule {name} is not valid.")
+        if self.action_type not in ("command", "webhook"):
+            raise RuleError(f"The action type of rule {name} is not supported.")
+
+    def __repr__(self):
+        return f"Rule:{self.name}"
+
+    def _compile(self, condition: str):
+        """Return the compiled condition. Only allow a safe subset of Python."""
+        try:
+            tree = ast.parse(condition, mode="eval")
+        except SyntaxError as e:
+            raise RuleError(f"Could not parse the condition of rule {self.name}: {e}")
+        inputs = set()
+        for node in ast.walk(tree):
+            if not isinstance(node, SAFE_NODES):
+                raise RuleError(
+                    f"The condition of rule {self.name} must not contain "
+                    f"{type(node).__name__}."
+                )
+            if isinstance(node, ast.Call) and (
+                not isinstance(node.func, ast.Name)
+                or node.func.id not in SAFE_FUNCTIONS
+            ):
+                raise RuleError(f"The condition of rule {self.name} calls a function.")
+            if isinstance(node, ast.Name) and node.id not in SAFE_FUNCTIONS:
+                inputs.add(node.id)
+        self.inputs = frozenset(inputs)
+        return compile(tree, f"<rule {self.name}>", "eval")
+
+    def evaluate(self, values: Dict[str, Any]) -> bool:
+        """Return the condition evaluated for the values. False if inputs are missing."""
+        if not self.inputs.issubset(values):
+            return False
+        try:
+            return bool(eval(self._code, {"__builtins__": SAFE_FUNCTIONS}, values))
+        except Exception as e:
+            log.warning(f"Could not evaluate {self}: {e}")
+            return False
+
+
+class RuleEngine:
+    """Evaluate the rules incrementally as values change."""
+
+    def __init__(self, rules: List[Rule]):
+        self.rules = rules
+        self.values: Dict[str, Any] = {}
+        self._index: Dict[str, List[Rule]] = defaultdict(list)
+        for rule in rules:
+            for name in rule.inputs:
+                self._index[name].append(rule)
+
+    def update(self, values: Dict[str, Any], now: Optional[float] = None) -> List[Rule]:
+        """Update the values and return the rules to fire.
+
+        Only rules referencing a changed value are evaluated."""
+        now = time.time() if now is None else now
+        changed = [k for k, v in values.items() if self.values.get(k) != v]
+        self.values.update(values)
+        affected: Set[Rule] = set()
+        for name in changed:
+            affected.update(self._index.get(name, ()))
+        to_fire = []
+        for rule in affected:
+            state = rule.evaluate(self.values)
+            rising = state and not rule.state
+            rule.state = state
+            if not rising:
+                continue
+            if rule.last_fired is not None and now - rule.last_fired < rule.debounce:
+                log.debug(f"Debounced {rule}.")
+                continue
+            rule.last_fired = now
+            to_fire.append(rule)
+        return to_fire
+
+
+class RuleInputs:
+    """Turn the items published to live.publisher into rule engine values."""
+
+    def __init__(self):
+        self.prices: Optional[pd.Series] = None
+
+    def from_item(self, item: Any) -> Dict[str, Any]:
+        """Return the values given by a published item."""
+        values: Dict[str, Any] = {}
+        if isinstance(item, LiveReading):
+            for field, value in item.values.items():
+                values[field] = value
+                values[f"{field}_{item.meter_id}"] = value
+        elif isinstance(item, SourceUpdate) and item.source == "awattar":
+            self.add_prices(item.data["marketprice"])
+        elif isinstance(item, SourceUpdate) and item.source == "weather":
+            df = item.data.sort_index()
+            for location, df_location in df.groupby("location"):
+                suffix = "" if location == "default" else f"_{location}"
+                for field, value in df_location.iloc[-1].items():
+                    if field != "location" and not pd.isna(value):
+                        values[f"{field}{suffix}"] = value
+        return values
+
+    def add_prices(self, prices: pd.Series) -> None:
+        """Add the Awattar prices by UTC start timestamp. New prices win."""
+        if not len(prices):
+            return
+        if self.prices is not None:
+            prices = prices.combine_first(self.prices)
+        self.prices = prices.sort_index()
+
+    def current(self, now: Optional[float] = None) -> Dict[str, Any]:
+        """Return the values depending on the time, i. e. the current marketprice."""
+        if self.prices is None or not len(self.prices):
+            return {}
+        now_ts = pd.Timestamp(time.time() if now is None else now, unit="s", tz="utc")
+        # Awattar prices are valid for one hour from their start timestamp.
+        valid_until = self.prices.index[-1] + pd.Timedelta(hours=1)
+        if now_ts < self.prices.index[0] or now_ts >= valid_until:
+            return {}
+        return {"marketprice": float(self.prices.asof(now_ts))}
+
+
+def stored_prices(config: Box, now: Optional[float] = None) -> pd.Series:
+    """Return the stored Awattar prices from the current hour on by UTC start
+    timestamp. The prices are polled by one worker of the cluster only."""
+    hour = pd.Timestamp(time.time() if now is None else now, unit="s").floor("h")
+    prices = ledger.read_prices(config, hour, hour + pd.Timedelta(days=2))
+    if not len(prices):
+        return prices
+    return prices.tz_localize("utc")
+
+
+def load_rules(config: Box) -> List[Rule]:
+    """Return the rules of all [rule_<name>] sections."""
+    rules = []
+    for section, options in config.items():
+        if not section.startswith("rule_"):
+            continue
+        try:
+            rules.append(
+                Rule(
+                    name=section[len("rule_") :],
+                    condition=options["condition"],
+                    action=options["action"],
+                    debounce=float(options.get("debounce", RULE_DEBOUNCE)),
+                )
+            )
+        except (KeyError, RuleError) as e:
+            log.error(f"Skipping the invalid rule {section}: {e}")
+    return rules
+
+
+async def run_action(rule: Rule, values: Dict[str, Any]) -> None:
+    """Run the action of the rule."""
+    log.info(f"Firing {rule}: {rule.condition}")
+    if rule.action_type == "command":
+        process = await asyncio.create_subprocess_exec(*shlex.split(rule.action_arg))
+        return_code = await process.wait()
+        if return_code:
+            log.warning(f"The command of {rule} exited with {return_code}.")
+    elif rule.action_type == "webhook":
+        payload = {
+            "rule": rule.name,
+            "condition": rule.condition,
+            "values": {k: values[k] for k in rule.inputs},
+        }
+        try:
+            async with httpx.AsyncClient() as client:
+                response = await client.post(rule.action_arg, json=payload, timeout=10)
+        except Exception as e:
+            log.warning(f"Could not call the webhook of {rule}: {e}")
+        else:
+            if response.status_code >= 300:
+                log.warning(
+                    f"The webhook of {rule} returned HTTP status code {response.status_code}."
+                )
@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Discovergy local statistics
+
+Answer DiscovergyMeter.statistics from the stored power data. Every complete day
+is summarized once into a mergeable summary (count, mean, M2, minimum,
+maximum per field). A time range is answered by merging the summaries of the
+complete days in it plus the summaries of at most two partial days at the
+edges, which are computed from the stored data.
+
+Summaries are kept in <data_dir>/statistics/<collection>.json and are dropped
+by invalidate_days whenever data of a day is written. Both run under
+<collection>.lock. A day is summarized unlocked, so invalidate_days counts the
+writes per day in <collection>.invalidated.json and a summary of a day written
+meanwhile is not saved.
+
+DiscovergyMeter.readings at a resolution is answered by rolling up the stored
+data per period of the resolution, see rollup.
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import json
+import os
+import time
+
+from pathlib import Path
+from typing import Callable, Dict, Iterable, List, Optional
+
+import numpy as np  # type: ignore
+import pandas as pd  # type: ignore
+
+from box import Box  # type: ignore
+from loguru import logger as log
+
+from . import hot_cache
+from .response_cache import period_start
+from .utils import file_lock, naive_utc
+
+
+SUMMARY_COLUMNS = ["count", "mean", "m2", "minimum", "maximum"]
+
+# The stored power data is scaled down. See power.raw_to_df.
+FIELD_SCALES = {"energy": 10000000, "voltage": 100}
+
+
+def field_scale(field: str) -> int:
+    """Return the factor to scale the stored field back to the API unit."""
+    for prefix, scale in FIELD_SCALES.items():
+        if field.startswith(prefix):
+            return scale
+    return 1
+
+
+def summarize(df: pd.DataFrame) -> pd.DataFrame:
+    """Return the mergeable summary of each column of df."""
+    df = df.astype("float64")
+    mean = df.mean()
+    return pd.DataFrame(
+        {
+            "count": df.count(),
+            "mean": mean,
+            "m2": ((df - mean) ** 2).sum(),
+            "minimum": df.min(),
+            "maximum": df.max(),
+        },
+        columns=SUMMARY_COLUMNS,
+    )
+
+
+def merge(summaries: Iterable[pd.DataFrame]) -> pd.DataFrame:
+    """Return the summary of the union of the data of the summaries.
+
+    Uses the parallel variance algorithm by Chan et al."""
+    merged: Optional[pd.DataFrame] = None
+    for summary in summaries:
+        if merged is None:
+            merged = summary
+            continue
+        a, b = merged.align(summary, join="outer", axis=0)
+        n_a, n_b = a["count"].fillna(0), b["count"].fillna(0)
+        n = n_a + n_b
+        delta = b["mean"].fillna(0) - a["mean"].fillna(0)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            mean = a["mean"].fillna(0) + delta * (n_b / n)
+            m2 = a["m2"].fillna(0) + b["m2"].fillna(0) + delta**2 * n_a * n_b / n
+        merged = pd.DataFrame(
+            {
+                "count": n,
+                "mean": mean.where(n > 0),
+                "m2": m2.where(n > 0),
+                "minimum": np.fmin(a["minimum"], b["minimum"]),
+                "maximum": np.fmax(a["maximum"], b["maximum"]),
+            },
+            columns=SUMMARY_COLUMNS,
+        )
+    if merged is None:
+        return pd.DataFrame(columns=SUMMARY_COLUMNS)
+    return merged
+
+
+def finalize(summary: pd.DataFrame) -> Dict[str, Dict[str, float]]:
+    """Return the summary in the format of the Discovergy statistics endpoint."""
+    statistics = {}
+    for field, row in summary.iterrows():
+        count = int(row["count"])
+        if not count:
+            continue
+        scale = field_scale(field)
+        statistics[field] = {
+            "count": count,
+            "minimum": row["minimum"] * scale,
+            "maximum": row["maximum"] * scale,
+            "mean": row["mean"] * scale,
+            "variance": row["m2"] / count * scale**2,
+        }
+    return statistics
+
+
+def rollup(df: pd.DataFrame, resolution: str) -> List[Dict]:
+    """Return the stored data rolled up per period of the resolution in the
+    format of the Discovergy readings endpoint.
+
+    Energy counters take their last value in a period, the other fields the mean.
+    """
+    if not len(df):
+        return []
+    df = df.astype("float64")
+    if resolution != "raw":
+        aggregations = {
+            f: "last" if f.startswith("energy") else "mean" for f in df.columns
+        }
+        df = df.groupby(period_start(df.index, resolution)).agg(aggregations)
+    df = df * [field_scale(f) for f in df.columns]
+    times = df.index.asi8 // 10**6
+    return [
+        {
+            "time": int(ts),
+            "values": {f: v for f, v in values.items() if not np.isnan(v)},
+        }
+        for ts, values in zip(times, df.to_dict(orient="records"))
+    ]
+
+
+class LocalStatistics:
+    """Compute the statistics of a meter from the stored data."""
+
+    def __init__(
+        self,
+        *,
+        config: Box,
+        meter_id: str,
+        reader: Optional[Callable[..., pd.DataFrame]] = None,
+    ):
+        """:param reader: returns the stored data of a time range, defaults to
+        hot_cache.read_data"""
+        self.config = config
+        self.meter_id = meter_id
+        self.name = f"power_{meter_id}"
+        self.reader = reader or hot_cache.read_data
+
+    def __repr__(self):
+        return f"LocalStatistics:{self.meter_id}"
+
+    def _read(
+        self,
+        date_from: pd.Timestamp,
+        date_to: pd.Timestamp,
+        fields: Optional[List[str]] = None,
+    ) -> pd.DataFrame:
+        return self.reader(
+            config=self.config,
+            name=self.name,
+            date_from=date_from,
+            date_to=date_to,
+            columns=fields,
+        )
+
+    @property
+    def summaries(self) -> Dict[str, pd.DataFrame]:
+        """Return the stored day summaries of all fields by day YYYY-MM-DD."""
+        return {
+            day: pd.DataFrame.from_dict(summary, orient="index")
+            for day, summary in read_summaries(self.config, self.name).items()
+        }
+
+    def day_summary(
+        self, day: pd.Timestamp, summaries: Optional[Dict[str, pd.DataFrame]] = None
+    ) -> pd.DataFrame:
+        """Return the summary of a complete day. Compute and save it if needed.
+
+        :param summaries: the stored summaries, read if not given"""
+        key = day.strftime("%Y-%m-%d")
+        if summaries is None:
+            summaries = self.summaries
+        if key in summaries:
+            return summaries[key]
+        lock_path = _path(self.config, self.name, "lock")
+        with file_lock(lock_path):
+            invalidated = read_invalidated(self.config, self.name).get(key, 0)
+        summary = summarize(self._read(day, day + pd.Timedelta(days=1)))
+        with file_lock(lock_path):
+            # Data of the day was written while it was summarized.
+            if read_invalidated(self.config, self.name).get(key, 0) != invalidated:
+                return summary
+            stored = read_summaries(self.config, self.name)
+            stored[key] = summary.to_dict(orient="index")
+            write_summaries(self.config, self.name, stored)
+        return summary
+
+    def statistics(
+        self,
+        *,
+        field_names: Optional[List[str]] = None,
+        ts_from: int,
+        ts_to: Optional[int] = None,
+    ) -> Dict[str, Dict[str, float]]:
+        """Return the statistics like DiscovergyMeter.statistics does.
+
+        :param ts_from: start as UNIX timestamp in s (inclusive)
+        :param ts_to: end as UNIX timestamp in s (exclusive), defaults to now
+        """
+        date_from = pd.Timestamp(ts_from, unit="s")
+        date_to = pd.Timestamp(time.time() if ts_to is None else ts_to, unit="s")
+        # Only days that are over can be summarized for good.
+        last_complete = naive_utc(pd.Timestamp.utcnow()).floor("D")
+        first_day = date_from.ceil("D")
+        last_day = min(date_to.floor("D"), last_complete)
+        summaries = []
+        if first_day < last_day:
+            if date_from < first_day:
+                edge = self._read(date_from, first_day, field_names)
+                summaries.append(summarize(edge))
+            days = pd.date_range(first_day, last_day - pd.Timedelta(days=1), freq="D")
+            stored = self.summaries
+            for day in days:
+                summaries.append(self.day_summary(day, stored))
+            if last_day < date_to:
+                edge = self._read(last_day, date_to, field_names)
+                summaries.append(summarize(edge))
+        else:
+            summaries.append(summarize(self._read(date_from, date_to, field_names)))
+        summary = merge(summaries)
+        if field_names:
+            summary = summary.reindex(field_names).dropna(how="all")
+        return finalize(summary)
+
+    def readings(
+        self,
+        *,
+        field_names: Optional[List[str]] = None,
+        ts_from: int,
+        ts_to: int,
+        resolution: str = "raw",
+    ) -> List[Dict]:
+        """Return the readings like DiscovergyMeter.readings does.
+
+        :param ts_from: start as UNIX timestamp in s (inclusive)
+        :param ts_to: end as UNIX timestamp in s (exclusive)
+        """
+        df = self._read(
+            pd.Timestamp(ts_from, unit="s"), pd.Timestamp(ts_to, unit="s"), field_names
+        )
+        return rollup(df, resolution)
+
+
+def _path(config: Box, name: str, suffix: str) -> Path:
+    return (
+        Path(config.file_location.data_dir).expanduser()
+        / "statistics"
+        / f"{name}.{suffix}"
+    )
+
+
+def summaries_path(config: Box, name: str) -> Path:
+    """Return the path of the day summaries of the collection name."""
+    return _path(config, name, "json")
+
+
+def read_summaries(config: Box, name: str) -> Dict[str, Dict]:
+    """Return the stored day summaries of the collection name."""
+    try:
+        with summaries_path(config, name).open() as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return {}
+    except json.JSONDecodeError:
+        log.warning(f"Could not decode the summaries of {name}. Recomputing them.")
+        return {}
+
+
+def write_summaries(config: Box, name: str, summaries: Dict[str, Dict]) -> None:
+    """Atomically write the day summaries of the collection name."""
+    file_path = summaries_path(config, name)
+    file_path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = file_path.with_suffix(".tmp")
+    with tmp_path.open("w") as fh:
+        json.dump(summaries, fh)
+    os.replace(tmp_path, file_path)
+
+
+def read_invalidated(config: Box, name: str) -> Dict[str, int]:
+    """Return the number of times each day YYYY-MM-DD of the collection name
+    was written after it was first summarized."""
+    try:
+        with _path(config, name, "invalidated.json").open() as fh:
+            return json.load(fh)
+    except FileNotFoundError:
+        return {}
+
+
+def invalidate_days(config: Box, name: str, days: Iterable[pd.Timestamp]) -> None:
+    """Drop the summaries of the days of the collection name after data was written."""
+    lock_path = _path(config, name, "lock")
+    # No day was ever summarized.
+    if not lock_path.exists():
+        return
+    with file_lock(lock_path):
+        written = {pd.Timestamp(day).strftime("%Y-%m-%d") for day in days}
+        summaries = read_summaries(config, name)
+        stale = written & set(summaries)
+        if stale:
+            log.debug(
+                f"Dropping the stale summaries of {name}: {', '.join(sorted(stale))}"
+            )
+            for day in stale:
+                del summaries[day]
+            write_summaries(config, name, summaries)
+        invalidated = read_invalidated(config, name)
+        for day in written:
+            invalidated[day] = invalidated.get(day, 0) + 1
+        file_path = _path(config, name, "invalidated.json")
+        tmp_path = file_path.with_suffix(".tmp")
+        with tmp_path.open("w") as fh:
+            json.dump(invalidated, fh)
+        os.replace(tmp_path, file_path)
@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+"""Run the poller in several worker processes
+
+Usage:
+   {cmd} supervise [--workers=<n>] [--id=<prefix>] [<config>...]
+   {cmd} supervise -h | --help
+
+Options:
+   --workers=<n>     Number of poller worker processes. Defaults to the number of CPUs.
+   --id=<prefix>     Prefix of the worker ids. Must be unique per host sharing the
+                     data directory. Defaults to the host name.
+   <config>          Config files, one per Discovergy account. Defaults to the
+                     config in use.
+   -h, --help
+
+The meters of all accounts are spread over the workers of all supervisors
+sharing the data directory by consistent hashing. See cluster. A worker that
+exits is restarted. If it stays dead, its meters move to the other workers.
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import multiprocessing
+import os
+import socket
+import sys
+import time
+
+from pathlib import Path
+from typing import Dict, List
+
+from box import Box  # type: ignore
+from docopt import docopt  # type: ignore
+from loguru import logger as log
+
+from . import poller
+from .cluster import Membership
+from .config import read_config
+from .defaults import CLUSTER_HEARTBEAT
+from .utils import start_logging
+
+
+def run_worker(config_paths: List[str], worker_id: str) -> None:
+    """Entry point of a poller worker process."""
+    configs = [read_config(Path(path)) for path in config_paths]
+    start_logging(configs[0])
+    membership = Membership(config=configs[0], worker_id=worker_id)
+    membership.beat()
+    members = sorted(membership.live() | {worker_id})
+    for i, config in enumerate(configs):
+        config["shard"] = {
+            "worker_id": worker_id,
+            "members": members,
+            "primary": i == 0,
+        }
+    log.info(f"Starting poller worker {worker_id} of {', '.join(members)}.")
+    poller.run(configs)
+
+
+class Supervisor:
+    """Start the poller workers and restart them once they exit."""
+
+    def __init__(self, *, config: Box, config_paths: List[Path], worker_ids: List[str]):
+        self.config = config
+        self.config_paths = [p.as_posix() for p in config_paths]
+        self.worker_ids = worker_ids
+        self.context = multiprocessing.get_context("spawn")
+        self.processes: Dict[str, multiprocessing.process.BaseProcess] = {}
+        self.started: Dict[str, float] = {}
+
+    def __repr__(self):
+        return f"Supervisor:{','.join(self.worker_ids)}"
+
+    def start(self, worker_id: str) -> None:
+        """Start the worker process."""
+        process = self.context.Process(
+            target=run_worker,
+            args=(self.config_paths, worker_id),
+            name=f"poller-{worker_id}",
+        )
+        process.start()
+        self.processes[worker_id] = process
+        self.started[worker_id] = time.time()
+
+    def run(self) -> None:
+        """Start all workers and supervise them until <Ctrl>+<C>."""
+        # Announce all workers first. Otherwise, the first ones to start would
+        # see the others join and restart right away to rebalance.
+        for worker_id in self.worker_ids:
+            Membership(config=self.config, worker_id=worker_id).beat()
+        for worker_id in self.worker_ids:
+            self.start(worker_id)
+        log.info(f"Started {len(self.worker_ids)} poller workers.")
+        try:
+            while True:
+                time.sleep(1)
+                for worker_id, process in self.processes.items():
+                    if process.is_alive():
+                        continue
+                    # A worker failing right away is restarted less often.
+                    uptime = time.time() - self.started[worker_id]
+                    if uptime < CLUSTER_HEARTBEAT:
+                        continue
+                    if process.exitcode:
+                        log.warning(
+                            f"Poller worker {worker_id} died with exit code "
+                            f"{process.exitcode}. Restarting it."
+                        )
+                    else:
+                        log.info(f"Restarting poller worker {worker_id}.")
+                    self.start(worker_id)
+        except KeyboardInterrupt:
+            # The workers got the <Ctrl>+<C> as well and flush their journals.
+            log.info("Stopping the poller workers.")
+            for worker_id, process in self.processes.items():
+                process.join()
+                Membership(config=self.config, worker_id=worker_id).leave()
+
+
+def main(config: Box) -> None:
+    """Entry point for the supervise sub command."""
+    arguments = docopt(__doc__.format(cmd=sys.argv[0]), argv=sys.argv[1:])
+    config_paths = [Path(p) for p in arguments["<config>"]] or [
+        Path(config.config_file_path)
+    ]
+    for path in config_paths:
+        if not path.is_file():
+            log.error(f"Could not find the config file {path}.")
+            sys.exit(1)
+    # The workers share the data directory of the first config.
+    config = read_config(config_paths[0])
+    try:
+        workers = int(arguments["--workers"] or os.cpu_count() or 1)
+    except ValueError:
+        log.error(f"The number of workers {arguments['--workers']} is not a number.")
+        sys.exit(1)
+    prefix = arguments["--id"] or socket.gethostname()
+    supervisor = Supervisor(
+        config=config,
+        config_paths=config_paths,
+        worker_ids=[f"{prefix}-{i}" for i in range(workers)],
+    )
+    supervisor.run()
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Discovergy HTTP transport
+
+All requests to the Discovergy API go through one httpx client per process. It
+keeps the TLS connections alive between requests, asks for gzip or deflate
+compressed responses and speaks HTTP/2 if h2 is installed.
+
+The transferred bytes are counted per request: wire_bytes as received, i. e.
+compressed, and body_bytes after decoding. The last transfer is logged at debug
+level and the sums are kept per host, see metrics.
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import os
+import threading
+
+from collections import Counter
+from typing import Any, Dict, NamedTuple, Optional
+
+import httpx
+
+from loguru import logger as log
+
+from .defaults import HTTP_KEEPALIVE_CONNECTIONS, HTTP_TIMEOUT
+from .utils import measure_duration
+
+try:
+    import h2  # type: ignore # noqa: F401
+except ImportError:
+    HTTP2 = False
+else:
+    HTTP2 = True
+
+
+class Transfer(NamedTuple):
+    method: str
+    url: str
+    status_code: int
+    http_version: str
+    wire_bytes: int  # body bytes as received
+    body_bytes: int  # body bytes after decoding
+    seconds: float
+
+
+_client: Optional[httpx.Client] = None
+_client_pid: Optional[int] = None
+_lock = threading.Lock()
+_metrics: Dict[str, Counter] = {}
+
+
+def get_client() -> httpx.Client:
+    """Return the HTTP client of this process."""
+    global _client, _client_pid
+    with _lock:
+        # Connections must not be shared with a forked process.
+        if _client is None or _client_pid != os.getpid():
+            log.debug(f"Opening a new HTTP client. HTTP/2: {HTTP2}")
+            _client = httpx.Client(
+                http2=HTTP2,
+                timeout=HTTP_TIMEOUT,
+                limits=httpx.Limits(
+                    max_keepalive_connections=HTTP_KEEPALIVE_CONNECTIONS
+                ),
+                headers={"Accept-Encoding": "gzip, deflate"},
+            )
+            _client_pid = os.getpid()
+        return _client
+
+
+def close() -> None:
+    """Close the connections of the HTTP client of this process."""
+    global _client
+    with _lock:
+        if _client is not None and _client_pid == os.getpid():
+            _client.close()
+        _client = None
+
+
+def request(method: str, url: str, **kwargs: Any) -> httpx.Response:
+    """Send the request, read the response and record its transfer.
+
+    The kwargs are passed to httpx.Client.request, e. g. auth or data."""
+    with measure_duration() as measure:
+        response = get_client().request(method, url, **kwargs)
+    transfer = Transfer(
+        method=method,
+        url=url,
+        status_code=response.status_code,
+        http_version=response.http_version,
+        wire_bytes=response.num_bytes_downloaded,
+        body_bytes=len(response.content),
+        seconds=measure.duration,
+    )
+    record_metrics(response.url.host, transfer)
+    log.debug(
+        f"{method} {url}: {transfer.status_code} {transfer.http_version}, "
+        f"{transfer.wire_bytes} bytes on the wire, {transfer.body_bytes} decoded, "
+        f"{transfer.seconds:.3f} s."
+    )
+    return response
+
+
+def get(url: str, **kwargs: Any) -> httpx.Response:
+    """GET the url, see request."""
+    return request("GET", url, **kwargs)
+
+
+def post(url: str, **kwargs: Any) -> httpx.Response:
+    """POST to the url, see request."""
+    return request("POST", url, **kwargs)
+
+
+def record_metrics(host: str, transfer: Transfer) -> None:
+    """Add the transfer to the metrics of the host."""
+    with _lock:
+        counter = _metrics.setdefault(host, Counter())
+        counter["requests"] += 1
+        counter["wire_bytes"] += transfer.wire_bytes
+        counter["body_bytes"] += transfer.body_bytes
+
+
+def metrics() -> Dict[str, Dict[str, int]]:
+    """Return the requests and transferred bytes per host of this process."""
+    with _lock:
+        return {host: dict(counter) for host, counter in _metrics.items()}
@@ -9,24 +9,39 @@ __author__ = "Frank Becker <fb@alien8.de>"
 __copyright__ = "Frank Becker"
 __license__ = "mit"
 
-import gzip
+import fcntl
 import json
 import os
 import re
 import sys
 
-from contextlib import ContextDecorator
+from contextlib import ContextDecorator, contextmanager
 from pathlib import Path
 from timeit import default_timer
-from typing import Any, Callable, Dict, List, NamedTuple, Optional, Union
-
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Union,
+)
+
+import numpy as np  # type: ignore
 import pandas as pd  # type: ignore
+import pyarrow as pa  # type: ignore
+import pyarrow.parquet as pq  # type: ignore
 import pystore
 
 from box import Box  # type: ignore
 from loguru import logger as log
 from tenacity import _utils  # type: ignore
 
+from .archive import append_records
+
 
 class TimeStampedValue(NamedTuple):
     timestamp: float
@@ -117,25 +132,9 @@ def split_df_by_month(*, df) -> List[pd.DataFrame]:
 
 def split_df_by_day(*, df) -> List[pd.DataFrame]:
     """Return data frames split by day."""
-    data_frames = []
-    intervals = sorted(set([(e.year, e.month, e.day) for e in df.index.unique()]))
-    if len(intervals) == 1:
-        # One day only, early return
-        data_frames.append(df)
-        return data_frames
-    date_range = pd.date_range(
-        "{}-{:02d}-{:02d}".format(intervals[0][0], intervals[0][1], intervals[0][2]),
-        periods=len(intervals),
-        freq="D",
-        # tz="UTC",
-    )
-    # date_range starts at 0h 00m 00s
-    prev_day = date_range[0]
-    for date in date_range[1:]:
-        df_per_day = df[(prev_day < df.index) & (df.index <= date)]
-        data_frames.append(df_per_day)
-        prev_day = date
-    return data_frames
+    if not len(df):
+        return []
+    return [df_per_day for _, df_per_day in df.groupby(df.index.normalize())]
 
 
 def str2bool(value: str) -> bool:
@@ -175,14 +174,15 @@ def verify_file_permissions(path: Path) -> bool:
 
 
 def write_data(*, data: List[Dict], file_path: Path) -> None:
-    """Write the gz-iped raw data to file_path."""
+    """Append the raw data to file_path as newline delimited JSON.
+
+    The codec is chosen by the suffix of file_path, see archive."""
     dst_dir = file_path.parent
     if not dst_dir.expanduser().is_dir():
         log.warning(f"Creating the data destination directory {dst_dir}.")
         os.makedirs(dst_dir.expanduser().as_posix())
 
-    with gzip.open(file_path.expanduser().as_posix(), "wb") as fh:
-        fh.write(json.dumps(data).encode("utf-8"))
+    append_records(file_path.expanduser(), data)
 
 
 def write_data_frames(
@@ -206,6 +206,150 @@ def write_data_frames(
         df.to_hdf(file_path, key=name)
 
 
+def naive_utc(timestamp: pd.Timestamp) -> pd.Timestamp:
+    """Return the timestamp as naive UTC timestamp. Naive timestamps are UTC already."""
+    timestamp = pd.Timestamp(timestamp)
+    return timestamp.tz_convert(None) if timestamp.tzinfo else timestamp
+
+
+def data_frame_files(
+    *, config: Box, name: str, date_from: pd.Timestamp, date_to: pd.Timestamp
+) -> List[Path]:
+    """Return the existing monthly hdf5 files of name covering the time range."""
+    data_dir = Path(config.file_location.data_dir).expanduser()
+    months = pd.period_range(naive_utc(date_from), naive_utc(date_to), freq="M")
+    file_paths = (data_dir / f"{name}_{m.year}-{m.month:02d}.hdf5" for m in months)
+    return [p for p in file_paths if p.is_file()]
+
+
+def read_data_frames(
+    *, config: Box, name: str, date_from: pd.Timestamp, date_to: pd.Timestamp
+) -> pd.DataFrame:
+    """Return the data of name stored by write_data_frames or append_data_frames
+    in the time range [date_from, date_to)."""
+    data_frames = [
+        pd.read_hdf(p, name)
+        for p in data_frame_files(
+            config=config, name=name, date_from=date_from, date_to=date_to
+        )
+    ]
+    if not data_frames:
+        return pd.DataFrame()
+    df = pd.concat(data_frames).sort_index()
+    return df[(df.index >= date_from) & (df.index < date_to)]
+
+
+def append_data_frames(
+    *,
+    config: Box,
+    data_frames: List[pd.DataFrame],
+    name: str,
+    dedup_columns: Optional[List[str]] = None,
+    fill_values: Optional[Dict[str, str]] = None,
+) -> None:
+    """Append the data as a Pandas DataFrame to monthly hdf5 files in table format.
+
+    Unlike write_data_frames the existing data is not loaded and rewritten. Only the
+    rows overlapping the time range of the new data are read to drop duplicates.
+    Rows are duplicates if the index and all dedup_columns match.
+    Files written by write_data_frames (fixed format) are converted once. String
+    columns they lack are filled with fill_values or "".
+    """
+    if not data_frames:
+        log.debug(f"Did not receive any data for {name}.")
+        return
+    for df in data_frames:
+        if not len(df):
+            log.debug(f"Did not find any data in {df}. Skipping...")
+            continue
+        keys = pd.Series(list(_index_keys(df, dedup_columns)), dtype=object)
+        df = df[~keys.duplicated(keep="last").values]
+        first_ts = min(df.index)
+        file_name = f"{name}_{first_ts.year}-{first_ts.month:02d}.hdf5"
+        file_path = (Path(config.file_location.data_dir) / Path(file_name)).expanduser()
+        with pd.HDFStore(file_path.as_posix()) as store:
+            if name in store and (
+                not store.get_storer(name).is_table
+                or _numeric_strings(store.select(name, start=0, stop=0), df)
+            ):
+                log.info(f"Converting {file_path} to the appendable table format.")
+                df_prev = _with_strings(store[name], df, fill_values or {})
+                store.remove(name)
+                _hdf_append(store, name, df_prev)
+            if name in store:
+                empty = store.select(name, start=0, stop=0)
+                columns = list(empty.columns)
+                dropped = set(df.columns) - set(columns)
+                if dropped:
+                    log.warning(
+                        f"Dropping the columns {', '.join(sorted(dropped))} unknown to {file_path}."
+                    )
+                # Missing strings, e. g. all NaN, must still be strings.
+                df = _with_strings(
+                    df.reindex(columns=columns), empty, fill_values or {}
+                )
+                df_prev = store.select(name, where="index >= first_ts")
+                if len(df_prev):
+                    known = set(_index_keys(df_prev, dedup_columns))
+                    df = df[[k not in known for k in _index_keys(df, dedup_columns)]]
+            if len(df):
+                _hdf_append(store, name, df)
+
+
+def _numeric_strings(df_prev: pd.DataFrame, df: pd.DataFrame) -> List[str]:
+    """Return the string columns of df stored as numbers in df_prev, e. g. as NaN
+    by an earlier conversion."""
+    return [
+        c
+        for c in df.columns
+        if c in df_prev.columns and df[c].dtype == object and df_prev[c].dtype != object
+    ]
+
+
+def _with_strings(
+    df_prev: pd.DataFrame, df: pd.DataFrame, fill_values: Dict[str, str]
+) -> pd.DataFrame:
+    """Return df_prev with the columns of df. String columns of df it lacks or
+    holds as numbers are strings, missing values are fill_values or ""."""
+    columns = list(df_prev.columns) + [
+        c for c in df.columns if c not in df_prev.columns
+    ]
+    df_prev = df_prev.reindex(columns=columns)
+    for c in df.columns:
+        if df[c].dtype == object and df_prev[c].dtype != object:
+            values = df_prev[c].astype(object)
+            values = values.where(values.notna(), fill_values.get(c, ""))
+            df_prev[c] = values.astype(str)
+    return df_prev
+
+
+def _index_keys(df: pd.DataFrame, columns: Optional[List[str]] = None):
+    """Return an iterator of (index, *columns) tuples identifying the rows of df."""
+    return zip(df.index, *(df[c] for c in columns or []))
+
+
+def _hdf_append(store: pd.HDFStore, name: str, df: pd.DataFrame) -> None:
+    """Append df to the table name. Reserve space for strings on creation."""
+    min_itemsize = None
+    if name not in store:
+        min_itemsize = {c: 128 for c in df.columns if df[c].dtype == object}
+    store.append(name, df, format="table", min_itemsize=min_itemsize or None)
+
+
+def collection_lock(config: Box, name: str, shared: bool = False):
+    """Return the lock of the Pystore collection name.
+
+    Writers and the compaction hold it exclusively, readers shared. Readers never
+    see an item while it is replaced."""
+    lock_path = Path(config.file_location.data_dir).expanduser() / "locks"
+    return file_lock(lock_path / f"{name}.lock", shared=shared)
+
+
+def init_pystore(config: Box) -> None:
+    """Set the Pystore directory to the data dir."""
+    pystore.set_path(Path(config.file_location.data_dir).expanduser().as_posix())
+
+
 def write_data_to_pystore(
     *,
     config: Box,
@@ -220,11 +364,10 @@ def write_data_to_pystore(
     as the item name.
     Each dataframe must only contain data of one day! This function doesn't check max(df.index).
 
-    Note, PyStore will make sure there is a unique index:
-
-    ~/.../site-packages/pystore/collection.py in append(self, item, data, npartitions, epochdate, threaded, reload_items, **kwargs)
-    183         # combined = current.data.append(new)
-    184         combined = dd.concat([current.data, new]).drop_duplicates(keep="last")
+    Data is appended to an existing item as a new parquet file. Only the files
+    overlapping the new data in time are merged with it, see
+    append_to_pystore_item. The key_columns of the metadata tell which rows are
+    the same. The compaction merges the files later on, see compact.
 
     PyStore:
     https://medium.com/@aroussi/fast-data-store-for-pandas-time-series-data-using-pystore-89d9caeef4e2
@@ -235,6 +378,13 @@ def write_data_to_pystore(
     if not data_frames:
         log.debug(f"Did not receive any data for {name}.")
         return
+    with collection_lock(config, name):
+        _write_data_to_pystore(data_frames=data_frames, name=name, metadata=metadata)
+
+
+def _write_data_to_pystore(
+    *, data_frames: List[pd.DataFrame], name: str, metadata: Dict
+) -> None:
     store = pystore.store("discovergy")
     collection = store.collection(name)
     item_names = collection.list_items()
@@ -245,11 +395,246 @@ def write_data_to_pystore(
         first_ts = min(df.index)
         item_name = f"{first_ts.year}-{first_ts.month:02d}"
         if item_name in item_names:
-            # FIXME (a8): Create one partition per day. There must be a better way. Issue is that
-            # pandas loads the full pd.DataFrame into memory. That requires memory.
-            npartitions = first_ts.day
             log.debug(f"Appended to {item_name} {first_ts}.")
-            collection.append(item_name, df, npartitions=npartitions)
+            append_to_pystore_item(
+                Path(collection._item_path(item_name)),
+                df,
+                key_columns=metadata.get("key_columns"),
+            )
         else:
             log.debug("Created new Dask DF.")
             collection.write(item_name, df, metadata=metadata, overwrite=False)
+            item_names.add(item_name)
+
+
+def parquet_part_files(item_path: Path) -> List[Path]:
+    """Return the parquet files of the Pystore item in the order they were written."""
+    parts = []
+    for file_path in item_path.iterdir():
+        match = re.match(r"^part\.(\d+)\.parquet$", file_path.name)
+        if match:
+            parts.append((int(match.group(1)), file_path))
+    return [file_path for _, file_path in sorted(parts)]
+
+
+def write_parquet_file(
+    df: pd.DataFrame, file_path: Path, row_group_rows: Optional[int] = None
+) -> None:
+    """Write df sorted by index to a parquet file.
+
+    :param row_group_rows: min. rows of a row group. Row groups hold whole days.
+        Defaults to one row group.
+    """
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    day_rows = df.groupby(df.index.normalize(), sort=True).size().to_numpy()
+    row_group_rows = row_group_rows or len(df)
+    with pq.ParquetWriter(
+        file_path.as_posix(), table.schema, compression="snappy"
+    ) as writer:
+        start = rows = 0
+        for n in day_rows:
+            rows += n
+            if rows >= row_group_rows:
+                writer.write_table(table.slice(start, rows), row_group_size=rows)
+                start, rows = start + rows, 0
+        if rows:
+            writer.write_table(table.slice(start, rows), row_group_size=rows)
+
+
+def read_parquet_files(files: List[Path]) -> pd.DataFrame:
+    """Return the concatenated data of the parquet files of a Pystore item."""
+    return pd.concat([pq.read_table(f.as_posix()).to_pandas() for f in files])
+
+
+def read_pystore_index(files: List[Path]) -> np.ndarray:
+    """Return the index of the parquet files of a Pystore item without the data."""
+    if not files:
+        return np.empty(0, dtype="datetime64[ns]")
+    index_name = pq.read_schema(files[-1].as_posix()).pandas_metadata[
+        "index_columns"
+    ][0]
+    return np.concatenate(
+        [
+            pq.read_table(f.as_posix(), columns=[index_name])
+            .column(index_name)
+            .to_numpy()
+            for f in files
+        ]
+    )
+
+
+def parquet_index_range(
+    parquet_file: pq.ParquetFile, index_name: str
+) -> Optional[Tuple[pd.Timestamp, pd.Timestamp]]:
+    """Return min and max of the index of the file from the row group statistics.
+
+    None if the file has no statistics of the index."""
+    metadata = parquet_file.metadata
+    if not metadata.num_row_groups:
+        return None
+    names = [
+        metadata.row_group(0).column(i).path_in_schema
+        for i in range(metadata.num_columns)
+    ]
+    if index_name not in names:
+        return None
+    column = names.index(index_name)
+    minimum = maximum = None
+    for i in range(metadata.num_row_groups):
+        statistics = metadata.row_group(i).column(column).statistics
+        if statistics is None or not statistics.has_min_max:
+            return None
+        row_min, row_max = pd.Timestamp(statistics.min), pd.Timestamp(statistics.max)
+        minimum = row_min if minimum is None else min(minimum, row_min)
+        maximum = row_max if maximum is None else max(maximum, row_max)
+    return minimum, maximum
+
+
+def append_to_pystore_item(
+    item_path: Path, df: pd.DataFrame, key_columns: Optional[List[str]] = None
+) -> None:
+    """Append df to the Pystore item as a new parquet file.
+
+    Unlike Pystore's append this doesn't read and rewrite the whole item. The
+    time range of df is compared to the min/max statistics of the index of
+    each file. If no file overlaps, df is written as a new file. Otherwise,
+    only the overlapping files are merged with df into a new file. In the
+    overlap the new rows win. Rows are the same if their index and their
+    key_columns are equal, see journal.drop_duplicates.
+
+    Columns of the item that df lacks are written as nulls. If df has new
+    columns or the types don't match the stored ones, the item is rewritten
+    as one file with the union of the columns.
+    """
+    files = parquet_part_files(item_path)
+    schema = pq.read_schema(files[-1].as_posix())
+    # Dask names the index __null_dask_index__. All files must use the same name.
+    index_name = schema.pandas_metadata["index_columns"][0]
+    df = df.rename_axis(index_name)
+    first_ts, last_ts = naive_utc(df.index.min()), naive_utc(df.index.max())
+    overlapping = []
+    for file_path in files:
+        index_range = parquet_index_range(
+            pq.ParquetFile(file_path.as_posix()), index_name
+        )
+        if index_range is None or (
+            naive_utc(index_range[0]) <= last_ts
+            and first_ts <= naive_utc(index_range[1])
+        ):
+            overlapping.append(file_path)
+    seq = int(files[-1].name.split(".")[1]) + 1
+    tmp_path = item_path / f".part.{seq}.parquet.tmp"
+    columns = [name for name in schema.names if name != index_name]
+    try:
+        if not set(df.columns) <= set(columns):
+            raise ValueError("The columns differ.")
+        table = pa.Table.from_pandas(
+            df.reindex(columns=columns), schema=schema, preserve_index=True
+        )
+    except (KeyError, ValueError, pa.ArrowException):
+        log.debug(f"The schema of {item_path} changed. Rewriting it.")
+        overlapping, table = files, None
+    if overlapping:
+        log.debug(f"Merging {len(overlapping)} files of {item_path} with the new data.")
+        df = _merge(read_parquet_files(overlapping), df, key_columns)
+        write_parquet_file(df.rename_axis(index_name), tmp_path)
+    else:
+        pq.write_table(table, tmp_path.as_posix(), compression="snappy")
+    os.replace(tmp_path, item_path / f"part.{seq}.parquet")
+    # Readers hold the collection lock. They never see both.
+    for file_path in overlapping:
+        file_path.unlink()
+
+
+def _merge(
+    df_prev: pd.DataFrame, df: pd.DataFrame, key_columns: Optional[List[str]] = None
+) -> pd.DataFrame:
+    """Return the union of the stored and the new rows sorted by index. New rows win."""
+    df = pd.concat([df_prev, df])
+    if key_columns:
+        keys = df[key_columns].reset_index()
+    else:
+        keys = df.index.to_frame()
+    df = df[~keys.duplicated(keep="last").to_numpy()]
+    return df.sort_index(kind="mergesort")
+
+
+def read_data_from_pystore(
+    *,
+    config: Box,
+    name: str,
+    date_from: pd.Timestamp,
+    date_to: pd.Timestamp,
+    columns: Optional[List[str]] = None,
+) -> pd.DataFrame:
+    """Return the data of the Pystore collection name in the time range [date_from, date_to).
+
+    Only the monthly items overlapping the time range are read. The returned data
+    has a naive UTC index like the power data.
+    """
+    store = pystore.store("discovergy")
+    if name not in store.list_collections():
+        log.debug(f"There is no collection {name}.")
+        return pd.DataFrame()
+    # The power data is stored with a naive UTC index.
+    date_from, date_to = naive_utc(date_from), naive_utc(date_to)
+    months = pd.period_range(date_from, date_to, freq="M")
+    data_frames = []
+    with collection_lock(config, name, shared=True):
+        collection = store.collection(name)
+        item_names = collection.list_items()
+        for month in months:
+            item_name = f"{month.year}-{month.month:02d}"
+            if item_name not in item_names:
+                continue
+            df = collection.item(item_name, columns=columns).to_pandas()
+            if df.index.tz is not None:
+                df.index = df.index.tz_convert(None)
+            data_frames.append(df[(df.index >= date_from) & (df.index < date_to)])
+    if not data_frames:
+        return pd.DataFrame()
+    return pd.concat(data_frames).sort_index()
+
+
+def read_watermark(*, config: Box, name: str) -> Optional[pd.Timestamp]:
+    """Return the timestamp up to which the data of name was fetched."""
+    file_path = Path(config.file_location.data_dir).expanduser() / "watermarks.json"
+    try:
+        with file_path.open() as fh:
+            watermarks = json.load(fh)
+    except FileNotFoundError:
+        return None
+    if name not in watermarks:
+        return None
+    return pd.Timestamp(watermarks[name], unit="s", tz="utc")
+
+
+def write_watermark(*, config: Box, name: str, timestamp: pd.Timestamp) -> None:
+    """Record that the data of name was fetched up to timestamp."""
+    file_path = Path(config.file_location.data_dir).expanduser() / "watermarks.json"
+    # Poller workers sharing the data dir update the file concurrently.
+    with file_lock(file_path.with_suffix(".lock")):
+        try:
+            with file_path.open() as fh:
+                watermarks = json.load(fh)
+        except FileNotFoundError:
+            watermarks = {}
+        watermarks[name] = timestamp.timestamp()
+        tmp_path = file_path.with_suffix(".tmp")
+        with tmp_path.open("w") as fh:
+            json.dump(watermarks, fh)
+        os.replace(tmp_path, file_path)
+
+
+@contextmanager
+def file_lock(path: Path, shared: bool = False) -> Iterator[None]:
+    """Hold an exclusive lock on path across processes, e. g. poller workers.
+
+    :param shared: hold a shared lock instead, e. g. to read"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with os.fdopen(os.open(path.as_posix(), os.O_RDWR | os.O_CREAT, 0o600)) as fh:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
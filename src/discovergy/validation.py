@@ -0,0 +1,186 @@
+# -*- coding: utf-8 -*-
+
+"""
+
+Discovergy reading validation
+
+Validate a batch of raw Discovergy readings at once. A reading is rejected if
+
+* its time is missing,
+* a field fetched, all of FIELDS by default, is missing,
+* a value is not an integer,
+* an energy counter or a voltage is negative (power is negative when feeding in),
+* an energy counter is below its highest value in the previous valid readings.
+
+Rejected readings are kept in the Pystore collection quarantine_<meter_id> with
+the reason and the values as sent, so they can be inspected and re-imported.
+The counts of each batch are logged and summed up per collection, see metrics.
+"""
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import json
+
+from collections import Counter
+from timeit import default_timer
+from typing import Dict, List, NamedTuple, Sequence
+
+import numpy as np  # type: ignore
+import pandas as pd  # type: ignore
+
+from box import Box  # type: ignore
+from loguru import logger as log
+
+from .journal import get_journal
+
+
+FIELDS = (
+    "energy",
+    "energy1",
+    "energy2",
+    "energyOut",
+    "energyOut1",
+    "energyOut2",
+    "power",
+    "power1",
+    "power2",
+    "power3",
+    "voltage1",
+    "voltage2",
+    "voltage3",
+)
+COUNTER_FIELDS = [f for f in FIELDS if f.startswith("energy")]
+NON_NEGATIVE_FIELDS = [f for f in FIELDS if f.startswith(("energy", "voltage"))]
+
+# In the order they are checked. A reading is rejected for the first one found.
+REASONS = (
+    "missing_time",
+    "missing_field",
+    "not_integer",
+    "negative",
+    "counter_decreasing",
+)
+
+_metrics: Dict[str, Counter] = {}
+
+
+class ValidationStats(NamedTuple):
+    readings: int
+    rejected: int
+    reasons: Dict[str, int]
+    seconds: float
+
+
+class Validation(NamedTuple):
+    # The valid readings, index: naive UTC time, columns: the fields as int64
+    readings: pd.DataFrame
+    # The rejected readings, columns: reason and the values as JSON
+    rejected: pd.DataFrame
+    stats: ValidationStats
+
+
+def validate_readings(data: List[Dict], fields: Sequence[str] = FIELDS) -> Validation:
+    """Split the raw readings as returned by the Discovergy API into valid and
+    rejected ones.
+
+    :param fields: the fields fetched, see power.meter_fields. Other fields are
+        dropped."""
+    start = default_timer()
+    counter_fields = [f for f in COUNTER_FIELDS if f in fields]
+    non_negative_fields = [f for f in NON_NEGATIVE_FIELDS if f in fields]
+    times = pd.to_numeric(
+        pd.Series([r.get("time") for r in data], dtype=object), errors="coerce"
+    )
+    raw = pd.DataFrame(
+        [r.get("values") if isinstance(r.get("values"), dict) else {} for r in data],
+        columns=list(fields),
+    )
+    values = raw.apply(pd.to_numeric, errors="coerce").astype("float64")
+    checks = {
+        "missing_time": times.isna().to_numpy(),
+        "missing_field": raw.isna().any(axis=1).to_numpy(),
+        "not_integer": ((values.isna() != raw.isna()) | (values % 1 > 0))
+        .any(axis=1)
+        .to_numpy(),
+        "negative": (values[non_negative_fields] < 0).any(axis=1).to_numpy(),
+    }
+    # Compare the counters of the readings passing the other checks to their
+    # max in the accepted readings before. E. g. of 100, 200, 150, 160 both the
+    # 150 and the 160 are rejected. Up to the first rejected reading that is the
+    # running max of all readings. After it a reading rejected for one counter
+    # must not raise the max of another, so these are checked one by one.
+    passed = ~np.logical_or.reduce(list(checks.values()), initial=False)
+    order = np.argsort(times.to_numpy(), kind="stable")
+    order = order[passed[order]]
+    counters = values[counter_fields].to_numpy()[order]
+    decreasing = np.zeros(len(order), dtype=bool)
+    running = np.maximum.accumulate(counters, axis=0)
+    below = (counters[1:] < running[:-1]).any(axis=1)
+    if below.any():
+        first = int(np.argmax(below)) + 1
+        highest = running[first - 1]
+        for i in range(first, len(order)):
+            if (counters[i] < highest).any():
+                decreasing[i] = True
+            else:
+                highest = counters[i]
+    checks["counter_decreasing"] = np.zeros(len(data), dtype=bool)
+    checks["counter_decreasing"][order] = decreasing
+    reason = np.select([checks[r] for r in REASONS], REASONS, default="")
+    valid = reason == ""
+
+    index = pd.DatetimeIndex(pd.to_datetime(times, unit="ms"))
+    readings = values[valid].astype("int64").set_axis(index[valid])
+    # Readings without a time are quarantined as of now.
+    now = pd.Timestamp.utcnow().tz_convert(None)
+    rejected = pd.DataFrame(
+        {
+            "reason": reason[~valid].astype(str),
+            "values": [
+                json.dumps(data[i].get("values")) for i in np.flatnonzero(~valid)
+            ],
+        },
+        index=index[~valid].fillna(now),
+    )
+    reasons = Counter(reason[~valid])
+    stats = ValidationStats(
+        readings=len(data),
+        rejected=int((~valid).sum()),
+        reasons={r: reasons[r] for r in REASONS if reasons[r]},
+        seconds=default_timer() - start,
+    )
+    return Validation(readings=readings, rejected=rejected, stats=stats)
+
+
+def quarantine(*, config: Box, meter_id: str, validation: Validation) -> None:
+    """Quarantine the rejected readings of the meter and record the stats."""
+    name = f"quarantine_{meter_id}"
+    stats = validation.stats
+    record_metrics(name, stats)
+    if not stats.rejected:
+        log.debug(f"All {stats.readings} readings of {meter_id} are valid.")
+        return
+    log.warning(
+        f"Rejected {stats.rejected} of {stats.readings} readings of {meter_id}: "
+        + ", ".join(f"{r} {n}" for r, n in stats.reasons.items())
+    )
+    get_journal(config).append(
+        name=name,
+        df=validation.rejected,
+        metadata={"meter_id": meter_id, "key_columns": ["reason", "values"]},
+    )
+
+
+def record_metrics(name: str, stats: ValidationStats) -> None:
+    """Add the stats of a batch to the metrics of the collection name."""
+    counter = _metrics.setdefault(name, Counter())
+    counter["batches"] += 1
+    counter["readings"] += stats.readings
+    counter["rejected"] += stats.rejected
+    counter.update(stats.reasons)
+
+
+def metrics() -> Dict[str, Dict[str, int]]:
+    """Return the validation counts per quarantine collection of this process."""
+    return {name: dict(counter) for name, counter in _metrics.items()}
@@ -9,41 +9,72 @@ __copyright__ = "Frank Becker"
 __license__ = "mit"
 
 import json
+import os
 import sys
+import time
 
-from typing import Dict, Optional
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
 
 import arrow  # type: ignore
-import numpy as np  # type: ignore
 import pandas as pd  # type: ignore
 
 from box import Box  # type: ignore
 from loguru import logger as log
 from pyowm import OWM  # type: ignore
 
-from .utils import write_data_frames
+from . import live
+from .defaults import (
+    WEATHER_COLUMNS,
+    WEATHER_FLUSH_INTERVAL,
+    WEATHER_FLUSH_SIZE,
+    WEATHER_STR_COLUMNS,
+)
+from .utils import append_data_frames, split_df_by_month
 
 
 def get(*, config: Box) -> None:
-    """Fetch and write weather data.
+    """Fetch weather data for all configured locations and buffer it.
+
+    Observations are appended to a durable buffer file first. The buffer is flushed
+    in one batch to the hdf5 files once it holds enough observations or the oldest
+    observation is too old. See flush_buffer.
 
     Note, for now only Open Weather Map is supported. Once multiple
     weather data sources are configurable this is going to be a dispatcher."""
 
-    owm_data = get_open_weather_map(config=config)
-    if not owm_data:
+    locations = get_locations(config=config)
+    if not locations:
         return
+    open_weather_map = OWM(config.open_weather_map["id"])
+    records = []
+    for location, (latitude, longitude) in locations.items():
+        owm_data = get_open_weather_map(
+            open_weather_map=open_weather_map, latitude=latitude, longitude=longitude
+        )
+        if not owm_data:
+            continue
+        records.append(raw_owm_to_record(data=owm_data, location=location))
+    if records:
+        buffer_records(config=config, records=records)
+        live.publisher.publish(
+            live.SourceUpdate(source="weather", data=records_to_df(records=records))
+        )
+    flush_buffer(config=config)
+
 
-    df = raw_owm_to_df(data=owm_data)
-    write_data_frames(config=config, data_frames=[df], name="weather")
+def get_locations(*, config: Box) -> Dict[str, Tuple[float, float]]:
+    """Return the configured locations as {name: (latitude, longitude)}.
 
+    The location given by latitude and longitude is named "default". Additional
+    locations can be configured as e. g.::
 
-def get_open_weather_map(*, config: Box) -> Optional[Dict]:
-    """Fetch and write the Open Weather Map data."""
+        locations: home=52.52,13.40; cabin=53.87,10.68
+    """
     try:
         owm_id = config.open_weather_map["id"]
-        latitude = float(config.open_weather_map["latitude"])
-        longitude = float(config.open_weather_map["longitude"])
+        latitude = config.open_weather_map["latitude"]
+        longitude = config.open_weather_map["longitude"]
     except KeyError:
         log.error(
             "The config file does not contain all Open Weather Map config keys (id, latitude, longitude). Cannot continue."
@@ -51,18 +82,34 @@ def get_open_weather_map(*, config: Box) -> Optional[Dict]:
         sys.exit(1)
     if owm_id.lower() == "none":
         log.debug("Open Weather Map is not configured.")
-        return
-
-    open_weather_map = OWM(owm_id)
-    if not open_weather_map.is_API_online():
-        log.warning("Open Weather Map endpoint is not online-line.")
-        return
+        return {}
+
+    locations = {}
+    if latitude.lower() != "none" and longitude.lower() != "none":
+        locations["default"] = (float(latitude), float(longitude))
+    for location in config.open_weather_map.get("locations", "").split(";"):
+        if not location.strip():
+            continue
+        try:
+            name, coordinates = location.split("=")
+            lat, lon = (float(e) for e in coordinates.split(","))
+        except ValueError:
+            log.error(f"Could not parse the Open Weather Map location '{location}'.")
+            continue
+        locations[name.strip()] = (lat, lon)
+    return locations
+
+
+def get_open_weather_map(
+    *, open_weather_map: OWM, latitude: float, longitude: float
+) -> Optional[Dict]:
+    """Fetch and return the Open Weather Map data for the given coordinates."""
     start_ts = arrow.utcnow()
     try:
         weather = open_weather_map.weather_at_coords(latitude, longitude)
     except Exception as e:
         log.warning("Could not fetch weather: {}.".format(str(e)))
-        return
+        return None
     else:
         elapsed_time = arrow.utcnow() - start_ts
         log.debug(
@@ -72,14 +119,101 @@ def get_open_weather_map(*, config: Box) -> Optional[Dict]:
         weather = json.loads(weather.to_JSON())
     except json.JSONDecodeError as e:
         log.warning(f"Could not JSON decode weather data: {e}.")
+        return None
     except Exception as e:
         log.warning(f"Could not convert weather data {weather} to JSON: {e}.")
-        return
+        return None
     return weather
 
 
-def raw_owm_to_df(*, data: Dict) -> pd.DataFrame:
-    """Return the raw OWM Weather data as a Pandas DataFrame."""
+def buffer_file_path(config: Box) -> Path:
+    """Return the path of the weather buffer file."""
+    return (Path(config.file_location.data_dir) / "weather_buffer.jsonl").expanduser()
+
+
+def buffer_records(*, config: Box, records: List[Dict]) -> None:
+    """Durably append the weather records to the buffer file."""
+    file_path = buffer_file_path(config)
+    with file_path.open("a") as fh:
+        for record in records:
+            fh.write(json.dumps(record) + "\n")
+        fh.flush()
+        os.fsync(fh.fileno())
+
+
+def read_buffer(file_path: Path) -> List[Dict]:
+    """Return the records of the buffer file. Skip a torn last line."""
+    records = []
+    try:
+        with file_path.open() as fh:
+            for line in fh:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    log.warning(f"Skipping a corrupt record in {file_path}.")
+    except FileNotFoundError:
+        pass
+    return records
+
+
+def flush_buffer(*, config: Box, force: bool = False) -> None:
+    """Write the buffered weather records in one batch if a threshold is reached.
+
+    The buffer is renamed before it is written. A left over renamed buffer, e. g.
+    after a crash, is written first. Duplicates are dropped by append_data_frames.
+    """
+    file_path = buffer_file_path(config)
+    flushing_path = file_path.with_suffix(".flushing")
+    if flushing_path.exists():
+        log.info(f"Found the unflushed weather buffer {flushing_path}. Writing it...")
+        _write_records(config=config, records=read_buffer(flushing_path))
+        flushing_path.unlink()
+
+    records = read_buffer(file_path)
+    if not records:
+        return
+    flush_size = int(config.open_weather_map.get("flush_size", WEATHER_FLUSH_SIZE))
+    flush_interval = int(
+        config.open_weather_map.get("flush_interval", WEATHER_FLUSH_INTERVAL)
+    )
+    age = time.time() - min(r["reference_time"] for r in records)
+    if not force and len(records) < flush_size and age < flush_interval:
+        log.debug(f"Buffered {len(records)} weather records.")
+        return
+    os.replace(file_path, flushing_path)
+    _write_records(config=config, records=records)
+    flushing_path.unlink()
+
+
+def _write_records(*, config: Box, records: List[Dict]) -> None:
+    """Write the weather records to the hdf5 files."""
+    if not records:
+        return
+    df = records_to_df(records=records)
+    log.debug(f"Writing {len(df)} weather records.")
+    append_data_frames(
+        config=config,
+        data_frames=split_df_by_month(df=df),
+        name="weather",
+        dedup_columns=["location"],
+        fill_values={"location": "default"},
+    )
+
+
+def records_to_df(*, records: List[Dict]) -> pd.DataFrame:
+    """Return the flat weather records as one Pandas DataFrame with fixed columns."""
+    index = pd.to_datetime([r["reference_time"] for r in records], unit="s", utc=True)
+    df = pd.DataFrame.from_records(records, index=index)
+    df = df.drop(columns="reference_time").reindex(columns=WEATHER_COLUMNS)
+    for column in WEATHER_COLUMNS:
+        if column not in WEATHER_STR_COLUMNS:
+            df[column] = pd.to_numeric(df[column], errors="coerce").astype("float64")
+    df = df.sort_index(kind="mergesort")
+    return df
+
+
+def raw_owm_to_record(*, data: Dict, location: str = "default") -> Dict:
+    """Return the raw OWM Weather data as a flat record."""
     # 1) Only store what we don't know. Dropping location info.
     weather_data = data["Weather"]
     # 2) Flatten nested data
@@ -98,28 +232,20 @@ def raw_owm_to_df(*, data: Dict) -> pd.DataFrame:
     snow_data = weather_data.pop("snow")
     for k, v in snow_data.items():
         weather_data[f"snow_{k}"] = v
-    # 3) Get index
-    time_stamp = weather_data.pop("reference_time")
-    index = [pd.Timestamp(time_stamp, unit="s", tz="utc")]
-    # 4) Gen data frame
-    for k, v in weather_data.items():
-        if v is None:
-            weather_data[k] = np.nan
-    df = pd.DataFrame(weather_data, index=index)
+    weather_data["location"] = location
+    return weather_data
 
-    return df
+
+def raw_owm_to_df(*, data: Dict, location: str = "default") -> pd.DataFrame:
+    """Return the raw OWM Weather data as a Pandas DataFrame."""
+    return records_to_df(records=[raw_owm_to_record(data=data, location=location)])
 
 
-def data_from_files():
+def data_from_files(data_dir: str = ".", config: Optional[Box] = None) -> None:
+    """Import dumped raw data from the files in data_dir. See importer."""
+    from . import importer
     from .config import read_config
-    import os
-    import json
-
-    config = read_config()
-    for f in os.listdir():
-        if f.startswith("open_weather_map"):
-            print(f)
-            with open(f) as fh:
-                data = json.loads(json.load(fh))
-            df = raw_owm_to_df(data=data)
-            write_data_frames(config=config, data_frames=[df], name="weather")
+
+    importer.import_files(
+        config=config or read_config(), source="weather", data_dir=Path(data_dir)
+    )
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from box import Box
+
+from discovergy import anomaly
+from discovergy.live import LiveReading
+
+
+@pytest.fixture
+def config(tmp_path):
+    return Box(file_location={"data_dir": tmp_path.as_posix()})
+
+
+def power(date_from, date_to, mw=100000.0, seed=0):
+    """Stored power data with some noise."""
+    index = pd.date_range(date_from, date_to, freq="s", inclusive="left")
+    noise = np.random.default_rng(seed).normal(0, 5000, len(index))
+    return pd.DataFrame({"power": mw + noise}, index=index)
+
+
+def test_batches_equal_stream():
+    df = power("2020-03-01", "2020-03-03")
+    times = df.index.values.astype("datetime64[s]").astype("int64")
+    values = df["power"].to_numpy()
+    batch = anomaly.Detector(meter_id="m")
+    batch.add(times, values)
+    stream = anomaly.Detector(meter_id="m")
+    for i in range(0, len(times), 7777):
+        stream.add(times[i : i + 7777], values[i : i + 7777])
+    pd.testing.assert_frame_equal(batch.profile(), stream.profile())
+    assert batch.count.sum() == 2 * 1440 - 1
+
+
+def test_anomaly(config):
+    for day in pd.date_range("2020-03-01", "2020-03-08"):
+        df = power(day, day + pd.Timedelta(days=1), seed=day.day)
+        assert anomaly.update(config=config, meter_id="m", df=df) == []
+    profile = anomaly.get_detector(config, "m").profile()
+    np.testing.assert_allclose(profile["mean"], 100000, rtol=0.01)
+    # A stuck heater for half an hour
+    df = power("2020-03-09 00:00", "2020-03-09 01:00")
+    df.loc["2020-03-09 00:10":"2020-03-09 00:39", "power"] += 2000000
+    anomalies = anomaly.update(config=config, meter_id="m", df=df)
+    assert len(anomalies) == 1
+    assert anomalies[0].start == pd.Timestamp("2020-03-09 00:10")
+    assert anomalies[0].time == pd.Timestamp("2020-03-09 00:24")
+    assert anomalies[0].score > 4
+    with anomaly.events_path(config, "m").open() as fh:
+        assert json.loads(fh.readline())["start"] == "2020-03-09T00:10:00"
+
+
+def test_live_readings_keep_the_batch(config):
+    df = power("2020-03-01 00:00", "2020-03-01 00:10")
+    timestamp = int(df.index[-1].value // 10**6)
+    anomaly.add_live_readings(
+        config=config,
+        readings=[LiveReading(meter_id="m", timestamp=timestamp, values={"power": 1})],
+    )
+    anomaly.update(config=config, meter_id="m", df=df)
+    detector = anomaly.get_detector(config, "m")
+    # The samples before the live reading still update the profile.
+    assert detector.last_time == timestamp // 1000
+    assert detector.count.sum() == 9
+    assert detector.live_time == timestamp // 1000
+
+
+def test_live_anomaly(config):
+    for day in pd.date_range("2020-03-01", "2020-03-08"):
+        df = power(day, day + pd.Timedelta(days=1), seed=day.day)
+        anomaly.update(config=config, meter_id="m", df=df)
+    count = anomaly.get_detector(config, "m").count.sum()
+    df = power("2020-03-09 00:00", "2020-03-09 01:00")
+    df.loc["2020-03-09 00:10":"2020-03-09 00:39", "power"] += 2000000
+    readings = [
+        LiveReading(meter_id="m", timestamp=ts.value // 10**6, values={"power": p})
+        for ts, p in df["power"].iloc[::10].items()
+    ]
+    anomalies = []
+    # A poll every minute
+    for i in range(0, len(readings), 6):
+        anomalies += anomaly.add_live_readings(
+            config=config, readings=readings[i : i + 6]
+        )
+    assert len(anomalies) == 1
+    assert anomalies[0].start == pd.Timestamp("2020-03-09 00:10")
+    assert anomalies[0].time == pd.Timestamp("2020-03-09 00:24")
+    assert anomaly.get_detector(config, "m").count.sum() == count
+    # The batch updates the profile but doesn't report the anomaly again.
+    assert anomaly.update(config=config, meter_id="m", df=df) == []
+    assert anomaly.get_detector(config, "m").count.sum() == count + 60
+
+
+def test_disabled(config):
+    config.anomaly = {"threshold": 0}
+    df = power("2020-03-01 00:00", "2020-03-01 00:10")
+    assert anomaly.update(config=config, meter_id="m", df=df) == []
+    assert not anomaly.detector_path(config, "m").exists()
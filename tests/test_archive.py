@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import gzip
+import json
+
+import pandas as pd
+
+from discovergy.archive import ArchiveWriter, read_records
+
+
+def test_archive_writer(tmp_path):
+    writer = ArchiveWriter(directory=tmp_path, name="raw", codec="gzip")
+    day = 86400 * 1000
+    assert writer.write([{"time": 0, "v": 1}, {"time": day, "v": 2}]) == 2
+    # Appending adds to the file of the day.
+    assert writer.write([{"time": 1000, "v": 3}]) == 1
+    first = writer.file_path(pd.Timestamp("1970-01-01"))
+    assert first.name == "raw_1970-01-01.ndjson.gz"
+    assert [r["v"] for r in read_records(first)] == [1, 3]
+    second = writer.file_path(pd.Timestamp("1970-01-02"))
+    assert [r["v"] for r in read_records(second)] == [2]
+
+    # A torn last line is skipped.
+    with gzip.open(first.as_posix(), "ab") as fh:
+        fh.write(b'{"time": 2000, "v"')
+    assert [r["v"] for r in read_records(first)] == [1, 3]
+
+
+def test_read_legacy_records(tmp_path):
+    file_path = tmp_path / "discovergy_data_1.json.gz"
+    with gzip.open(file_path.as_posix(), "wb") as fh:
+        fh.write(json.dumps([{"time": 0}, {"time": 1000}]).encode("utf-8"))
+    assert list(read_records(file_path)) == [{"time": 0}, {"time": 1000}]
+
+
+def test_read_truncated_records(tmp_path):
+    writer = ArchiveWriter(directory=tmp_path, name="raw", codec="gzip")
+    writer.write([{"time": 0, "v": 1}])
+    writer.write([{"time": 1000, "v": i} for i in range(2, 1000)])
+    file_path = writer.file_path(pd.Timestamp("1970-01-01"))
+    # A crash while appending the second member
+    data = file_path.read_bytes()
+    file_path.write_bytes(data[: len(data) - 100])
+    records = list(read_records(file_path))
+    assert records[0] == {"time": 0, "v": 1}
+    assert 1 < len(records) < 999
+    assert [r["v"] for r in records] == list(range(1, len(records) + 1))
@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import json
+
+from box import Box
+
+from discovergy.api import save_meters
+from discovergy.cluster import HashRing, Membership, RateLimiter, owns
+
+
+def test_hash_ring_moves_only_the_keys_of_a_dead_worker():
+    keys = [f"meter{i}" for i in range(1000)]
+    ring = HashRing(["a", "b", "c", "d"])
+    before = {k: ring.owner(k) for k in keys}
+    assert set(before.values()) == {"a", "b", "c", "d"}
+    after = {k: HashRing(["a", "b", "d"]).owner(k) for k in keys}
+    moved = [k for k in keys if before[k] != after[k]]
+    assert moved and all(before[k] == "c" for k in moved)
+    assert HashRing([]).owner("meter0") is None
+
+
+def test_owns_splits_meters_between_workers(tmp_path):
+    members = ["host-0", "host-1"]
+    configs = [
+        Box(
+            discovergy_account={"email": "me@example.com"},
+            file_location={"data_dir": tmp_path.as_posix()},
+            shard={"worker_id": worker_id, "members": members, "primary": True},
+        )
+        for worker_id in members
+    ]
+    for key in ("meter1", "meter2", "meter3"):
+        assert sum(owns(config, key) for config in configs) == 1
+    assert sum(owns(config, "awattar", account=False) for config in configs) == 1
+    configs[0].shard.primary = configs[1].shard.primary = False
+    assert not any(owns(config, "awattar", account=False) for config in configs)
+
+
+def test_membership(tmp_path):
+    config = Box(file_location={"data_dir": tmp_path.as_posix()})
+    a = Membership(config=config, worker_id="a")
+    b = Membership(config=config, worker_id="b", timeout=0)
+    a.beat()
+    b.beat()
+    assert a.live() == {"a", "b"}
+    assert b.live() == set()
+    a.leave()
+    assert a.live() == {"b"}
+
+
+def test_rate_limiter(tmp_path):
+    path = tmp_path / "rate_limit.json"
+    limiter = RateLimiter(path=path, rate=2)
+    assert limiter._take() == 0
+    assert limiter._take() == 0
+    assert limiter._take() > 0
+    # Another process sees the same bucket.
+    assert RateLimiter(path=path, rate=2)._take() > 0
+
+
+def test_save_meters_merges(tmp_path):
+    config = Box(config_file_path=tmp_path / "discovergy.ini")
+    save_meters(config=config, meters={"m1": {"meterId": "m1"}})
+    # Another worker saves its meters.
+    save_meters(config=config, meters={"m2": {"meterId": "m2", "timestamp": 1}})
+    save_meters(config=config, meters={"m1": {"meterId": "m1", "timestamp": 2}})
+    with (tmp_path / "meters-metadata.json").open() as fh:
+        assert json.load(fh) == {
+            "m1": {"meterId": "m1", "timestamp": 2},
+            "m2": {"meterId": "m2", "timestamp": 1},
+        }
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from box import Box
+
+from discovergy.compact import compact, store_path
+from discovergy.utils import (
+    parquet_part_files,
+    init_pystore,
+    read_data_from_pystore,
+    split_df_by_day,
+    write_data_to_pystore,
+)
+
+
+def test_compact(tmp_path):
+    config = Box(file_location={"data_dir": tmp_path.as_posix()})
+    init_pystore(config)
+    index = pd.date_range("2020-03-01", "2020-03-04", freq="s", inclusive="left")
+    df = pd.DataFrame({"power": np.arange(len(index))}, index=index)
+    for df_day in split_df_by_day(df=df):
+        write_data_to_pystore(config=config, data_frames=[df_day], name="power_x")
+    item_path = store_path(config) / "power_x" / "2020-03"
+    assert len(parquet_part_files(item_path)) == 3
+
+    assert compact(config=config) == 1
+    files = parquet_part_files(item_path)
+    assert len(files) == 1
+    metadata = pq.ParquetFile(files[0].as_posix()).metadata
+    assert metadata.num_row_groups == 3
+    assert metadata.row_group(0).num_rows == 86400
+    date_from, date_to = index[0], index[-1] + pd.Timedelta(seconds=1)
+    stored = read_data_from_pystore(
+        config=config, name="power_x", date_from=date_from, date_to=date_to
+    )
+    pd.testing.assert_frame_equal(stored, df, check_names=False, check_freq=False)
+    # Nothing left to do
+    assert compact(config=config) == 0
+
+    # Appending to a compacted item still works.
+    more = pd.DataFrame(
+        {"power": [1, 2]},
+        index=pd.date_range("2020-03-04", periods=2, freq="s"),
+    )
+    write_data_to_pystore(config=config, data_frames=[more], name="power_x")
+    stored = read_data_from_pystore(
+        config=config,
+        name="power_x",
+        date_from=date_from,
+        date_to=pd.Timestamp("2020-04-01"),
+    )
+    assert len(stored) == len(df) + 2
+    # A new column makes the item be rewritten with all columns.
+    more = pd.DataFrame(
+        {"power": [3.0], "power1": [1.0]},
+        index=pd.date_range("2020-03-05", periods=1, freq="s"),
+    )
+    write_data_to_pystore(config=config, data_frames=[more], name="power_x")
+    stored = read_data_from_pystore(
+        config=config,
+        name="power_x",
+        date_from=date_from,
+        date_to=pd.Timestamp("2020-04-01"),
+    )
+    assert len(stored) == len(df) + 3
+    assert stored["power1"].count() == 1
+    assert len(parquet_part_files(item_path)) == 1
+    # Fewer columns are filled with nulls. The stored file is not touched.
+    files = parquet_part_files(item_path)
+    more = pd.DataFrame(
+        {"power": [4.0]},
+        index=pd.date_range("2020-03-06", periods=1, freq="s"),
+    )
+    write_data_to_pystore(config=config, data_frames=[more], name="power_x")
+    assert parquet_part_files(item_path)[:1] == files
+    assert len(parquet_part_files(item_path)) == 2
+    stored = read_data_from_pystore(
+        config=config,
+        name="power_x",
+        date_from=date_from,
+        date_to=pd.Timestamp("2020-04-01"),
+    )
+    assert len(stored) == len(df) + 4
+    assert stored["power1"].count() == 1
+
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import os
+
+import pytest
+
+from discovergy.config import read_config
+from discovergy.defaults import DEFAULT_CONFIG
+
+
+def write_config(path, text):
+    with os.fdopen(
+        os.open(path.as_posix(), os.O_WRONLY | os.O_CREAT, 0o600), "w"
+    ) as fh:
+        fh.write(text)
+
+
+def test_read_config(tmp_path):
+    path = tmp_path / "config.ini"
+    rule = "\n[rule_cheap]\ncondition: marketprice < 30\naction: command: true\n"
+    write_config(path, DEFAULT_CONFIG + rule)
+    config = read_config(path)
+    assert config.file_location.data_dir == "~/discovergy/data/"
+    assert config.rule_cheap.condition == "marketprice < 30"
+    assert config.config_file_path == path
+
+
+def test_read_invalid_config(tmp_path):
+    path = tmp_path / "config.ini"
+    write_config(path, DEFAULT_CONFIG.replace("live: 0", "live: never"))
+    with pytest.raises(SystemExit):
+        read_config(path)
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import numpy as np
+import pandas as pd
+
+from box import Box
+
+from discovergy.api import DiscovergyMeter
+from discovergy.coverage import Coverage, add_coverage, read_coverage, rebuild
+from discovergy.hot_cache import get_hot_cache
+from discovergy.journal import get_journal
+from discovergy.repair import missing_windows, repair, windows
+from discovergy.utils import read_data_from_pystore
+from discovergy.utils import init_pystore, split_df_by_day, write_data_to_pystore
+from discovergy.validation import FIELDS
+
+
+def test_coverage():
+    coverage = Coverage([(10, 20), (30, 40)])
+    coverage.add(20, 25)
+    assert coverage.intervals == [(10, 25), (30, 40)]
+    coverage.add(0, 5)
+    coverage.add(24, 31)
+    assert coverage.intervals == [(0, 5), (10, 40)]
+    coverage.add(50, 60)
+    assert coverage.missing(0, 100) == [(5, 10), (40, 50), (60, 100)]
+    assert coverage.missing(12, 38) == []
+    coverage.add(-10, 100)
+    assert coverage.intervals == [(-10, 100)]
+
+
+def test_windows():
+    gaps = [(0, 10), (20, 30), (100, 250)]
+    assert list(windows(gaps, 50)) == [(0, 30), (100, 150), (150, 200), (200, 250)]
+    assert list(windows([], 50)) == []
+
+
+def test_repair_windows(tmp_path):
+    config = Box(file_location={"data_dir": tmp_path.as_posix()})
+    init_pystore(config)
+    index = pd.date_range("2020-03-01", "2020-03-01 06:00", freq="s", inclusive="left")
+    df = pd.DataFrame({"power": np.arange(len(index))}, index=index)
+    # A hole of an hour
+    df = df[(df.index < "2020-03-01 02:00") | (df.index >= "2020-03-01 03:00")]
+    write_data_to_pystore(
+        config=config, data_frames=split_df_by_day(df=df), name="power_x"
+    )
+    coverage = rebuild(config=config, name="power_x", max_gap=60)
+    hole = (
+        int(pd.Timestamp("2020-03-01 02:00").timestamp()),
+        int(pd.Timestamp("2020-03-01 03:00").timestamp()),
+    )
+    assert len(coverage.intervals) == 2
+    assert missing_windows(config=config, meter_id="x") == [hole]
+    assert missing_windows(config=config, meter_id="x", window=1800) == [
+        (hole[0], hole[0] + 1800),
+        (hole[0] + 1800, hole[1]),
+    ]
+
+    add_coverage(
+        config=config,
+        name="power_x",
+        date_from=pd.Timestamp("2020-03-01 02:00", tz="utc"),
+        date_to=pd.Timestamp("2020-03-01 03:00", tz="utc"),
+    )
+    assert len(read_coverage(config, "power_x").intervals) == 1
+    assert missing_windows(config=config, meter_id="x") == []
+
+
+class StubMeter:
+    """Returns 1 s readings like the API."""
+
+    meter_id = "x"
+    fields = None
+    last_query_duration = 0.0
+
+    def __init__(self):
+        self.requests = []
+
+    def readings(self, *, field_names, ts_from, ts_to, resolution):
+        ts_from = DiscovergyMeter.gen_ms_timestamp(ts_from)
+        ts_to = DiscovergyMeter.gen_ms_timestamp(ts_to)
+        self.requests.append((ts_from, ts_to))
+        return [
+            {"time": t, "values": {f: t // 1000 for f in FIELDS}}
+            for t in range(ts_from, ts_to, 1000)
+        ]
+
+
+def test_repair(tmp_path):
+    config = Box(file_location={"data_dir": tmp_path.as_posix()})
+    init_pystore(config)
+    hole = (
+        pd.Timestamp("2020-03-01 02:00", tz="utc"),
+        pd.Timestamp("2020-03-01 02:10", tz="utc"),
+    )
+    add_coverage(
+        config=config,
+        name="power_x",
+        date_from=pd.Timestamp("2020-03-01 00:00", tz="utc"),
+        date_to=hole[0],
+    )
+    add_coverage(
+        config=config,
+        name="power_x",
+        date_from=hole[1],
+        date_to=pd.Timestamp("2020-03-01 06:00", tz="utc"),
+    )
+    meter = StubMeter()
+    assert repair(config=config, meter=meter, window=300) == 2
+    assert meter.requests[0] == (
+        hole[0].value // 10**6,
+        hole[0].value // 10**6 + 300000,
+    )
+    assert missing_windows(config=config, meter_id="x") == []
+    get_journal(config).flush()
+    df = read_data_from_pystore(
+        config=config,
+        name="power_x",
+        date_from=hole[0].tz_convert(None),
+        date_to=hole[1].tz_convert(None),
+    )
+    assert len(df) == 600
+    # Old data is not written to the hot cache.
+    assert get_hot_cache(config, "x") is None
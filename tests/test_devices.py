@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from box import Box
+
+from discovergy import devices
+from discovergy.utils import init_pystore, split_df_by_day, write_data_to_pystore
+
+
+@pytest.fixture
+def config(tmp_path):
+    config = Box(file_location={"data_dir": tmp_path.as_posix()})
+    init_pystore(config)
+    return config
+
+
+def power(date_from, date_to, seed=0):
+    """Stored power data in mW of a 2 kW kettle on phase 1 at 07:00 for 5
+    minutes and a 100 W fridge on phase 2 every other hour for 20 minutes."""
+    index = pd.date_range(date_from, date_to, freq="s", inclusive="left")
+    noise = np.random.default_rng(seed).normal(0, 2000, (len(index), 3))
+    df = pd.DataFrame(50000 + noise, index=index, columns=devices.PHASES)
+    minutes = index.hour * 60 + index.minute
+    df.loc[(minutes >= 420) & (minutes < 425), "power1"] += 2000000
+    df.loc[(index.hour % 2 == 0) & (index.minute < 20), "power2"] += 100000
+    return df
+
+
+def test_detect_steps():
+    df = power("2020-03-01", "2020-03-02")
+    steps = devices.detect_steps(df)
+    # The fridge was on before the data starts.
+    assert len(steps) == 2 + 2 * 12 - 1
+    kettle = steps[steps["phase"] == 1]
+    assert list(kettle.index) == [
+        pd.Timestamp("2020-03-01 07:00"),
+        pd.Timestamp("2020-03-01 07:05"),
+    ]
+    np.testing.assert_allclose(kettle["delta"], [2000, -2000], rtol=0.01)
+    # Gaps are no steps.
+    assert len(devices.detect_steps(df.drop(df.index[3600:3610]))) == len(steps)
+
+
+def test_update(config):
+    df = power("2020-03-01", "2020-03-04")
+    write_data_to_pystore(
+        config=config, data_frames=split_df_by_day(df=df), name="power_m"
+    )
+    activity = devices.update(
+        config=config, meter_id="m", date_to=pd.Timestamp("2020-03-03")
+    )
+    signatures = devices.signatures(activity)
+    # The kettle was not used often enough yet.
+    assert list(signatures.index) == ["L2-100W"]
+    assert list(signatures["activations"]) == [23]
+    assert devices.read_days(config, "power_m") == {"2020-03-01", "2020-03-02"}
+    # Only the new day is read.
+    activity = devices.update(
+        config=config, meter_id="m", date_to=pd.Timestamp("2020-03-04")
+    )
+    signatures = devices.signatures(activity)
+    assert list(signatures.index) == ["L1-2000W", "L2-100W"]
+    assert list(signatures["activations"]) == [3, 35]
+    devices.invalidate_days(config, "power_m", [pd.Timestamp("2020-03-03")])
+    assert devices.read_days(config, "power_m") == {"2020-03-01"}
+    pd.testing.assert_frame_equal(
+        devices.update(config=config, meter_id="m", date_to=pd.Timestamp("2020-03-04")),
+        activity,
+    )
+    pd.testing.assert_frame_equal(devices.read_activity(config, "m"), activity)
+
+
+def test_invalidated_while_detecting(config, monkeypatch):
+    df = power("2020-03-01", "2020-03-04")
+    write_data_to_pystore(
+        config=config, data_frames=split_df_by_day(df=df), name="power_m"
+    )
+    day_steps = devices.day_steps
+
+    def flush_meanwhile(**kwargs):
+        # The journal flush writes 2020-03-02 while the steps are detected.
+        devices.invalidate_days(config, "power_m", [pd.Timestamp("2020-03-02")])
+        return day_steps(**kwargs)
+
+    monkeypatch.setattr(devices, "day_steps", flush_meanwhile)
+    devices.update(config=config, meter_id="m", date_to=pd.Timestamp("2020-03-04"))
+    assert devices.read_days(config, "power_m") == {"2020-03-03"}
+    monkeypatch.setattr(devices, "day_steps", day_steps)
+    devices.update(config=config, meter_id="m", date_to=pd.Timestamp("2020-03-04"))
+    assert devices.read_days(config, "power_m") == {
+        "2020-03-01",
+        "2020-03-02",
+        "2020-03-03",
+    }
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import pandas as pd
+import pytest
+
+from box import Box
+
+from discovergy import disaggregation
+from discovergy.journal import get_journal
+from discovergy.utils import (
+    init_pystore,
+    read_data_from_pystore,
+    read_watermark,
+    split_df_by_day,
+    write_data_to_pystore,
+    write_watermark,
+)
+
+
+class StubMeter:
+    def __init__(self):
+        self.requests = []
+
+    def disaggregation(self, *, ts_from, ts_to):
+        self.requests.append(("disaggregation", ts_from, ts_to))
+        return {str(ts_from * 1000): {"Fridge": 10, "Kettle": 20}}
+
+    def activities(self, *, ts_from, ts_to):
+        self.requests.append(("activities", ts_from, ts_to))
+        return [
+            {"deviceId": "fridge", "beginTime": ts_from * 1000, "endTime": ts_to * 1000}
+        ]
+
+
+@pytest.fixture
+def config(tmp_path):
+    config = Box(file_location={"data_dir": tmp_path.as_posix()})
+    init_pystore(config)
+    return config
+
+
+def test_disaggregation_to_df():
+    data = {
+        "1583020800000": {"Fridge": 10, "Kettle": 20},
+        "1583020900000": {"Fridge": 11},
+    }
+    df = disaggregation.disaggregation_to_df(data=data)
+    assert list(df.columns) == ["device", "energy"]
+    assert list(df.index) == list(
+        pd.to_datetime([1583020800000, 1583020800000, 1583020900000], unit="ms")
+    )
+    assert list(df["device"]) == ["Fridge", "Kettle", "Fridge"]
+    assert list(df["energy"]) == [10, 20, 11]
+    assert df["energy"].dtype == "int64"
+    df = disaggregation.disaggregation_to_df(data={})
+    assert not len(df) and list(df.columns) == ["device", "energy"]
+
+
+def test_activities_to_df():
+    data = [
+        {"deviceId": "b", "beginTime": 2000, "endTime": 3000},
+        {"deviceId": "a", "beginTime": 1000, "endTime": 4000},
+    ]
+    df = disaggregation.activities_to_df(data=data)
+    assert list(df.index) == list(pd.to_datetime([1000, 2000], unit="ms"))
+    assert list(df["deviceId"]) == ["a", "b"]
+    assert df["endTime"].iloc[0] == pd.Timestamp(4000, unit="ms")
+    # The API may wrap the activities.
+    wrapped = disaggregation.activities_to_df(data={"activities": data})
+    pd.testing.assert_frame_equal(wrapped, df)
+    assert not len(disaggregation.activities_to_df(data={}))
+    assert not len(disaggregation.activities_to_df(data=[{"deviceId": "a"}]))
+
+
+def test_watermark(config):
+    assert read_watermark(config=config, name="activities_x") is None
+    timestamp = pd.Timestamp("2020-03-01 12:00:01", tz="utc")
+    write_watermark(config=config, name="activities_x", timestamp=timestamp)
+    write_watermark(config=config, name="disaggregation_x", timestamp=timestamp)
+    assert read_watermark(config=config, name="activities_x") == timestamp
+
+
+def test_get(config):
+    meter = StubMeter()
+    disaggregation.get(config=config, meters={"x": meter}, initial=pd.Timedelta("1h"))
+    assert [r[0] for r in meter.requests] == ["disaggregation", "activities"]
+    _, ts_from, ts_to = meter.requests[0]
+    assert ts_to - ts_from == 3600
+    watermark = read_watermark(config=config, name="disaggregation_x")
+    assert watermark == pd.Timestamp(ts_to, unit="s", tz="utc")
+    # The next fetch starts at the watermark.
+    write_watermark(
+        config=config,
+        name="disaggregation_x",
+        timestamp=watermark - pd.Timedelta("10min"),
+    )
+    disaggregation.get(config=config, meters={"x": meter}, initial=pd.Timedelta("1h"))
+    assert meter.requests[2][1] == ts_to - 600
+    get_journal(config).flush()
+    date_from, date_to = watermark - pd.Timedelta("1d"), watermark + pd.Timedelta("1d")
+    stored = read_data_from_pystore(
+        config=config, name="disaggregation_x", date_from=date_from, date_to=date_to
+    )
+    assert list(stored.index) == [
+        watermark.tz_convert(None) - pd.Timedelta(t)
+        for t in ("1h", "1h", "10min", "10min")
+    ]
+    assert list(stored["device"]) == ["Fridge", "Kettle"] * 2
+
+
+def test_read_data_from_pystore(config):
+    index = pd.date_range("2020-03-31 23:00", "2020-04-01 01:00", freq="min")
+    df = pd.DataFrame({"power": range(len(index))}, index=index)
+    write_data_to_pystore(
+        config=config, data_frames=split_df_by_day(df=df), name="power_x"
+    )
+    stored = read_data_from_pystore(
+        config=config,
+        name="power_x",
+        date_from=pd.Timestamp("2020-04-01 00:30", tz="Europe/Berlin"),
+        date_to=pd.Timestamp("2020-04-01 00:40", tz="utc"),
+    )
+    # The index is naive UTC. The range spans two monthly items.
+    assert stored.index.tz is None
+    assert stored.index[0] == pd.Timestamp("2020-03-31 23:00")
+    assert stored.index[-1] == pd.Timestamp("2020-04-01 00:39")
+    assert list(stored["power"]) == list(range(100))
+    assert read_data_from_pystore(
+        config=config,
+        name="power_y",
+        date_from=pd.Timestamp("2020-04-01"),
+        date_to=pd.Timestamp("2020-04-02"),
+    ).empty
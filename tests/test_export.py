@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import io
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from box import Box
+
+from discovergy.compact import compact
+from discovergy.export import ExportError, export, pystore_chunks
+from discovergy.utils import init_pystore, split_df_by_day, write_data_to_pystore
+
+
+@pytest.fixture
+def config(tmp_path):
+    config = Box(file_location={"data_dir": tmp_path.as_posix()})
+    init_pystore(config)
+    return config
+
+
+@pytest.fixture
+def stored(config):
+    index = pd.date_range("2020-03-30", "2020-04-02", freq="s", inclusive="left")
+    df = pd.DataFrame(
+        {"power": np.arange(len(index), dtype="float64"), "power1": 1.0}, index=index
+    )
+    # Write the days in reverse order so the files of a month are out of order.
+    for df_day in reversed(split_df_by_day(df=df)):
+        write_data_to_pystore(config=config, data_frames=[df_day], name="power_m")
+    return df
+
+
+def test_export_parquet(config, stored):
+    stream = io.BytesIO()
+    rows = export(
+        config=config,
+        source="power",
+        meter_id="m",
+        stream=stream,
+        columns=["power"],
+        date_from=pd.Timestamp("2020-03-31T12:00"),
+        file_format="parquet",
+    )
+    df = pq.read_table(io.BytesIO(stream.getvalue())).to_pandas().set_index("time")
+    expected = stored.loc["2020-03-31T12:00":, ["power"]]
+    assert rows == len(expected)
+    np.testing.assert_array_equal(df.index, expected.index)
+    np.testing.assert_array_equal(df["power"], expected["power"])
+
+
+def test_export_resample(config, stored):
+    stream = io.BytesIO()
+    export(
+        config=config,
+        source="power",
+        meter_id="m",
+        stream=stream,
+        resample="1h",
+        file_format="arrow",
+    )
+    df = pa.ipc.open_stream(stream.getvalue()).read_pandas().set_index("time")
+    expected = stored.resample("1h").mean()
+    assert len(df) == len(expected)
+    np.testing.assert_allclose(df["power"], expected["power"])
+
+
+def test_compact_while_exporting(config, stored):
+    chunks = pystore_chunks(
+        config=config,
+        name="power_m",
+        date_from=pd.Timestamp("2020-03-01"),
+        date_to=pd.Timestamp("2020-05-01"),
+    )
+    first = next(chunks)
+    # The export doesn't hold the lock while its reader is busy.
+    assert compact(config=config) == 1
+    df = pd.concat([first, *chunks])
+    np.testing.assert_array_equal(df.index, stored.index)
+
+
+def test_export_errors(config, stored):
+    with pytest.raises(ExportError):
+        export(config=config, source="power", stream=io.BytesIO())
+    with pytest.raises(ExportError):
+        export(
+            config=config,
+            source="power",
+            meter_id="m",
+            stream=io.BytesIO(),
+            resample="W",
+        )
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import numpy as np
+import pandas as pd
+
+from box import Box
+
+from discovergy.hot_cache import HotCache
+
+
+def test_hot_cache(tmp_path):
+    config = Box(
+        file_location={"data_dir": tmp_path.as_posix()}, hot_cache={"window": 100}
+    )
+    writer = HotCache(config=config, meter_id="m", writable=True)
+    index = pd.date_range("2020-03-01", periods=150, freq="s")
+    df = pd.DataFrame({"power": np.arange(150.0)}, index=index)
+    writer.write(df.iloc[:60])
+    writer.write(df.iloc[60:])
+
+    reader = HotCache(config=config, meter_id="m")
+    assert reader.fields() == ["power"]
+    assert reader.covers(index[50], index[-1])
+    assert not reader.covers(index[49], index[-1])
+    assert not reader.covers(index[100], index[-1] + pd.Timedelta(seconds=2))
+
+    # The range wraps around the end of the ring buffer.
+    stored = reader.read(date_from=index[50], date_to=index[-1])
+    pd.testing.assert_frame_equal(stored, df.iloc[50:149], check_freq=False)
+
+    # No copy if the range doesn't wrap.
+    seconds, values = reader.arrays(date_from=index[100], date_to=index[140])
+    assert len(seconds) == 40
+    assert np.shares_memory(values["power"], reader.field("power"))
+
+    # A gap restarts the coverage.
+    writer.write(df.iloc[:1].set_axis([index[-1] + pd.Timedelta(seconds=10)]))
+    assert not reader.covers(index[-5], index[-1])
+    stored = reader.read(date_from=index[-5], date_to=index[-1] + pd.Timedelta(11, "s"))
+    assert len(stored) == 6
+
+
+def test_hot_cache_old_rows(tmp_path):
+    config = Box(
+        file_location={"data_dir": tmp_path.as_posix()}, hot_cache={"window": 100}
+    )
+    cache = HotCache(config=config, meter_id="m", writable=True)
+    index = pd.date_range("2020-03-01", periods=300, freq="s")
+    df = pd.DataFrame({"power": np.arange(300.0)}, index=index)
+    cache.write(df.iloc[240:])
+    # A backfill of older data must not overwrite the recent rows.
+    cache.write(df.iloc[:60])
+    cache.write(df.iloc[180:230])
+    assert cache.covers(index[240], index[-1])
+    stored = cache.read(date_from=index[240], date_to=index[-1])
+    pd.testing.assert_frame_equal(stored, df.iloc[240:299], check_freq=False)
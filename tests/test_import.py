@@ -9,7 +9,41 @@ import importlib
 
 def test_module_imports():
     """Test if all modules can be imported."""
-    modules = ["api", "auth", "awattar", "cli", "config", "defaults", "poller", "utils", "weather"]
+    modules = [
+        "anomaly",
+        "api",
+        "archive",
+        "auth",
+        "awattar",
+        "cli",
+        "cluster",
+        "compact",
+        "config",
+        "coverage",
+        "defaults",
+        "devices",
+        "disaggregation",
+        "export",
+        "hot_cache",
+        "join",
+        "ledger",
+        "importer",
+        "journal",
+        "live",
+        "load_profile",
+        "optimizer",
+        "poller",
+        "power",
+        "repair",
+        "response_cache",
+        "rules",
+        "statistics",
+        "supervisor",
+        "transport",
+        "utils",
+        "validation",
+        "weather",
+    ]
     for module in modules:
         try:
             importlib.import_module("discovergy." + module)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import gzip
+import json
+
+import pandas as pd
+
+from box import Box
+
+from discovergy.importer import import_files, state_path
+from discovergy.repair import missing_windows
+from discovergy.utils import read_data_from_pystore
+
+
+VALUES = {
+    "energyOut": 0,
+    "energy2": 0,
+    "energy1": 0,
+    "voltage1": 0,
+    "voltage2": 0,
+    "voltage3": 0,
+    "energyOut1": 0,
+    "power": 0,
+    "energyOut2": 0,
+    "power3": 0,
+    "power1": 0,
+    "energy": 0,
+    "power2": 0,
+}
+
+
+def write_raw_file(file_path, index):
+    data = [
+        {"time": ts.value // 10**6, "values": dict(VALUES, power=i)}
+        for i, ts in enumerate(index)
+    ]
+    with gzip.open(file_path.as_posix(), "wb") as fh:
+        fh.write(json.dumps(data).encode("utf-8"))
+
+
+def test_import_files(tmp_path):
+    config = Box(file_location={"data_dir": (tmp_path / "data").as_posix()})
+    raw_dir = tmp_path / "raw"
+    raw_dir.mkdir()
+    # Two files across midnight, overlapping by one minute
+    first = pd.date_range("2020-03-01 23:00", "2020-03-02 01:00", freq="s")
+    second = pd.date_range("2020-03-02 00:59", "2020-03-02 02:00", freq="s")
+    write_raw_file(raw_dir / "discovergy_data_1.json.gz", first)
+    write_raw_file(raw_dir / "discovergy_data_2.json.gz", second)
+    (raw_dir / "unrelated.txt").write_text("skip me")
+    # The raw archive of another meter
+    write_raw_file(raw_dir / "discovergy_data_y_2020-03-02.ndjson.gz", second)
+
+    imported = import_files(
+        config=config, source="power", data_dir=raw_dir, meter_id="x", processes=2
+    )
+    assert imported == 2
+    assert state_path(config, "power", "x").is_file()
+    stored = read_data_from_pystore(
+        config=config,
+        name="power_x",
+        date_from=pd.Timestamp("2020-03-01"),
+        date_to=pd.Timestamp("2020-03-03"),
+    )
+    assert len(stored) == len(first.union(second))
+    assert stored.index.is_unique
+    # The later file wins in the overlap.
+    assert stored.loc["2020-03-02 00:59:00", "power"] == 0
+
+    # Nothing left to do unless a file changed
+    assert (
+        import_files(config=config, source="power", data_dir=raw_dir, meter_id="x") == 0
+    )
+    write_raw_file(raw_dir / "discovergy_data_2.json.gz", second[:10])
+    assert (
+        import_files(config=config, source="power", data_dir=raw_dir, meter_id="x") == 1
+    )
+
+
+def test_import_coverage(tmp_path):
+    config = Box(file_location={"data_dir": (tmp_path / "data").as_posix()})
+    raw_dir = tmp_path / "raw"
+    raw_dir.mkdir()
+    first = pd.date_range("2020-03-01 23:00", "2020-03-02 01:00", freq="s")
+    second = pd.date_range("2020-03-02 03:00", "2020-03-02 04:00", freq="s")
+    write_raw_file(raw_dir / "discovergy_data_1.json.gz", first)
+    write_raw_file(raw_dir / "discovergy_data_2.json.gz", second)
+    import_files(config=config, source="power", data_dir=raw_dir, meter_id="x")
+    # Only the hours between the files are left to repair.
+    assert missing_windows(config=config, meter_id="x", window=86400) == [
+        (int(first[-1].timestamp()) + 1, int(second[0].timestamp()))
+    ]
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from box import Box
+
+from discovergy.join import JoinError, Source, join
+from discovergy.utils import (
+    append_data_frames,
+    init_pystore,
+    split_df_by_day,
+    split_df_by_month,
+    write_data_frames,
+    write_data_to_pystore,
+)
+
+
+@pytest.fixture
+def config(tmp_path):
+    config = Box(file_location={"data_dir": tmp_path.as_posix()})
+    init_pystore(config)
+    index = pd.date_range("2020-03-31", "2020-04-02", freq="s", inclusive="left")
+    power = pd.DataFrame({"power": np.arange(len(index), dtype="int64")}, index=index)
+    write_data_to_pystore(
+        config=config, data_frames=split_df_by_day(df=power), name="power_m"
+    )
+    hours = pd.date_range("2020-03-30", "2020-04-03", freq="h", tz="utc")
+    prices = pd.DataFrame({"marketprice": np.arange(len(hours)) * 1.0}, index=hours)
+    write_data_frames(
+        config=config, data_frames=split_df_by_month(df=prices), name="awattar"
+    )
+    times = pd.to_datetime(
+        ["2020-03-31 10:20", "2020-03-31 10:20", "2020-04-01 06:00"], utc=True
+    )
+    weather = pd.DataFrame(
+        {"temp": [280.0, 290.0, 285.0], "location": ["default", "cabin", "default"]},
+        index=times,
+    )
+    append_data_frames(
+        config=config,
+        data_frames=split_df_by_month(df=weather),
+        name="weather",
+        dedup_columns=["location"],
+    )
+    return config
+
+
+def test_join(config):
+    sources = [
+        Source(source="power", meter_id="m"),
+        Source(source="awattar", how="asof", limit="1h"),
+        Source(source="weather", how="asof", limit="3h", location="default"),
+    ]
+    for _ in range(2):
+        frames = list(
+            join(
+                config=config,
+                sources=sources,
+                date_from=pd.Timestamp("2020-03-31 09:00"),
+                date_to=pd.Timestamp("2020-04-01 12:00"),
+                freq="1h",
+            )
+        )
+        assert len(frames) == 2
+        df = pd.concat(frames)
+        assert list(df.columns) == ["power", "marketprice", "temp"]
+        assert len(df) == 27
+        # The mean of the seconds 9:00:00 - 9:59:59
+        assert df.loc[pd.Timestamp("2020-03-31 09:00"), "power"] == 9 * 3600 + 1799.5
+        assert df.loc[pd.Timestamp("2020-04-01 09:00"), "marketprice"] == 57.0
+        temp = df["temp"]
+        assert np.isnan(temp[pd.Timestamp("2020-03-31 10:00")])
+        assert temp[pd.Timestamp("2020-03-31 11:00")] == 280.0
+        assert temp[pd.Timestamp("2020-03-31 13:00")] == 280.0
+        assert np.isnan(temp[pd.Timestamp("2020-03-31 14:00")])
+        assert temp[pd.Timestamp("2020-04-01 06:00")] == 285.0
+    # A cached month is aligned again once its data changed.
+    later = pd.DataFrame(
+        {"power": [0]}, index=[pd.Timestamp("2020-04-01 09:00:00.5")]
+    ).astype("int64")
+    write_data_to_pystore(config=config, data_frames=[later], name="power_m")
+    df = pd.concat(
+        join(
+            config=config,
+            sources=sources,
+            date_from=pd.Timestamp("2020-04-01 09:00"),
+            date_to=pd.Timestamp("2020-04-01 10:00"),
+        )
+    )
+    assert df.loc[pd.Timestamp("2020-04-01 09:00"), "power"] == pytest.approx(
+        (33 * 3600 * 3600 + 3600 * 3599 / 2) / 3601
+    )
+
+
+def test_join_errors(config):
+    with pytest.raises(JoinError):
+        list(
+            join(
+                config=config,
+                sources=[Source(source="power")],
+                date_from=pd.Timestamp("2020-03-31"),
+                date_to=pd.Timestamp("2020-04-01"),
+            )
+        )
+    with pytest.raises(JoinError):
+        list(
+            join(
+                config=config,
+                sources=[Source(source="awattar")],
+                date_from=pd.Timestamp("2020-03-31"),
+                date_to=pd.Timestamp("2020-04-01"),
+                freq="7min",
+            )
+        )
@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import os
+
+import pandas as pd
+import pytest
+
+from box import Box
+
+from discovergy.cluster import Membership
+from discovergy.journal import Journal
+from discovergy.utils import init_pystore, read_data_from_pystore
+
+
+@pytest.fixture
+def config(tmp_path):
+    config = Box(file_location={"data_dir": tmp_path.as_posix()})
+    init_pystore(config)
+    return config
+
+
+def power(start, periods, value):
+    return pd.DataFrame(
+        {"power": [value] * periods},
+        index=pd.date_range(start, periods=periods, freq="s"),
+    )
+
+
+def stored(config):
+    return read_data_from_pystore(
+        config=config,
+        name="power_x",
+        date_from=pd.Timestamp("2020-03-01"),
+        date_to=pd.Timestamp("2020-03-03"),
+    )
+
+
+def test_replay_and_flush(config):
+    journal = Journal(config=config)
+    journal.append(name="power_x", df=power("2020-03-01", 10, 1))
+    journal.append(name="power_x", df=power("2020-03-01 00:00:05", 10, 2))
+    assert journal.rows == 20
+    journal.close()
+
+    journal = Journal(config=config)
+    assert journal.rows == 20
+    journal.flush()
+    assert journal.rows == 0
+    assert journal.segments() == []
+    df = stored(config)
+    # The later append wins.
+    assert list(df["power"]) == [1] * 5 + [2] * 10
+    journal.close()
+    assert Journal(config=config).rows == 0
+
+
+def test_corrupt_record(config):
+    journal = Journal(config=config)
+    journal.append(name="power_x", df=power("2020-03-01", 10, 1))
+    journal.append(name="power_x", df=power("2020-03-02", 10, 2))
+    journal.close()
+    (segment,) = journal.segments()
+    data = bytearray(segment.read_bytes())
+    data[-1] ^= 0xFF
+    segment.write_bytes(bytes(data))
+    assert Journal(config=config).rows == 10
+
+
+def test_processes(config):
+    poller = Journal(config=config)
+    poller.append(name="power_x", df=power("2020-03-01", 10, 1))
+    # A command run while the poller runs gets its own segments.
+    command = Journal(config=config)
+    assert command.path != poller.path
+    assert command.rows == 0
+    command.append(name="power_x", df=power("2020-03-02", 10, 2))
+    command.flush()
+    assert len(stored(config)) == 10
+    assert len(poller.segments()) == 1
+    command.close()
+
+    # Segments left by a command that died are adopted by the next journal.
+    command = Journal(config=config)
+    command.append(name="power_x", df=power("2020-03-02", 10, 3))
+    command.close()
+    poller.close()
+    journal = Journal(config=config)
+    assert journal.path == poller.path
+    assert journal.rows == 20
+    assert not command.path.exists()
+
+
+def test_adopt_dead_worker(config):
+    worker = Box(config, shard={"worker_id": "w1", "members": ["w1", "w2"]})
+    Membership(config=config, worker_id="w1").beat()
+    journal = Journal(config=worker)
+    journal.append(name="power_x", df=power("2020-03-01", 10, 1))
+    journal.close()
+    other = Box(config, shard={"worker_id": "w2", "members": ["w1", "w2"]})
+    # w1 may be restarting.
+    journal = Journal(config=other)
+    assert journal.rows == 0
+    journal.close()
+    # Its heartbeat expired.
+    heartbeat = config.file_location.data_dir + "/cluster/members/w1"
+    os.utime(heartbeat, (0, 0))
+    assert Journal(config=other).rows == 10
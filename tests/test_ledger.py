@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from box import Box
+
+from discovergy import ledger
+from discovergy.utils import (
+    init_pystore,
+    split_df_by_day,
+    split_df_by_month,
+    write_data_frames,
+    write_data_to_pystore,
+)
+
+
+@pytest.fixture
+def config(tmp_path):
+    config = Box(file_location={"data_dir": tmp_path.as_posix()})
+    init_pystore(config)
+    return config
+
+
+def energy(date_from, date_to, wh_per_second=1.0, start=0.0):
+    """Stored power data with a constant consumption."""
+    index = pd.date_range(date_from, date_to, freq="s", inclusive="left")
+    return pd.DataFrame(
+        {"energy": start + wh_per_second * np.arange(len(index)), "power": 3600.0},
+        index=index,
+    )
+
+
+def prices(date_from, date_to, price):
+    hours = pd.date_range(date_from, date_to, freq="h", tz="utc", inclusive="left")
+    return pd.DataFrame({"marketprice": price}, index=hours)
+
+
+def test_ledger(config):
+    write_data_frames(
+        config=config,
+        data_frames=split_df_by_month(
+            df=prices("2020-03-01 00:00", "2020-03-01 02:00", 50.0)
+        ),
+        name="awattar",
+    )
+    df = energy("2020-03-01 00:00", "2020-03-01 03:00")
+    # The first half of the data arrives late.
+    ledger.add_readings(config=config, meter_id="m", df=df.iloc[5400:])
+    ledger.add_readings(config=config, meter_id="m", df=df.iloc[:5400])
+    hourly = ledger.read_ledger(config, "m")
+    assert len(hourly) == 3
+    # 3599 Wh between the first and the last reading of the first hour, 3600 Wh later.
+    np.testing.assert_allclose(hourly["kwh"], [3.599, 3.6, 3.6])
+    np.testing.assert_allclose(hourly["cost"][:2], [3.599 * 0.05, 3.6 * 0.05])
+    assert np.isnan(hourly["cost"].iloc[2])
+    # The price of the last hour arrives late.
+    ledger.add_prices(
+        config=config, prices=prices("2020-03-01 02:00", "2020-03-01 03:00", 100.0)
+    )
+    hourly = ledger.read_ledger(config, "m")
+    assert hourly["cost"].iloc[2] == pytest.approx(0.36)
+    day = ledger.daily(hourly)
+    assert day["kwh"].iloc[0] == pytest.approx(3.599 + 7.2)
+
+
+def test_rebuild(config):
+    df = energy("2020-03-31 22:00", "2020-04-01 02:00")
+    write_data_to_pystore(
+        config=config, data_frames=split_df_by_day(df=df), name="power_m"
+    )
+    assert ledger.rebuild(config=config, meter_id="m") == 4
+    hourly = ledger.read_ledger(config, "m")
+    np.testing.assert_allclose(hourly["kwh"], [3.599, 3.6, 3.6, 3.6])
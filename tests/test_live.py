@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import asyncio
+
+from discovergy.live import LivePoller, LiveReading, Publisher
+
+
+class StubMeter:
+    def __init__(self, readings):
+        self.readings = iter(readings)
+
+    def last_reading(self):
+        reading = next(self.readings)
+        if isinstance(reading, Exception):
+            raise reading
+        return reading
+
+
+def test_publish_from_thread():
+    publisher = Publisher()
+
+    async def main():
+        queue = publisher.subscribe()
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, publisher.publish, 1)
+        publisher.publish(2)
+        return [await asyncio.wait_for(queue.get(), 1) for _ in range(2)]
+
+    assert sorted(asyncio.run(main())) == [1, 2]
+
+
+def test_slow_subscriber():
+    publisher = Publisher(maxsize=2)
+
+    async def main():
+        slow = publisher.subscribe()
+        fast = publisher.subscribe(maxsize=10)
+        for i in range(5):
+            publisher.publish(i)
+        publisher.unsubscribe(fast)
+        publisher.publish(5)
+        return [slow.get_nowait() for _ in range(2)], fast.qsize()
+
+    # The oldest items are dropped.
+    assert asyncio.run(main()) == ([4, 5], 5)
+
+
+def test_live_poller():
+    values = {"power": 1}
+    meters = {
+        "a": StubMeter(
+            [
+                {"time": 1000, "values": values},
+                {"time": 1000, "values": values},
+                {"time": 2000, "values": values},
+            ]
+        ),
+        "b": StubMeter([ValueError("down"), {"values": values}, {"time": 500}]),
+    }
+    publisher = Publisher()
+
+    async def main():
+        queue = publisher.subscribe()
+        poller = LivePoller(meters=meters, publisher=publisher)
+        polls = [await poller.poll() for _ in range(3)]
+        return polls, [queue.get_nowait() for _ in range(queue.qsize())]
+
+    polls, published = asyncio.run(main())
+    first = LiveReading(meter_id="a", timestamp=1000, values=values)
+    second = LiveReading(meter_id="a", timestamp=2000, values=values)
+    # Readings already seen, errors and invalid readings are skipped.
+    assert polls == [[first], [], [second]]
+    assert published == [first, second]
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import gzip
+
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from box import Box
+
+from discovergy import load_profile
+from discovergy.journal import get_journal
+from discovergy.utils import (
+    init_pystore,
+    read_data_from_pystore,
+    read_watermark,
+    write_watermark,
+)
+
+
+class StubMeter:
+    def __init__(self):
+        self.requests = []
+
+    def load_profile(self, *, ts_from, ts_to):
+        self.requests.append((ts_from, ts_to))
+        index = pd.date_range(
+            pd.Timestamp(ts_from, unit="s"),
+            pd.Timestamp(ts_to, unit="s"),
+            freq="1D",
+            inclusive="left",
+        )
+        return [
+            {"time": ts.value // 10**6, "values": {"1.8.0": i, "2.8.0": None}}
+            for i, ts in enumerate(index)
+        ]
+
+    def raw_load_profile(self, *, ts_from, ts_to):
+        return f"{ts_from}-{ts_to}"
+
+
+@pytest.fixture
+def config(tmp_path):
+    config = Box(file_location={"data_dir": tmp_path.as_posix()})
+    init_pystore(config)
+    return config
+
+
+def test_pages():
+    pages = list(
+        load_profile.pages(
+            pd.Timestamp("2020-01-01 12:00"), pd.Timestamp("2020-03-01 06:00")
+        )
+    )
+    assert pages == [
+        (pd.Timestamp("2020-01-01"), pd.Timestamp("2020-02-01")),
+        (pd.Timestamp("2020-02-01"), pd.Timestamp("2020-03-02")),
+    ]
+
+
+def test_load_profile_to_df():
+    data = [
+        {"time": 2000, "values": {"1.8.0": 2, "2.8.0": None}},
+        {"time": 1000, "values": {"1.8.0": 1}},
+        {"time": 2000, "values": {"1.8.0": 3, "2.8.0": 4}},
+    ]
+    df = load_profile.load_profile_to_df(data=data)
+    assert list(df.index) == list(pd.to_datetime([1000, 2000], unit="ms"))
+    assert list(df.dtypes) == [np.dtype("float64")] * 2
+    assert list(df["1.8.0"]) == [1, 3]
+    assert np.isnan(df["2.8.0"].iloc[0])
+    df = load_profile.load_profile_to_df(data=data[:2])
+    assert df["2.8.0"].isna().all()
+    assert not len(load_profile.load_profile_to_df(data=[]))
+
+
+def test_get(config):
+    meter = StubMeter()
+    load_profile.get(
+        config=config,
+        meters={"x": meter},
+        date_to=pd.Timestamp("2020-03-10"),
+        date_from=pd.Timestamp("2020-01-15"),
+        raw=True,
+    )
+    assert len(meter.requests) == 2
+    # An explicit range doesn't move the watermark.
+    assert read_watermark(config=config, name="load_profile_x") is None
+    get_journal(config).flush()
+    stored = read_data_from_pystore(
+        config=config,
+        name="load_profile_x",
+        date_from=pd.Timestamp("2020-01-01"),
+        date_to=pd.Timestamp("2020-04-01"),
+    )
+    assert len(stored) == (pd.Timestamp("2020-03-10") - pd.Timestamp("2020-01-15")).days
+    # Fetching a page again replaces its raw file only.
+    load_profile.get(
+        config=config,
+        meters={"x": meter},
+        date_to=pd.Timestamp("2020-02-20"),
+        date_from=pd.Timestamp("2020-02-15"),
+        raw=True,
+    )
+    raw_dir = Path(config.file_location.data_dir) / "raw_load_profile" / "x"
+    assert sorted(p.name for p in raw_dir.iterdir()) == [
+        "2020-01-15_2020-02-15.txt.gz",
+        "2020-02-15_2020-02-20.txt.gz",
+        "2020-02-15_2020-03-10.txt.gz",
+    ]
+    with gzip.open(raw_dir / "2020-02-15_2020-02-20.txt.gz", "rt") as fh:
+        assert fh.read() == "1581724800-1582156800"
+
+
+def test_get_from_watermark(config):
+    meter = StubMeter()
+    name = "load_profile_x"
+    write_watermark(
+        config=config, name=name, timestamp=pd.Timestamp("2020-03-10", tz="utc")
+    )
+    load_profile.get(
+        config=config, meters={"x": meter}, date_to=pd.Timestamp("2020-03-12")
+    )
+    assert meter.requests == [(1583798400, 1583971200)]
+    assert read_watermark(config=config, name=name) == pd.Timestamp(
+        "2020-03-12", tz="utc"
+    )
+    assert get_journal(config).rows == 2
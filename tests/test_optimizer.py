@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import numpy as np
+import pandas as pd
+
+from discovergy.optimizer import cheapest_start
+
+
+def test_cheapest_start_matches_brute_force():
+    index = pd.date_range("2020-05-01", periods=24, freq="h", tz="utc")
+    prices = pd.Series(np.random.default_rng(1).uniform(10, 80, 24), index=index)
+    profile = [0.3, 0.8, 0.2, 0.2, 0.1]
+    plan = cheapest_start(
+        prices=prices,
+        profile=profile,
+        resolution="15min",
+        earliest=index[0],
+        deadline=index[-1],
+    )
+    slots = prices.reindex(
+        pd.date_range(index[0], index[-1] - pd.Timedelta("15min"), freq="15min"),
+        method="ffill",
+    )
+    costs = [
+        sum(p * w for p, w in zip(slots.iloc[i : i + len(profile)], profile)) / 1000
+        for i in range(len(slots) - len(profile) + 1)
+    ]
+    assert plan.start == slots.index[int(np.argmin(costs))]
+    assert np.isclose(plan.cost, min(costs))
+    assert plan.end <= index[-1]
+
+
+def test_cheapest_start_without_enough_prices():
+    index = pd.date_range("2020-05-01", periods=1, freq="h", tz="utc")
+    prices = pd.Series([20.0], index=index)
+    assert (
+        cheapest_start(
+            prices=prices,
+            profile=[1.0] * 5,
+            earliest=index[0],
+            deadline=index[0] + pd.Timedelta(hours=5),
+        )
+        is None
+    )
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import time
+
+from box import Box
+
+from discovergy import response_cache
+from discovergy.api import DiscovergyMeter
+from discovergy.response_cache import ResponseCache, align_window, window_closed
+
+
+def test_window_closed():
+    now_ms = int(time.time() * 1000)
+    assert window_closed(now_ms - 3 * 86400 * 1000, "raw", 86400)
+    assert not window_closed(now_ms - 3600 * 1000, "raw", 86400)
+    assert not window_closed(now_ms, "one_hour", 0)
+    # The current month is open for a month resolution.
+    assert not window_closed(now_ms, "one_month", 0)
+    assert window_closed(0, "one_year", 0)
+
+
+def test_align_window():
+    hour = 3600 * 1000
+    assert align_window(hour + 1, 2 * hour, "one_hour") == (hour, 2 * hour)
+    assert align_window(hour + 1, 2 * hour + 1, "one_hour") == (hour, 3 * hour)
+    assert align_window(1500, 2500, "raw") == (1000, 3000)
+    # 2020-03-15 to 2020-04-02
+    assert align_window(1584230400000, 1585785600000, "one_month") == (
+        1583020800000,
+        1588291200000,
+    )
+
+
+def test_response_cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(response_cache, "_metrics", response_cache.Counter())
+    cache = ResponseCache(path=tmp_path, max_bytes=10000, memory_bytes=1000)
+    assert cache.get("readings?from=0") is None
+    data = [{"time": i, "values": {"power": i}} for i in range(10)]
+    cache.put("readings?from=0", data)
+    assert cache.get("readings?from=0") == data
+    # A new process only finds it on disk.
+    cache = ResponseCache(path=tmp_path, max_bytes=10000, memory_bytes=1000)
+    assert cache.get("readings?from=0") == data
+    assert cache.get("readings?from=0") == data
+    assert response_cache.metrics() == {
+        "misses": 1,
+        "stores": 1,
+        "memory_hits": 2,
+        "disk_hits": 1,
+    }
+    big = [{"time": i, "values": {"power": i, "energy": i * 1000}} for i in range(200)]
+    for i in range(10):
+        cache.put(f"readings?from={i}", big)
+    assert response_cache.metrics()["evictions"]
+    assert cache._scan() <= 10000
+    assert cache.get("readings?from=9") == big
+
+
+def test_meter_readings(tmp_path, monkeypatch):
+    config = Box(
+        {"file_location": {"data_dir": str(tmp_path)}, "response_cache": {"size": 1}}
+    )
+    meter = DiscovergyMeter(meter={"meterId": "1"}, config=config)
+    queries = []
+
+    def query(resource, raw=False):
+        queries.append(resource)
+        return [{"time": 0, "values": {"power": 1}}]
+
+    monkeypatch.setattr(meter, "_query", query)
+    for _ in range(3):
+        meter.readings(ts_from=86400, ts_to=2 * 86400, resolution="one_hour")
+        meter.statistics(ts_from=86400, ts_to=2 * 86400)
+    assert len(queries) == 2
+    now = time.time()
+    for _ in range(2):
+        meter.readings(ts_from=now - 60, ts_to=now)
+    assert len(queries) == 4
+
+
+def test_meter_readings_aligned(tmp_path, monkeypatch):
+    config = Box(
+        {"file_location": {"data_dir": str(tmp_path)}, "response_cache": {"size": 1}}
+    )
+    meter = DiscovergyMeter(meter={"meterId": "1"}, config=config)
+    queries = []
+
+    def query(resource, raw=False):
+        queries.append(resource)
+        return [{"time": t * 3600000, "values": {"power": t}} for t in range(24, 48)]
+
+    monkeypatch.setattr(meter, "_query", query)
+    readings = meter.readings(
+        ts_from=86400 + 5400, ts_to=86400 + 3 * 3600, resolution="one_hour"
+    )
+    assert "from=90000000&to=97200000" in queries[0]
+    # The hours of the window asked for
+    assert [r["values"]["power"] for r in readings] == [25, 26]
+    # Another window in the same hours
+    readings = meter.readings(
+        ts_from=86400 + 3660, ts_to=86400 + 3 * 3600 - 60, resolution="one_hour"
+    )
+    assert [r["values"]["power"] for r in readings] == [25, 26]
+    assert len(queries) == 1
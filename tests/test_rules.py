@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import pandas as pd
+import pytest
+
+from box import Box
+
+from discovergy.live import SourceUpdate
+from discovergy.rules import Rule, RuleEngine, RuleError, RuleInputs, stored_prices
+from discovergy.utils import init_pystore, split_df_by_month, write_data_frames
+
+
+def test_rule_inputs():
+    rule = Rule(
+        name="wm",
+        condition="marketprice < 30 and abs(power) < 500",
+        action="command: true",
+    )
+    assert rule.inputs == {"marketprice", "power"}
+
+
+def test_rule_rejects_unsafe_conditions():
+    for condition in ("__import__('os')", "power.real > 1", "[x for x in power]"):
+        with pytest.raises(RuleError):
+            Rule(name="bad", condition=condition, action="command: true")
+
+
+def test_engine_fires_on_rising_edge_with_debounce():
+    cheap = Rule(
+        name="cheap",
+        condition="marketprice < 30",
+        action="webhook: http://localhost/",
+        debounce=100,
+    )
+    idle = Rule(name="idle", condition="power < 100", action="command: true")
+    engine = RuleEngine([cheap, idle])
+    assert engine.update({"marketprice": 20}, now=0) == [cheap]
+    # Unchanged inputs: nothing is evaluated, nothing fires
+    assert engine.update({"marketprice": 20}, now=1) == []
+    assert engine.update({"marketprice": 40}, now=2) == []
+    # Rising edge within the debounce interval
+    assert engine.update({"marketprice": 10}, now=50) == []
+    assert engine.update({"marketprice": 40}, now=150) == []
+    assert engine.update({"marketprice": 10}, now=151) == [cheap]
+    # Only rules referencing power are evaluated
+    assert engine.update({"power": 50}, now=152) == [idle]
+
+
+def test_stored_prices(tmp_path):
+    config = Box(file_location={"data_dir": tmp_path.as_posix()})
+    init_pystore(config)
+    now = pd.Timestamp("2020-03-01 12:30", tz="utc").timestamp()
+    inputs = RuleInputs()
+    inputs.add_prices(stored_prices(config, now))
+    assert inputs.current(now) == {}
+    # The prices were polled by another worker.
+    hours = pd.date_range("2020-03-01", periods=48, freq="h", tz="utc")
+    df = pd.DataFrame({"marketprice": range(48)}, index=hours, dtype="float64")
+    write_data_frames(
+        config=config, data_frames=split_df_by_month(df=df), name="awattar"
+    )
+    inputs.add_prices(stored_prices(config, now))
+    assert len(inputs.prices) == 36
+    assert inputs.current(now) == {"marketprice": 12.0}
+    # Published prices win.
+    update = SourceUpdate(source="awattar", data=df.iloc[12:13] + 100)
+    inputs.from_item(update)
+    assert inputs.current(now) == {"marketprice": 112.0}
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from box import Box
+
+from discovergy.api import DiscovergyMeter
+from discovergy.statistics import (
+    LocalStatistics,
+    field_scale,
+    invalidate_days,
+    read_summaries,
+)
+
+
+@pytest.fixture
+def stored():
+    """Three days of stored 1 s power data."""
+    index = pd.date_range("2020-03-01", "2020-03-04", freq="s", inclusive="left")
+    rng = np.random.default_rng(0)
+    return pd.DataFrame(
+        {
+            "power": rng.integers(0, 5000, len(index)),
+            "energy": np.cumsum(rng.integers(0, 3, len(index))),
+        },
+        index=index,
+    )
+
+
+def api_stand_in(df, *, ts_from, ts_to):
+    """Compute the statistics like the Discovergy API does from the raw data."""
+    raw = df[
+        (df.index >= pd.Timestamp(ts_from, unit="s"))
+        & (df.index < pd.Timestamp(ts_to, unit="s"))
+    ]
+    result = {}
+    for field in raw:
+        values = raw[field].to_numpy(dtype="float64") * field_scale(field)
+        result[field] = {
+            "count": len(values),
+            "minimum": values.min(),
+            "maximum": values.max(),
+            "mean": values.mean(),
+            "variance": values.var(),
+        }
+    return result
+
+
+@pytest.mark.parametrize(
+    "date_from,date_to",
+    [
+        ("2020-03-01 00:00", "2020-03-04 00:00"),
+        ("2020-03-01 13:17:05", "2020-03-03 08:00:01"),
+        ("2020-03-02 01:00", "2020-03-02 02:00"),
+    ],
+)
+def test_local_statistics_match_api(tmp_path, stored, date_from, date_to):
+    reads = []
+
+    def reader(*, config, name, date_from, date_to, columns=None):
+        reads.append((date_from, date_to))
+        return stored[(stored.index >= date_from) & (stored.index < date_to)]
+
+    config = Box({"file_location": {"data_dir": str(tmp_path)}})
+    local = LocalStatistics(config=config, meter_id="m", reader=reader)
+    ts_from = int(pd.Timestamp(date_from).timestamp())
+    ts_to = int(pd.Timestamp(date_to).timestamp())
+    expected = api_stand_in(stored, ts_from=ts_from, ts_to=ts_to)
+    for _ in range(2):
+        result = local.statistics(ts_from=ts_from, ts_to=ts_to)
+        assert result.keys() == expected.keys()
+        for field in expected:
+            for key, value in expected[field].items():
+                assert result[field][key] == pytest.approx(value, rel=1e-9)
+    # The second query only reads the partial days at the edges.
+    assert len(reads) <= 2 * 3 + 2
+
+
+def test_local_readings(tmp_path, stored):
+    def reader(*, config, name, date_from, date_to, columns=None):
+        df = stored[(stored.index >= date_from) & (stored.index < date_to)]
+        return df[columns] if columns else df
+
+    config = Box({"file_location": {"data_dir": str(tmp_path)}})
+    local = LocalStatistics(config=config, meter_id="m", reader=reader)
+    ts_from = int(pd.Timestamp("2020-03-01").timestamp())
+    ts_to = int(pd.Timestamp("2020-03-03").timestamp())
+    readings = local.readings(ts_from=ts_from, ts_to=ts_to, resolution="one_hour")
+    assert len(readings) == 48
+    assert readings[1]["time"] == (ts_from + 3600) * 1000
+    hour = stored.loc[
+        pd.Timestamp("2020-03-01 01:00") : pd.Timestamp("2020-03-01 01:59:59")
+    ]
+    assert readings[1]["values"]["power"] == pytest.approx(hour["power"].mean())
+    assert readings[1]["values"]["energy"] == hour["energy"].iloc[-1] * field_scale(
+        "energy"
+    )
+    readings = local.readings(
+        field_names=["power"], ts_from=ts_from, ts_to=ts_from + 10, resolution="raw"
+    )
+    assert [r["values"] for r in readings] == [
+        {"power": p} for p in stored["power"].iloc[:10]
+    ]
+
+
+def test_invalidate_days(tmp_path, stored):
+    data = {"df": stored}
+    day = pd.Timestamp("2020-03-01")
+
+    def reader(*, config, name, date_from, date_to, columns=None):
+        df = data["df"]
+        return df[(df.index >= date_from) & (df.index < date_to)]
+
+    config = Box({"file_location": {"data_dir": str(tmp_path)}})
+    local = LocalStatistics(config=config, meter_id="m", reader=reader)
+    ts_from = int(day.timestamp())
+    ts_to = ts_from + 86400
+    first = local.statistics(ts_from=ts_from, ts_to=ts_to)
+    assert list(read_summaries(config, "power_m")) == ["2020-03-01"]
+    data["df"] = stored * 2
+    invalidate_days(config, "power_m", [day])
+    assert read_summaries(config, "power_m") == {}
+    # The same instance doesn't answer from a stale summary.
+    second = local.statistics(ts_from=ts_from, ts_to=ts_to)
+    assert second["power"]["mean"] == pytest.approx(2 * first["power"]["mean"])
+
+    def writing_reader(**kwargs):
+        # Data of the day is written while it is summarized.
+        invalidate_days(config, "power_m", [day])
+        return reader(**kwargs)
+
+    invalidate_days(config, "power_m", [day])
+    local = LocalStatistics(config=config, meter_id="m", reader=writing_reader)
+    assert local.statistics(ts_from=ts_from, ts_to=ts_to) == second
+    assert read_summaries(config, "power_m") == {}
+
+
+def test_choose_resolution():
+    choose = DiscovergyMeter.choose_resolution
+    assert choose(ts_from=0, ts_to=600, max_points=1000) == "raw"
+    assert choose(ts_from=0, ts_to=86400, max_points=500) == "three_minutes"
+    assert choose(ts_from=0, ts_to=10 * 86400, max_points=500) == "one_hour"
+    # A year of raw data can't be queried at once.
+    assert choose(ts_from=0, ts_to=365 * 86400, max_points=10**9) == "one_day"
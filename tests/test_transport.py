@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import gzip
+import json
+import os
+
+import httpx
+
+from discovergy import transport
+from discovergy.auth import OAuth1Auth, OAuth1Token
+
+
+def test_request(monkeypatch):
+    body = json.dumps([{"time": i, "values": {"power": 1000}} for i in range(1000)])
+    seen = []
+
+    def handler(request):
+        seen.append(request)
+        return httpx.Response(
+            200,
+            headers={"Content-Encoding": "gzip"},
+            content=gzip.compress(body.encode()),
+        )
+
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    monkeypatch.setattr(transport, "_client", client)
+    monkeypatch.setattr(transport, "_client_pid", os.getpid())
+    monkeypatch.setattr(transport, "_metrics", {})
+    token = OAuth1Token(
+        key="key", client_secret="secret", token="token", token_secret="token_secret"
+    )
+    for _ in range(2):
+        response = transport.get(
+            "https://api.example.com/public/v1/readings?meterId=1",
+            auth=OAuth1Auth(token),
+        )
+        assert response.json()[-1]["time"] == 999
+    assert transport.get_client() is client
+    authorization = seen[0].headers["Authorization"]
+    assert authorization.startswith("OAuth ")
+    assert 'oauth_token="token"' in authorization
+    assert "oauth_signature=" in authorization
+    metrics = transport.metrics()["api.example.com"]
+    assert metrics["requests"] == 2
+    assert metrics["body_bytes"] == 2 * len(body)
+    assert metrics["wire_bytes"] < metrics["body_bytes"] / 10
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import pandas as pd
+
+from box import Box
+
+from discovergy.compact import store_path
+from discovergy.utils import (
+    init_pystore,
+    parquet_part_files,
+    read_data_from_pystore,
+    write_data_to_pystore,
+)
+
+
+def test_append_overlapping(tmp_path):
+    config = Box(file_location={"data_dir": tmp_path.as_posix()})
+    init_pystore(config)
+    item_path = store_path(config) / "power_x" / "2020-03"
+
+    def write(start, periods, power):
+        df = pd.DataFrame(
+            {"power": [power] * periods},
+            index=pd.date_range(start, periods=periods, freq="s"),
+        )
+        write_data_to_pystore(config=config, data_frames=[df], name="power_x")
+
+    write("2020-03-01", 10, 1)
+    write("2020-03-02", 10, 2)
+    first, second = parquet_part_files(item_path)
+    # No overlap, the stored files are not touched.
+    write("2020-03-03", 10, 3)
+    assert parquet_part_files(item_path)[:2] == [first, second]
+    # Overlapping the second file only, which is merged. The new rows win.
+    write("2020-03-02 00:00:05", 10, 4)
+    files = parquet_part_files(item_path)
+    assert len(files) == 3
+    assert first in files and second not in files
+    stored = read_data_from_pystore(
+        config=config,
+        name="power_x",
+        date_from=pd.Timestamp("2020-03-02"),
+        date_to=pd.Timestamp("2020-03-03"),
+    )
+    assert len(stored) == 15
+    assert list(stored["power"]) == [2] * 5 + [4] * 10
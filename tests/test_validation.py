@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import pandas as pd
+
+from discovergy.power import raw_to_df
+from discovergy.validation import FIELDS, metrics, record_metrics, validate_readings
+
+
+def reading(time, **values):
+    return {"time": time, "values": dict({f: 10**8 for f in FIELDS}, **values)}
+
+
+def test_validate_readings():
+    data = [
+        reading(1000),
+        reading(2000, energy=5),
+        reading(3000, energy=10**8 + 1),
+        {"values": reading(0)["values"]},
+        reading(4000, energy=10**8 + 1, power=-3),
+        reading(5000, voltage1=-1),
+        reading(6000, power1="x"),
+        reading(7000, power2=1.5),
+        {"time": 8000, "values": {"power": 1}},
+    ]
+    validation = validate_readings(data)
+    assert list(validation.readings.index) == list(
+        pd.to_datetime([1000, 3000, 4000], unit="ms")
+    )
+    # Feeding in is a negative power.
+    assert validation.readings.loc[pd.Timestamp("1970-01-01 00:00:04"), "power"] == -3
+    assert validation.stats.readings == 9
+    assert validation.stats.rejected == 6
+    assert validation.stats.reasons == {
+        "missing_time": 1,
+        "missing_field": 1,
+        "not_integer": 2,
+        "negative": 1,
+        "counter_decreasing": 1,
+    }
+    assert validation.rejected.loc[pd.Timestamp("1970-01-01 00:00:02"), "reason"] == (
+        "counter_decreasing"
+    )
+    assert (
+        '"power1": "x"'
+        in validation.rejected.loc[pd.Timestamp("1970-01-01 00:00:06"), "values"]
+    )
+
+    record_metrics("quarantine_x", validation.stats)
+    assert metrics()["quarantine_x"]["rejected"] == 6
+
+    assert not len(validate_readings([]).readings)
+
+
+def test_counter_below_max():
+    data = [
+        reading(t * 1000, energy=energy)
+        for t, energy in enumerate([100, 200, 150, 160, 200, 210], 1)
+    ]
+    validation = validate_readings(data)
+    assert list(validation.readings["energy"]) == [100, 200, 200, 210]
+    assert validation.stats.reasons == {"counter_decreasing": 2}
+
+
+def test_counter_below_max_of_accepted():
+    data = [
+        reading(t * 1000, energy=energy, energy1=energy1)
+        for t, (energy, energy1) in enumerate([(100, 100), (90, 300), (110, 200)], 1)
+    ]
+    validation = validate_readings(data, ["energy", "energy1"])
+    # The rejected second reading doesn't raise the max of energy1.
+    assert list(validation.readings["energy1"]) == [100, 200]
+    assert validation.stats.reasons == {"counter_decreasing": 1}
+
+
+def test_raw_to_df():
+    df = raw_to_df(data=[reading(1000, energy=25 * 10**7, voltage1=23012)])
+    assert df.loc[pd.Timestamp("1970-01-01 00:00:01"), "energy"] == 25
+    assert df.loc[pd.Timestamp("1970-01-01 00:00:01"), "voltage1"] == 230
+    assert df.loc[pd.Timestamp("1970-01-01 00:00:01"), "power"] == 10**8
+
+
+def test_validate_fields():
+    data = [
+        {"time": 1000, "values": {"power": 5, "energy": 10**8}},
+        {"time": 2000, "values": {"power": -5, "energy": 10**8 - 1}},
+        {"time": 3000, "values": {"power": 7, "energy": 10**8, "voltage1": -1}},
+        {"time": 4000, "values": {"energy": 10**8}},
+    ]
+    validation = validate_readings(data, ["power", "energy"])
+    assert list(validation.readings.columns) == ["power", "energy"]
+    assert list(validation.readings["power"]) == [5, 7]
+    assert validation.stats.reasons == {"missing_field": 1, "counter_decreasing": 1}
+    df = raw_to_df(data=data, fields=["power"])
+    assert list(df.columns) == ["power"]
+    assert len(df.dropna()) == 4 - 1
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -*-
+
+__author__ = "Frank Becker <fb@alien8.de>"
+__copyright__ = "Frank Becker"
+__license__ = "mit"
+
+import time
+
+import pandas as pd
+import pytest
+
+from box import Box
+
+from discovergy import weather
+from discovergy.utils import read_data_frames, write_data_frames
+
+
+@pytest.fixture
+def config(tmp_path):
+    return Box(
+        file_location={"data_dir": tmp_path.as_posix()},
+        open_weather_map={"id": "x", "flush_size": 3, "flush_interval": 3600},
+    )
+
+
+def record(reference_time, temp=280.0, location="default"):
+    return {
+        "reference_time": reference_time,
+        "temp": temp,
+        "status": "Clouds",
+        "detailed_status": "overcast clouds",
+        "weather_icon_name": "04d",
+        "location": location,
+    }
+
+
+def stored(config):
+    return read_data_frames(
+        config=config,
+        name="weather",
+        date_from=pd.Timestamp("2000-01-01", tz="utc"),
+        date_to=pd.Timestamp("2100-01-01", tz="utc"),
+    )
+
+
+def test_buffer(config):
+    now = int(time.time())
+    weather.buffer_records(config=config, records=[record(now), record(now + 1)])
+    with weather.buffer_file_path(config).open("a") as fh:
+        fh.write('{"reference_time": ')
+    assert weather.read_buffer(weather.buffer_file_path(config)) == [
+        record(now),
+        record(now + 1),
+    ]
+
+
+def test_flush_buffer(config):
+    now = int(time.time())
+    buffer_path = weather.buffer_file_path(config)
+    weather.buffer_records(config=config, records=[record(now), record(now + 1)])
+    weather.flush_buffer(config=config)
+    assert buffer_path.exists()
+    assert not len(stored(config))
+    # The flush size is reached.
+    weather.buffer_records(config=config, records=[record(now + 2)])
+    weather.flush_buffer(config=config)
+    assert not buffer_path.exists()
+    assert len(stored(config)) == 3
+
+    # A buffer left over by a crash is written first. Duplicates are dropped.
+    flushing_path = buffer_path.with_suffix(".flushing")
+    flushing_path.write_text(
+        "\n".join(
+            f'{{"reference_time": {t}, "location": "default"}}' for t in [now, now + 3]
+        )
+    )
+    weather.flush_buffer(config=config)
+    assert not flushing_path.exists()
+    assert len(stored(config)) == 4
+
+
+def test_convert_fixed_format(config):
+    # Files written before the buffer had one location and no location column.
+    old = weather.records_to_df(records=[record(1583020800), record(1583024400)])
+    old = old.drop(columns=["location", "detailed_status", "weather_icon_name"])
+    write_data_frames(config=config, data_frames=[old], name="weather")
+
+    new = [record(1583024400, temp=1.0), record(1583028000, location="office")]
+    weather._write_records(config=config, records=new)
+    weather._write_records(config=config, records=[record(1583031600)])
+    df = stored(config)
+    assert list(df["location"]) == ["default", "default", "office", "default"]
+    # The record already stored for the default location is not added again.
+    assert list(df["temp"]) == [280.0, 280.0, 280.0, 280.0]
+    assert list(df["detailed_status"])[1:] == ["", "overcast clouds", "overcast clouds"]
+
+
+def test_convert_numeric_strings(config):
+    # A table an earlier conversion wrote with NaN locations
+    old = weather.records_to_df(records=[record(1583020800)])
+    old["location"] = float("nan")
+    file_path = (
+        weather.buffer_file_path(config).parent / "weather_2020-03.hdf5"
+    ).as_posix()
+    old.astype({"location": "float64"}).to_hdf(file_path, key="weather", format="table")
+    weather._write_records(config=config, records=[record(1583024400)])
+    assert list(stored(config)["location"]) == ["default", "default"]